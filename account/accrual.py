@@ -0,0 +1,83 @@
+"""
+Nightly interest accrual and delinquency for active loans.
+
+run() walks approved loans in primary-key order, CHUNK_SIZE at a time, one DB transaction
+per chunk. Each chunk is a fixed handful of queries whatever its size:
+  1. lock the next loans not yet accrued for the business date (SKIP LOCKED, so several
+     workers can share a night);
+  2. one grouped query over their open installments (outstanding principal, oldest
+     missed due date, amount overdue);
+  3. one bulk insert of LoanAccrual entries and one bulk_update (a CASE per column) of
+     accrued_interest, days_past_due and last_accrual_date;
+  4. one bulk insert of delinquency notifications, after commit.
+Interest is outstanding principal * APR / 365 for every day since the loan's previous
+accrual (or its approval), so a skipped night is caught up on the next one. A loan
+accrued for a date is never picked again for it: reruns and restarts are no-ops for the
+loans already done, and an interrupted run simply resumes.
+"""
+from decimal import Decimal
+
+from django.db import transaction
+from django.db.models import F, Min, Q, Sum
+from django.utils import timezone
+
+from . import approvals
+from .models import Loan, LoanAccrual, LoanInstallment
+
+CHUNK_SIZE = 1000
+DAYS_PER_YEAR = 365
+DELINQUENCY_DAYS = (1, 30, 60, 90) # Notify when a loan crosses each of these
+INTEREST_PLACES = Decimal('0.0001')
+ZERO = Decimal('0.00')
+
+
+def due(business_date):
+    """Active loans not yet accrued for business_date."""
+    return Loan.objects.filter(Q(last_accrual_date__lt=business_date) | Q(last_accrual_date__isnull=True), status='approved')
+
+def _days_since(loan, business_date):
+    since = loan.last_accrual_date or (timezone.localdate(loan.approved_at) if loan.approved_at else business_date)
+    return max((business_date - since).days, 0)
+
+@transaction.atomic
+def accrue_chunk(business_date, after=0, chunk_size=CHUNK_SIZE):
+    """Accrues the next chunk of loans with pk > after. Returns (last pk or None when done, loans, interest)."""
+    batch = list(due(business_date).filter(pk__gt=after).order_by('pk').select_for_update(skip_locked=True)
+                 .only('pk', 'user_id', 'apr', 'approved_at', 'accrued_interest', 'days_past_due', 'last_accrual_date')[:chunk_size])
+    if not batch: return None, 0, ZERO
+
+    installments = LoanInstallment.objects.filter(loan__in=batch, paid_at__isnull=True).values('loan_id').annotate(
+        outstanding=Sum(F('principal') - F('principal_paid')),
+        oldest_missed=Min('due_date', filter=Q(due_date__lt=business_date)),
+        overdue=Sum(F('principal') + F('interest') - F('principal_paid') - F('interest_paid'), filter=Q(due_date__lt=business_date)),
+    ).order_by()
+    open_by_loan = {row['loan_id']: row for row in installments}
+
+    entries, notices, total = [], [], ZERO
+    for loan in batch:
+        row = open_by_loan.get(loan.pk, {})
+        principal, days = row.get('outstanding') or ZERO, _days_since(loan, business_date)
+        interest = (principal * (loan.apr or 0) * days / DAYS_PER_YEAR).quantize(INTEREST_PLACES)
+        past_due = (business_date - row['oldest_missed']).days if row.get('oldest_missed') else 0
+        crossed = [d for d in DELINQUENCY_DAYS if loan.days_past_due < d <= past_due]
+        if crossed:
+            notices.append((loan.user_id, f"Your loan payment of ${row['overdue']:,.2f} is {past_due} days past due. Please pay to avoid further action.",
+                            (row['overdue'], 'Loan Payment Overdue', f"{past_due} days past due")))
+        entries.append(LoanAccrual(loan=loan, business_date=business_date, days=days, principal=principal, interest=interest, days_past_due=past_due))
+        loan.accrued_interest += interest
+        loan.days_past_due, loan.last_accrual_date = past_due, business_date
+        total += interest
+
+    LoanAccrual.objects.bulk_create(entries)
+    Loan.objects.bulk_update(batch, ['accrued_interest', 'days_past_due', 'last_accrual_date'])
+    approvals.notify_many(notices)
+    return batch[-1].pk, len(batch), total
+
+def run(business_date=None, chunk_size=CHUNK_SIZE):
+    """Accrues every due loan for business_date (default: today). Yields (loans, interest) per chunk."""
+    business_date = business_date or timezone.localdate()
+    after = 0
+    while True:
+        after, count, interest = accrue_chunk(business_date, after, chunk_size)
+        if after is None: return
+        yield count, interest
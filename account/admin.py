@@ -1,25 +1,24 @@
 from django.contrib import admin
 from django.utils.html import format_html
-from .models import Account, Transaction, CreditCard, Notification, SupportMessage, Loan
+from decimal import Decimal
+from .models import Account, Transaction, ArchivedTransaction, CreditCard, Notification, SupportMessage, Loan, LoanInstallment, LedgerEntry
+from . import approvals, ledger
 
 # --- MANAGER QUICK ACTIONS ---
 @admin.action(description='✅ Approve Selected Transactions')
 def approve_transactions(modeladmin, request, queryset):
-    for txn in queryset:
-        if txn.status != 'success':
-            txn.status = 'success'
-            txn.save() # Triggers balance update signal
+    approved = approvals.approve_transactions(queryset)
+    modeladmin.message_user(request, f"Approved {approved} transaction(s).")
 
 @admin.action(description='❌ Reject Selected Transactions')
 def reject_transactions(modeladmin, request, queryset):
-    queryset.update(status='failed', rejection_reason="Compliance Review Failed")
+    rejected = approvals.reject_transactions(queryset, "Compliance Review Failed")
+    modeladmin.message_user(request, f"Rejected {rejected} transaction(s); their bookings were reversed.")
 
 @admin.action(description='✅ Approve Selected Loans')
 def approve_loans(modeladmin, request, queryset):
-    for loan in queryset:
-        if loan.status != 'approved':
-            loan.status = 'approved'
-            loan.save() # Triggers credit signal
+    approved = approvals.approve_loans(queryset)
+    modeladmin.message_user(request, f"Approved and disbursed {approved} loan(s).")
 
 @admin.action(description='🔍 Verify KYC Identity')
 def verify_kyc(modeladmin, request, queryset):
@@ -35,6 +34,7 @@ class AccountAdmin(admin.ModelAdmin):
     list_filter = ('account_status', 'kyc_confirmed')
     search_fields = ('account_number', 'user__username', 'user__email', 'phone')
     list_editable = ('account_status',) 
+    list_select_related = ('user',) # user_info reads the holder's name per row
     readonly_fields = ('account_number',)
 
     fieldsets = (
@@ -55,6 +55,15 @@ class AccountAdmin(admin.ModelAdmin):
         }),
     )
 
+    def save_model(self, request, obj, form, change):
+        # Balance edits become ledger adjustments instead of overwriting the projection
+        target = obj.balance
+        current = Account.objects.get(pk=obj.pk).balance if change else Decimal('0.00')
+        if not change: obj.balance = current
+        super().save_model(request, obj, form, change)
+        if target != current:
+            ledger.post([(obj, target - current)], memo=f"Admin adjustment by {request.user.username}", allow_overdraft=True)
+
     @admin.display(description='User')
     def user_info(self, obj):
         return obj.user.username
@@ -86,6 +95,7 @@ class TransactionAdmin(admin.ModelAdmin):
     list_filter = ('status', 'transaction_type', 'date')
     search_fields = ('sender__username', 'receiver__username', 'amount', 'id')
     list_editable = ('status', 'date', 'rejection_reason') 
+    list_select_related = ('sender', 'receiver') # user_info reads both usernames per row
     actions = [approve_transactions, reject_transactions]
     date_hierarchy = 'date'
 
@@ -127,14 +137,25 @@ class TransactionAdmin(admin.ModelAdmin):
         return "-"
 
 
+class LoanInstallmentInline(admin.TabularInline):
+    model = LoanInstallment
+    fields = ('number', 'due_date', 'principal', 'interest', 'principal_paid', 'interest_paid', 'paid_at')
+    readonly_fields = fields
+    extra = 0
+
+    # Written at approval and by repayments (account.loans), never by hand
+    def has_add_permission(self, request, obj=None): return False
+    def has_delete_permission(self, request, obj=None): return False
+
 @admin.register(Loan)
 class LoanAdmin(admin.ModelAdmin):
     # FIXED: Replaced 'status_badge' with 'status'
-    list_display = ('user', 'amount_fmt', 'purpose', 'status', 'date_applied')
+    list_display = ('user', 'amount_fmt', 'purpose', 'status', 'days_past_due', 'date_applied')
     list_filter = ('status', 'date_applied')
     search_fields = ('user__username', 'amount')
     list_editable = ('status',)
     actions = [approve_loans]
+    inlines = [LoanInstallmentInline]
 
     @admin.display(description='Amount')
     def amount_fmt(self, obj):
@@ -154,5 +175,30 @@ class SupportMessageAdmin(admin.ModelAdmin):
     def direction(self, obj):
         return "Admin ➝ User" if obj.is_admin_reply else "User ➝ Admin"
 
+@admin.register(LedgerEntry)
+class LedgerEntryAdmin(admin.ModelAdmin):
+    list_display = ('posting_id', 'account', 'amount', 'txn', 'memo', 'created_at')
+    list_filter = ('created_at',)
+    search_fields = ('posting_id', 'account__account_number', 'memo')
+    list_select_related = ('account__user',)
+
+    # Append-only: entries are written by account.ledger, never by hand
+    def has_add_permission(self, request): return False
+    def has_change_permission(self, request, obj=None): return False
+    def has_delete_permission(self, request, obj=None): return False
+
+@admin.register(ArchivedTransaction)
+class ArchivedTransactionAdmin(admin.ModelAdmin):
+    list_display = ('id', 'sender', 'receiver', 'amount', 'transaction_type', 'status', 'date')
+    list_filter = ('status', 'transaction_type')
+    search_fields = ('sender__username', 'receiver__username', 'id')
+    list_select_related = ('sender', 'receiver')
+    date_hierarchy = 'date'
+
+    # Read-only: rows are moved here by `partition_transactions --archive-years`
+    def has_add_permission(self, request): return False
+    def has_change_permission(self, request, obj=None): return False
+    def has_delete_permission(self, request, obj=None): return False
+
 admin.site.register(CreditCard)
 admin.site.register(Notification)
\ No newline at end of file
@@ -0,0 +1,228 @@
+"""
+Side effects of approving transactions and loans.
+
+The Transaction and Loan post_save signals call in here once a saved status differs from
+the one the row was loaded with. Balance effects are booked through the ledger inside
+the saving transaction (LoadedValues.save makes a status-changing save atomic);
+notifications and alert emails are only dispatched once that transaction commits, so a
+rolled-back approval never tells anyone anything and no lock is held while they are built.
+
+approve_transactions() and approve_loans() do the same for a whole queryset (admin
+actions, the `approve_pending` command) set-wise, BATCH_SIZE rows per DB transaction:
+rows locked in one SELECT ... FOR UPDATE, statuses flipped in one UPDATE, every credit
+booked through one ledger batch posting (one grouped balance UPDATE), rollups adjusted
+in one upsert and notifications bulk-inserted after commit. Approving a held internal
+transfer settles it: its receiver is credited from the clearing side, as
+account.settlement would. Deposits, held transfers and loans whose user has no account
+are left as they are.
+
+reject_transactions() (and a single save that moves a row to 'failed') undoes what the
+row had booked, in the same transaction that fails it: a successful row is reversed on
+both sides, a held one refunds its sender from the clearing side. Each reversal is a
+'refund' row of its own, so statements, checkpoints and rollups, which are built from
+the rows, net out too. A rejected row that refunded its sender cannot be approved again;
+the customer books a new transfer instead. Likewise a successful row can only move on to
+'failed', and a receiver credit already in the ledger for a row is never booked again.
+"""
+from django.contrib.auth.models import User
+from django.db import transaction
+from django.utils import timezone
+
+from . import checkpoints, emails, ledger, loans, notifications, rollups, statements
+from .models import Account, Loan, LoanInstallment, Notification, Transaction
+
+BATCH_SIZE = 1000
+PRICING_FIELDS = ('apr', 'approved_at', 'total_repayment') # Set by loans.schedule()
+
+
+def notify_many(notices):
+    """After commit, bulk-creates (user_id, message, alert) notifications and queues an alert email for each alert given as (amount, type, status)."""
+    notices = list(notices)
+    if not notices: return
+    def dispatch():
+        notifications.bulk_create([Notification(user_id=user_id, message=message) for user_id, message, _ in notices])
+        users = User.objects.select_related('account').in_bulk({user_id for user_id, _, alert in notices if alert})
+        for user_id, _, alert in notices:
+            if alert and user_id in users: emails.queue_transaction_alert(users[user_id], *alert)
+    transaction.on_commit(dispatch)
+
+def notify(user_id, message, alert=None):
+    notify_many([(user_id, message, alert)])
+
+def _account_id(user_id, what):
+    account_id = Account.objects.filter(user_id=user_id).values_list('pk', flat=True).first()
+    if account_id is None: raise ledger.LedgerError(f"User {user_id} has no account to credit {what} to.")
+    return account_id
+
+def _receiver_credit(txn, old_status):
+    """Memo of the credit that approving txn owes its receiver, or None.
+
+    Deposits come in from outside; held internal transfers ('processing') already took the
+    money from the sender, and it waits on the clearing side until settled.
+    """
+    if not txn.receiver_id: return None
+    if txn.transaction_type == 'deposit': return f"Deposit TRX-{txn.pk}"
+    if txn.transaction_type == 'transfer' and txn.sender_id and old_status == 'processing': return f"Settlement of TRX-{txn.pk}"
+    return None
+
+def transaction_status_changed(txn, old_status):
+    """Books and announces a transaction whose status moved from old_status to txn.status."""
+    if old_status == 'failed' and txn.sender_id:
+        raise ledger.LedgerError(f"TRX-{txn.pk} was rejected and its sender refunded; book a new transaction instead.")
+    if old_status == 'success' and txn.status != 'failed':
+        # Nothing unbooks a settled row short of rejecting it, so settling it again would pay twice
+        raise ledger.LedgerError(f"TRX-{txn.pk} has already succeeded; reject it to reverse it.")
+    if txn.status == 'failed':
+        _reverse([(txn, old_status)], txn.rejection_reason)
+    credited = txn.status == 'success' and _receiver_credit(txn, old_status)
+    if credited and ledger.posted({txn.pk: credited}): credited = None
+    if credited:
+        ledger.credit(_account_id(txn.receiver_id, f"TRX-{txn.pk}"), txn.amount, credited, txn=txn)
+
+    notify_many(_status_notices([txn]))
+    if credited and txn.sender_id: notify_many(_credit_notices([txn]))
+
+def _status_notices(txns):
+    for t in txns:
+        target = t.sender_id or t.receiver_id
+        if not target: continue
+        msg = f"Transaction Update: ${t.amount} is now {t.status.upper()}."
+        if t.status == 'failed' and t.rejection_reason: msg += f" Reason: {t.rejection_reason}"
+        yield target, msg, (t.amount, t.transaction_type, t.get_status_display())
+
+def _credit_notices(transfers):
+    return [(t.receiver_id, f"Credit Alert: You received ${t.amount}.", (t.amount, "Incoming Transfer", "Successful")) for t in transfers]
+
+def loan_approved(loan):
+    """Schedules a newly approved loan and disburses it into the borrower's account."""
+    account_id = _account_id(loan.user_id, f"loan #{loan.pk}")
+    LoanInstallment.objects.bulk_create(loans.schedule(loan))
+    Loan.objects.filter(pk=loan.pk).update(**{f: getattr(loan, f) for f in PRICING_FIELDS})
+    credit = Transaction.objects.create(**_disbursement(loan))
+    ledger.credit(account_id, loan.amount, f"Loan Disbursement #{loan.pk}", txn=credit)
+    notify_many(_loan_notices([loan]))
+
+def _disbursement(loan):
+    return {'receiver_id': loan.user_id, 'amount': loan.amount, 'transaction_type': 'loan', 'status': 'success', 'note': f"Loan Approved: {loan.purpose}"}
+
+def _loan_notices(approved):
+    return [(l.user_id, f"Congratulations! Your loan of ${l.amount} has been approved.", (l.amount, 'Loan Disbursement', 'Success')) for l in approved]
+
+
+# --- BULK ---
+def _in_batches(ids, batch_size, approve_batch):
+    return sum(approve_batch(ids[i:i + batch_size]) for i in range(0, len(ids), batch_size))
+
+def approve_transactions(queryset, batch_size=BATCH_SIZE):
+    """Marks every transaction in queryset that has not succeeded yet (nor been refunded) as successful. Returns how many were approved."""
+    ids = list(queryset.exclude(status='success').exclude(status='failed', sender__isnull=False).order_by('pk').values_list('pk', flat=True))
+    return _in_batches(ids, batch_size, _approve_transaction_batch)
+
+@ledger.retry_on_conflict
+def _approve_transaction_batch(ids):
+    batch = list(Transaction.objects.filter(pk__in=ids).exclude(status='success').exclude(status='failed', sender__isnull=False)
+                 .select_for_update().only(*Transaction.TRACKED_FIELDS).order_by('pk'))
+    memos = {t.pk: _receiver_credit(t, t.status) for t in batch} # Read before the flip below
+    for pk in ledger.posted(memos): memos[pk] = None # Credited before (the row was approved once already)
+    accounts = dict(Account.objects.filter(user_id__in={t.receiver_id for t in batch if memos[t.pk]}).values_list('user_id', 'pk'))
+    batch = [t for t in batch if not memos[t.pk] or t.receiver_id in accounts]
+    if not batch: return 0
+
+    # 1. Flip statuses in one UPDATE (bulk update skips the signals: rollups are kept here)
+    Transaction.objects.filter(pk__in=[t.pk for t in batch]).update(status='success')
+    for t in batch: t.status = 'success'
+    rollups.apply(t.tracked_state() for t in batch)
+
+    # 2. Credit deposit and held-transfer receivers in one posting batch
+    credited = [t for t in batch if memos[t.pk]]
+    ledger.post_batch([([(accounts[t.receiver_id], t.amount)], memos[t.pk], t) for t in credited])
+
+    # 3. Notices after commit
+    notify_many([*_status_notices(batch), *_credit_notices(t for t in credited if t.sender_id)])
+    return len(batch)
+
+def reject_transactions(queryset, reason, batch_size=BATCH_SIZE):
+    """Fails every transaction in queryset that has not failed yet and reverses what it booked. Returns how many were rejected."""
+    ids = list(queryset.exclude(status='failed').order_by('pk').values_list('pk', flat=True))
+    return _in_batches(ids, batch_size, lambda batch: _reject_transaction_batch(batch, reason))
+
+@ledger.retry_on_conflict
+def _reject_transaction_batch(ids, reason):
+    batch = list(Transaction.objects.filter(pk__in=ids).exclude(status='failed').select_for_update()
+                 .only(*Transaction.TRACKED_FIELDS, 'rejection_reason').order_by('pk'))
+    if not batch: return 0
+
+    # 1. Flip statuses in one UPDATE; only successful rows were in the rollups
+    before = [(t, t.status) for t in batch]
+    Transaction.objects.filter(pk__in=[t.pk for t in batch]).update(status='failed', rejection_reason=reason)
+    rollups.apply((t.tracked_state() for t in batch if t.status == 'success'), -1)
+    for t in batch: t.status, t.rejection_reason = 'failed', reason
+
+    # 2. Reverse their bookings in one posting batch
+    _reverse(before, reason)
+
+    # 3. Notices after commit
+    notify_many(_status_notices(batch))
+    return len(batch)
+
+def _booked(txn, status):
+    """[(user_id, signed amount)] that txn moved while in status: both sides once it succeeded, the sender's alone while held."""
+    moved = []
+    if status in ('success', 'processing') and txn.sender_id: moved.append((txn.sender_id, -txn.amount))
+    if status == 'success' and txn.receiver_id: moved.append((txn.receiver_id, txn.amount))
+    return moved
+
+def _reverse(rejected, reason):
+    """Books a refund row and the opposite ledger posting for each (txn, status it had) that moved money."""
+    rejected = [(t, _booked(t, status)) for t, status in rejected]
+    rejected = [(t, moved) for t, moved in rejected if moved]
+    if not rejected: return
+    users = User.objects.in_bulk({user_id for _, moved in rejected for user_id, _ in moved})
+    accounts = dict(Account.objects.filter(user_id__in=users).values_list('user_id', 'pk'))
+
+    # Refund rows run opposite to the original (bulk_create skips save() and the signals: kept here)
+    refunds = []
+    for t, moved in rejected:
+        sides = {'receiver' if amount < 0 else 'sender': users[user_id] for user_id, amount in moved}
+        refunds.append(Transaction(amount=t.amount, transaction_type='refund', status='success', note=f"Reversal of TRX-{t.pk}: {reason}", **sides))
+    for r in refunds: r.search_document = r.build_search_document()
+    refunds = Transaction.objects.bulk_create(refunds)
+    for r in refunds:
+        checkpoints.record_change(None, r.tracked_state())
+        statements.record_change(None, r.tracked_state())
+    rollups.apply(r.tracked_state() for r in refunds)
+
+    # The money comes back even if the receiver has spent it since (as with admin adjustments)
+    ledger.post_batch([([(accounts[user_id], -amount) for user_id, amount in moved if user_id in accounts], f"Reversal of TRX-{t.pk}", r)
+                       for (t, moved), r in zip(rejected, refunds)], allow_overdraft=True)
+
+def approve_loans(queryset, batch_size=BATCH_SIZE):
+    """Approves and disburses every loan in queryset that is not active yet. Returns how many were approved."""
+    ids = list(queryset.exclude(status='approved').order_by('pk').values_list('pk', flat=True))
+    return _in_batches(ids, batch_size, _approve_loan_batch)
+
+@ledger.retry_on_conflict
+def _approve_loan_batch(ids):
+    batch = list(Loan.objects.filter(pk__in=ids).exclude(status='approved').select_for_update(of=('self',))
+                 .select_related('user').order_by('pk'))
+    accounts = dict(Account.objects.filter(user_id__in={l.user_id for l in batch}).values_list('user_id', 'pk'))
+    batch = [l for l in batch if l.user_id in accounts]
+    if not batch: return 0
+
+    # 1. Schedule, then price and flip in one UPDATE
+    now, installments = timezone.now(), []
+    for loan in batch:
+        loan.status = 'approved'
+        installments += loans.schedule(loan, now)
+    Loan.objects.bulk_update(batch, ['status', *PRICING_FIELDS])
+    LoanInstallment.objects.bulk_create(installments, batch_size=1000)
+
+    # 2. Disbursement rows (bulk_create skips save() and the signals: search text and rollups are filled here)
+    credits = [Transaction(receiver=loan.user, **_disbursement(loan)) for loan in batch]
+    for t in credits: t.search_document = t.build_search_document()
+    credits = Transaction.objects.bulk_create(credits)
+    rollups.apply(t.tracked_state() for t in credits)
+    ledger.post_batch([([(accounts[l.user_id], l.amount)], f"Loan Disbursement #{l.pk}", t) for l, t in zip(batch, credits)])
+
+    notify_many(_loan_notices(batch))
+    return len(batch)
@@ -0,0 +1,82 @@
+"""
+Cold archive for old transactions.
+
+archive_month() moves one whole month out of Transaction into ArchivedTransaction: same
+ids, only the columns history, exports and statements print (no check images, routing
+numbers or search text), indexed per side like the hot table. On Postgres the month's
+partition is copied and dropped, so nothing is left behind to vacuum.
+
+Months are archived oldest first, so every archived row is older than every hot row.
+Readers (account.queries, account.statements) rely on that: once the hot table runs
+out they simply continue into the archive. Archived months must already be closed
+(close_month), so opening balances never need their rows; monthly rollups keep their
+totals, and ledger entries keep pointing at the archived id. Archived rows are not
+searchable and cannot be edited.
+"""
+from datetime import date
+
+from django.db import connection, transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from . import checkpoints, partitions
+from .models import ArchivedTransaction, BalanceCheckpoint, Transaction
+
+COLUMNS = ('id', 'sender_id', 'receiver_id', 'amount', 'transaction_type', 'status', 'date',
+           'rejection_reason', 'receiver_account_number', 'receiver_bank_name', 'note')
+
+
+class ArchiveError(Exception):
+    pass
+
+
+def horizon(years, today=None):
+    """First month that stays hot when keeping `years` years of history."""
+    today = checkpoints.month_start(today or timezone.now())
+    return date(today.year - years, today.month, 1)
+
+def oldest_hot_month():
+    first = Transaction.objects.order_by('date').values_list('date', flat=True).first()
+    return checkpoints.month_start(first) if first else None
+
+@transaction.atomic
+def archive_month(month):
+    """Moves every transaction dated in `month` to the archive. Returns how many rows moved."""
+    if month > checkpoints.last_closed_month():
+        raise ArchiveError(f"{month:%Y-%m} has not closed yet.")
+    start, end = checkpoints.month_bounds(month)
+    if Transaction.objects.filter(date__lt=start).exists():
+        raise ArchiveError(f"Older months must be archived before {month:%Y-%m}.")
+    if not BalanceCheckpoint.objects.filter(month=month).exists() and Transaction.objects.filter(date__lt=end).exists():
+        raise ArchiveError(f"{month:%Y-%m} has no balance checkpoints; run close_month first.")
+
+    columns = ', '.join(COLUMNS)
+    partition = partitions.existing().get(month) if partitions.is_partitioned() else None
+    with connection.cursor() as cursor:
+        if partition:
+            cursor.execute(f"INSERT INTO {ArchivedTransaction._meta.db_table} ({columns}) SELECT {columns} FROM {partition}")
+            moved = cursor.rowcount
+            cursor.execute(f"DROP TABLE {partition}")
+        else:
+            # Raw SQL on purpose: the ORM delete would run the Transaction signals and unwind checkpoints/rollups
+            where = "WHERE date >= %s AND date < %s"
+            cursor.execute(f"INSERT INTO {ArchivedTransaction._meta.db_table} ({columns}) SELECT {columns} FROM {Transaction._meta.db_table} {where}", [start, end])
+            moved = cursor.rowcount
+            cursor.execute(f"DELETE FROM {Transaction._meta.db_table} {where}", [start, end])
+    return moved
+
+def archive_before(month):
+    """Archives every hot month older than `month`, oldest first. Yields (month, rows moved)."""
+    current = oldest_hot_month()
+    while current and current < month:
+        yield current, archive_month(current)
+        current = checkpoints.next_month(current)
+
+
+# --- READERS ---
+def user_rows(user, side=None, since=None):
+    """Archived rows of one user (or one side of them), with counterparties loaded."""
+    rows = ArchivedTransaction.objects.select_related('sender', 'receiver')
+    if since: rows = rows.filter(date__gte=since)
+    if side: return rows.filter(**{'sender' if side == 'sent' else 'receiver': user})
+    return rows.filter(Q(sender=user) | Q(receiver=user))
@@ -0,0 +1,142 @@
+"""
+Batch (payroll) transfers.
+
+A CSV or JSON file of internal transfers is validated up front (every recipient
+account number resolved in bulk, the batch total checked against the balance once),
+then posted in chunks: each chunk is one DB transaction with a bulk_create of its
+Transaction rows and a single ledger batch posting. The caller gets one result row
+per input row.
+
+Rows get the same treatment as a single transfer of their amount. Every row counts
+against the velocity limits (account.velocity.reserve_many, once per chunk), and a row
+that would break one fails on its own. Rows of HOLD_AMOUNT or more are booked as
+'processing': their money waits on the clearing side until account.settlement pays the
+receiver.
+"""
+import csv
+import io
+import json
+from decimal import Decimal, InvalidOperation
+
+from django.contrib.auth.models import User
+
+from . import emails, ledger, notifications, rollups, velocity
+from .models import Account, Notification, Transaction
+
+MAX_ROWS = 50000
+CHUNK_SIZE = 1000
+LOOKUP_CHUNK = 10000 # Keeps the IN (...) list under SQLite's bound-parameter limit
+HOLD_AMOUNT = Decimal('1000.00') # Same review threshold as execute_transfer
+RESULT_FIELDS = ['row', 'account_number', 'amount', 'note', 'status', 'reference', 'error']
+
+
+class BatchError(Exception):
+    """The file as a whole cannot be processed (nothing was posted)."""
+
+
+def parse_batch(upload):
+    """Reads an uploaded CSV (account_number,amount[,note] header) or JSON list into row dicts."""
+    if upload is None: raise BatchError("Please choose a CSV or JSON file.")
+    try: text = upload.read().decode('utf-8-sig')
+    except UnicodeDecodeError: raise BatchError("The file must be UTF-8 text.")
+
+    if upload.name.lower().endswith('.json') or text.lstrip().startswith('['):
+        try: records = json.loads(text)
+        except ValueError: raise BatchError("The JSON file could not be parsed.")
+        if not isinstance(records, list) or not all(isinstance(r, dict) for r in records):
+            raise BatchError("JSON batches must be a list of {account_number, amount, note} objects.")
+    else:
+        records = list(csv.DictReader(io.StringIO(text)))
+        if records and not {'account_number', 'amount'} <= set(records[0]):
+            raise BatchError("CSV batches need an 'account_number' and an 'amount' column.")
+
+    if not records: raise BatchError("The file contains no transfers.")
+    if len(records) > MAX_ROWS: raise BatchError(f"Batches are limited to {MAX_ROWS:,} transfers.")
+    return [{'row': n, 'account_number': str(r.get('account_number') or '').strip(), 'amount': str(r.get('amount') or '').strip(),
+             'note': str(r.get('note') or '').strip()[:100]} for n, r in enumerate(records, start=1)]
+
+
+def _held(row):
+    return row['amount'] >= HOLD_AMOUNT
+
+def _validate(user, rows):
+    numbers = list({r['account_number'] for r in rows})
+    accounts = {}
+    for i in range(0, len(numbers), LOOKUP_CHUNK):
+        accounts.update((num, (pk, user_id)) for num, pk, user_id in
+                        Account.objects.filter(account_number__in=numbers[i:i + LOOKUP_CHUNK]).values_list('account_number', 'pk', 'user_id'))
+
+    valid = []
+    for r in rows:
+        r.update(status='failed', reference='', error='')
+        try:
+            amount = Decimal(r['amount'])
+            if amount <= 0 or amount != amount.quantize(Decimal('0.01')): raise InvalidOperation
+        except InvalidOperation:
+            r['error'] = "Invalid amount"; continue
+        target = accounts.get(r['account_number'])
+        if not target: r['error'] = "Recipient account number not found"; continue
+        if target[1] == user.id: r['error'] = "Cannot transfer to your own account"; continue
+        r.update(amount=amount, account_id=target[0], user_id=target[1])
+        valid.append(r)
+    return valid
+
+@ledger.retry_on_conflict
+def _post_chunk(request, sender, chunk):
+    # Every row counts against the velocity limits, as a single transfer would
+    user = request.user
+    broken = velocity.reserve_many(request, [(r['amount'], r['account_number']) for r in chunk])
+    refused = {chunk[i]['row']: velocity.message(rule) for i, rule in broken.items()}
+    chunk = [r for r in chunk if r['row'] not in refused]
+
+    receivers = User.objects.select_related('account').in_bulk({r['user_id'] for r in chunk})
+    txns = [Transaction(sender=user, receiver=receivers[r['user_id']], amount=r['amount'], transaction_type='transfer', status='processing' if _held(r) else 'success',
+                        receiver_account_number=r['account_number'], note=r['note'] or "Batch Transfer") for r in chunk]
+    # bulk_create skips Transaction.save(), which normally fills the search text
+    for t in txns: t.search_document = t.build_search_document()
+    txns = Transaction.objects.bulk_create(txns)
+    # Held rows only leave the sender; settlement credits their receivers later
+    ledger.post_batch([([(sender.pk, -r['amount'])] + ([] if _held(r) else [(r['account_id'], r['amount'])]), f"Batch transfer TRX-{t.pk}", t) for r, t in zip(chunk, txns)])
+    # bulk_create skips the Transaction signals, so keep the rollups current here
+    rollups.apply(t.tracked_state() for t in txns)
+    paid = [r for r in chunk if not _held(r)]
+    notifications.bulk_create([Notification(user_id=r['user_id'], message=f"Credit Alert: Received ${r['amount']} from {user.username}.") for r in paid])
+    for r in paid:
+        emails.queue_transaction_alert(receivers[r['user_id']], r['amount'], "Incoming Transfer", "Successful")
+    return list(zip(chunk, txns)), refused
+
+def run_batch(request, rows):
+    """Validates and posts a parsed batch for request.user. Returns (rows with status/reference/error, summary dict)."""
+    user = request.user
+    sender = Account.objects.get(user=user)
+    valid = _validate(user, rows)
+    total = sum((r['amount'] for r in valid), Decimal('0.00'))
+    if total > sender.balance:
+        raise BatchError(f"Insufficient Funds. Batch total ${total:,.2f}, balance ${sender.balance:,.2f}")
+
+    posted = Decimal('0.00')
+    for i in range(0, len(valid), CHUNK_SIZE):
+        chunk = valid[i:i + CHUNK_SIZE]
+        try:
+            booked, refused = _post_chunk(request, sender, chunk)
+        except ledger.InsufficientFunds:
+            # Balance moved underneath us (another session spent it): later chunks fail too
+            for r in valid[i:]: r['error'] = "Insufficient funds"
+            break
+        for r in chunk: r['error'] = refused.get(r['row'], '')
+        for r, t in booked:
+            r.update(status=t.status, reference=f"#{str(t.pk).zfill(8)}")
+            posted += r['amount']
+
+    succeeded = sum(1 for r in rows if r['status'] == 'success')
+    held = sum(1 for r in rows if r['status'] == 'processing')
+    if succeeded or held:
+        emails.send_transaction_alert(user, posted, 'Batch Transfer', 'Success' if not held else 'Processing')
+    return rows, {'total': len(rows), 'succeeded': succeeded, 'held': held, 'failed': len(rows) - succeeded - held, 'amount': posted}
+
+def results_csv(rows):
+    out = io.StringIO()
+    writer = csv.DictWriter(out, fieldnames=RESULT_FIELDS, extrasaction='ignore')
+    writer.writeheader()
+    writer.writerows(rows)
+    return out.getvalue()
@@ -0,0 +1,111 @@
+"""
+Month-close balance checkpoints for statements.
+
+A checkpoint stores a user's statement running balance (everything received minus
+everything sent) at the close of a month. The opening balance of any month is then
+the latest earlier checkpoint plus the transactions dated after it, instead of a sum
+over the whole account history.
+"""
+from datetime import date, datetime
+from decimal import Decimal
+
+from django.db.models import F, Q, Sum
+from django.utils import timezone
+
+from .models import ArchivedTransaction, BalanceCheckpoint, Transaction
+
+ZERO = Decimal('0.00')
+
+
+def month_start(value):
+    """First day of the month containing a date/datetime (in the active timezone)."""
+    if isinstance(value, datetime):
+        value = timezone.localtime(value) if timezone.is_aware(value) else value
+    return date(value.year, value.month, 1)
+
+def next_month(month):
+    return date(month.year + month.month // 12, month.month % 12 + 1, 1)
+
+def month_bounds(month):
+    """Aware [start, end) datetimes for a month given as a date."""
+    return (timezone.make_aware(datetime(month.year, month.month, 1)),
+            timezone.make_aware(datetime.combine(next_month(month), datetime.min.time())))
+
+def previous_month(month):
+    return date(month.year - (month.month == 1), (month.month - 2) % 12 + 1, 1)
+
+def last_closed_month(today=None):
+    return previous_month(month_start(today or timezone.now()))
+
+
+def statement_totals(user, start=None, end=None):
+    """(money_in, money_out) for a user between two datetimes, in one query."""
+    txns = Transaction.objects.filter(Q(sender=user) | Q(receiver=user))
+    if start: txns = txns.filter(date__gte=start)
+    if end: txns = txns.filter(date__lt=end)
+    totals = txns.aggregate(i=Sum('amount', filter=Q(receiver=user)), o=Sum('amount', filter=Q(sender=user)))
+    return totals['i'] or ZERO, totals['o'] or ZERO
+
+def opening_balance(user, month):
+    """Statement balance at the start of `month`: one indexed lookup plus a bounded delta."""
+    checkpoint = BalanceCheckpoint.objects.filter(user=user, month__lt=month).order_by('-month').values('month', 'balance').first()
+    start = month_bounds(checkpoint['month'])[1] if checkpoint else None
+    money_in, money_out = statement_totals(user, start, month_bounds(month)[0])
+    return (checkpoint['balance'] if checkpoint else ZERO) + money_in - money_out
+
+
+def net_by_user(txns, users=None):
+    """{user_id: received - sent} over a transaction queryset, optionally only for some user ids."""
+    received, sent = txns.filter(receiver__isnull=False), txns.filter(sender__isnull=False)
+    if users is not None: received, sent = received.filter(receiver_id__in=users), sent.filter(sender_id__in=users)
+    net = {}
+    for user_id, total in received.values_list('receiver_id').annotate(Sum('amount')).order_by():
+        net[user_id] = net.get(user_id, ZERO) + total
+    for user_id, total in sent.values_list('sender_id').annotate(Sum('amount')).order_by():
+        net[user_id] = net.get(user_id, ZERO) - total
+    return net
+
+def close_month(month):
+    """Writes (or rewrites) every user's checkpoint for a closed month. Returns rows written."""
+    if month > last_closed_month():
+        raise ValueError(f"{month:%Y-%m} has not closed yet.")
+    start, end = month_bounds(month)
+    if ArchivedTransaction.objects.filter(date__gte=start).exists():
+        raise ValueError(f"{month:%Y-%m} is archived; its checkpoints are final.")
+    balances = dict(BalanceCheckpoint.objects.filter(month=previous_month(month)).values_list('user_id', 'balance'))
+
+    if not balances:
+        # Nothing to build on: start from the full history once
+        balances = net_by_user(Transaction.objects.filter(date__lt=end))
+    else:
+        activity = net_by_user(Transaction.objects.filter(date__gte=start, date__lt=end))
+        # Users without a previous checkpoint carry their whole past in
+        newcomers = set(activity) - set(balances)
+        past = net_by_user(Transaction.objects.filter(Q(sender_id__in=newcomers) | Q(receiver_id__in=newcomers), date__lt=start)) if newcomers else {}
+        for user_id, net in activity.items():
+            balances[user_id] = balances.get(user_id, ZERO) + net + (past.get(user_id, ZERO) if user_id in newcomers else ZERO)
+
+    rows = [BalanceCheckpoint(user_id=user_id, month=month, balance=balance) for user_id, balance in balances.items()]
+    BalanceCheckpoint.objects.bulk_create(rows, batch_size=1000, update_conflicts=True, unique_fields=['user', 'month'], update_fields=['balance', 'updated_at'])
+    return len(rows)
+
+
+STATEMENT_FIELDS = ('sender_id', 'receiver_id', 'amount', 'date')
+
+def _shift(user_id, when, delta):
+    # Only closed months carry checkpoints, so current-month activity costs nothing here
+    month = month_start(when)
+    if user_id and delta and month <= last_closed_month():
+        BalanceCheckpoint.objects.filter(user_id=user_id, month__gte=month).update(balance=F('balance') + delta)
+
+def record_change(before, after):
+    """Adjusts checkpoints for a transaction that was inserted, edited or deleted.
+
+    before/after are Transaction.tracked_state() dicts; None means the row did not exist.
+    """
+    if before and after and all(before[f] == after[f] for f in STATEMENT_FIELDS): return
+    for fields, sign in ((before, -1), (after, 1)):
+        if not fields: continue
+        amount = Decimal(fields['amount']) * sign
+        _shift(fields['receiver_id'], fields['date'], amount)
+        _shift(fields['sender_id'], fields['date'], -amount)
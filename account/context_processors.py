@@ -1,11 +1,20 @@
-from .models import Notification
+import uuid
+
+from django.utils.functional import SimpleLazyObject
+
+from . import notifications
 
 def global_notifications(request):
+    # One cached summary per user (account.notifications), read only if the page renders the dropdown
     if request.user.is_authenticated:
-        notifications = Notification.objects.filter(user=request.user).order_by('-date')
-        unread_count = notifications.filter(is_read=False).count()
+        summary = SimpleLazyObject(lambda: notifications.summary(request.user.pk))
         return {
-            'notifications': notifications,
-            'unread_count': unread_count
+            'notifications': SimpleLazyObject(lambda: summary['latest']),
+            'unread_count': SimpleLazyObject(lambda: summary['unread']),
+            'notifications_more': SimpleLazyObject(lambda: summary['more']),
         }
-    return {}
\ No newline at end of file
+    return {}
+
+def idempotency(request):
+    # Fresh key per rendered form; a double submit of the same form reuses it (see account.idempotency)
+    return {'idempotency_key': uuid.uuid4().hex}
@@ -0,0 +1,167 @@
+"""
+Premium email engine: OTP codes and transaction receipts.
+
+send_* functions hand each email to its own thread right away (request paths that
+already committed). queue_* functions wait for the surrounding database transaction
+to commit and then hand the email to a single outbox worker thread, so batch jobs
+never mail about work that rolled back and never spawn a thread per email.
+"""
+import queue
+import random
+import threading
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.mail import EmailMultiAlternatives
+from django.db import transaction
+from django.utils import timezone
+from django.utils.html import strip_tags
+
+
+class EmailThread(threading.Thread):
+    def __init__(self, subject, html_content, recipient_list):
+        self.subject = subject
+        self.recipient_list = recipient_list
+        self.html_content = html_content
+        threading.Thread.__init__(self)
+
+    def run(self):
+        try:
+            msg = EmailMultiAlternatives(self.subject, strip_tags(self.html_content), settings.EMAIL_HOST_USER, self.recipient_list)
+            msg.attach_alternative(self.html_content, "text/html")
+            msg.send()
+        except Exception as e:
+            print(f"Email Sending Failed: {e}")
+
+def get_email_style():
+    """Returns the CSS styles for premium emails."""
+    return """
+    <style>
+        body { font-family: 'Helvetica Neue', Helvetica, Arial, sans-serif; background-color: #f4f6f8; margin: 0; padding: 0; }
+        .container { max-width: 600px; margin: 40px auto; background: #ffffff; border-radius: 16px; overflow: hidden; box-shadow: 0 4px 20px rgba(0,0,0,0.05); }
+        .header { background: #004d99; padding: 30px; text-align: center; }
+        .header h1 { color: #ffffff; margin: 0; font-size: 24px; letter-spacing: 2px; font-weight: 700; }
+        .content { padding: 40px; }
+        .amount-box { text-align: center; margin-bottom: 30px; padding: 20px; background: #f8fafc; border-radius: 12px; border: 1px solid #e2e8f0; }
+        .label { font-size: 12px; text-transform: uppercase; color: #64748b; letter-spacing: 1px; margin-bottom: 5px; font-weight: 600; }
+        .amount { font-size: 38px; font-weight: 800; color: #1a1a1a; letter-spacing: -1px; margin: 0; }
+        .code-box { background: #eff6ff; border: 1px solid #dbeafe; border-radius: 8px; padding: 20px; text-align: center; margin: 30px 0; }
+        .code-val { font-size: 36px; font-weight: bold; color: #004d99; letter-spacing: 5px; display: block; }
+        .status-badge { display: inline-block; padding: 6px 14px; border-radius: 20px; font-size: 12px; font-weight: 700; text-transform: uppercase; margin-top: 15px; }
+        .status-success { background: #dcfce7; color: #166534; }
+        .status-processing { background: #fef9c3; color: #854d0e; }
+        .details-table { width: 100%; border-collapse: collapse; margin-top: 20px; }
+        .details-table td { padding: 12px 0; border-bottom: 1px solid #f1f5f9; color: #334155; font-size: 14px; }
+        .details-table td:last-child { text-align: right; font-weight: 600; color: #1a1a1a; }
+        .footer { background: #f8fafc; padding: 25px; text-align: center; border-top: 1px solid #e2e8f0; color: #94a3b8; font-size: 12px; line-height: 1.6; }
+    </style>
+    """
+
+def send_premium_otp(user, otp, action="verify your identity"):
+    """Sends a secure, branded OTP email with Rate Limiting."""
+    
+    # 1. RATE LIMIT CHECK (Max 1 email per 2 minutes per user)
+    cache_key = f"email_limit_{user.id}"
+    if cache.get(cache_key):
+        print(f"⚠️ Email blocked for {user.email} (Rate Limit Exceeded)")
+        return # STOP HERE. Save the quota.
+
+    # 2. SEND EMAIL
+    subject = f'{otp} is your Veltris verification code'
+    html_content = f"""
+    <!DOCTYPE html><html><head>{get_email_style()}</head><body>
+    <div class="container">
+        <div class="header"><h1>VELTRIS BANK</h1></div>
+        <div class="content">
+            <h2 style="color:#1a1a1a;margin-top:0;text-align:center;">Verification Required</h2>
+            <p style="color:#666;font-size:15px;line-height:1.6;text-align:center;">
+                Hello <strong>{user.first_name or user.username}</strong>,<br><br>
+                You requested to <strong>{action}</strong>. Please use the secure code below to complete this action.
+            </p>
+            <div class="code-box">
+                <span class="label" style="color:#64748b;display:block;margin-bottom:10px;">Security Code</span>
+                <span class="code-val">{otp}</span>
+            </div>
+            <p style="color:#999;font-size:13px;text-align:center;">This code expires in 10 minutes. Do not share it with anyone.</p>
+        </div>
+        <div class="footer">&copy; 2025 Veltris Technologies Inc.<br>Secure Banking System</div>
+    </div></body></html>
+    """
+    EmailThread(subject, html_content, [user.email]).start()
+
+    # 3. SET LOCK (Prevent sending again for 120 seconds)
+    cache.set(cache_key, True, 120)
+
+def transaction_alert_email(user, amount, type, status):
+    """Builds (subject, html) for a transaction receipt, or None if the user opted out."""
+    if not hasattr(user, 'account') or not user.account.email_alerts: 
+        return None
+    
+    formatted_amount = "{:,.2f}".format(float(amount))
+    status_color = "success" if status.lower() in ['success', 'successful'] else "processing"
+    
+    subject = f'Transaction Alert: {type.title()}'
+    html_content = f"""
+    <!DOCTYPE html><html><head>{get_email_style()}</head><body>
+    <div class="container">
+        <div class="header"><h1>VELTRIS BANK</h1></div>
+        <div class="content">
+            <div class="amount-box">
+                <div class="label">Transaction Amount</div>
+                <div class="amount">${formatted_amount}</div>
+                <div class="status-badge status-{status_color}">{status.upper()}</div>
+            </div>
+            <p style="color:#666;font-size:14px;line-height:1.6;">
+                <strong>Transaction Type:</strong> {type.title()}<br>
+                <strong>Date:</strong> {timezone.now().strftime('%b %d, %Y - %I:%M %p')}<br>
+                <strong>Account:</strong> Checking •••• {user.account.account_number[-4:]}<br>
+                <strong>Reference:</strong> #TRX-{random.randint(100000,999999)}
+            </p>
+            <table class="details-table">
+                <tr><td>Status</td><td>{status}</td></tr>
+                <tr><td>Merchant/Recipient</td><td>Veltris Processing</td></tr>
+            </table>
+        </div>
+        <div class="footer">
+            &copy; 2025 Veltris Technologies Inc.<br>
+            If you did not authorize this transaction, please contact support immediately.
+        </div>
+    </div></body></html>
+    """
+    return subject, html_content
+
+def send_transaction_alert(user, amount, type, status):
+    """Sends a digital receipt email for transactions."""
+    email = transaction_alert_email(user, amount, type, status)
+    if email: EmailThread(email[0], email[1], [user.email]).start()
+
+def queue_transaction_alert(user, amount, type, status):
+    """Like send_transaction_alert, but only once the current DB transaction commits."""
+    email = transaction_alert_email(user, amount, type, status)
+    if email: queue_email(email[0], email[1], [user.email])
+
+
+# --- OUTBOX (one worker thread, fed after commit) ---
+_outbox = queue.Queue()
+_outbox_lock = threading.Lock()
+_outbox_worker = None
+
+def _drain_outbox():
+    while True:
+        subject, html_content, recipient_list = _outbox.get()
+        try: EmailThread(subject, html_content, recipient_list).run() # run() inline: this is already the worker thread
+        finally: _outbox.task_done()
+
+def queue_email(subject, html_content, recipient_list):
+    def enqueue():
+        global _outbox_worker
+        with _outbox_lock:
+            if _outbox_worker is None or not _outbox_worker.is_alive():
+                _outbox_worker = threading.Thread(target=_drain_outbox, name='email-outbox', daemon=True)
+                _outbox_worker.start()
+        _outbox.put((subject, html_content, recipient_list))
+    transaction.on_commit(enqueue)
+
+def flush_outbox():
+    """Blocks until every queued email has been handed to the mail backend (for batch commands)."""
+    _outbox.join()
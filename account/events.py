@@ -0,0 +1,165 @@
+"""
+Push channel for support chat and the ops queue (server-sent events).
+
+Instead of polling every few seconds, customers and operators hold one SSE stream open
+(account.views.support_stream and admin_stream, served by core/asgi.py). Saving a
+SupportMessage or SupportSession publishes a hint on commit. Events are hints, not
+payloads: a stream that wakes up reads what changed in one query. An idle stream
+sends a keepalive comment every HEARTBEAT seconds and queries nothing.
+
+Subscribers are asyncio queues in this process. The broker setting decides how hints
+reach them (settings.EVENTS_BROKER):
+  - 'local': only subscribers in this process, which is enough for a single worker.
+  - 'cache': hints also go through the shared cache. Each published hint claims the
+    next sequence number with cache.add. Each worker process runs one relay task
+    that reads new hints every RELAY_INTERVAL seconds with one get_many, shared by
+    all of that worker's subscribers and skipped when it has none. This stands in
+    for a real broker (e.g. Redis pub/sub) behind the same publish()/subscribe().
+    The head (the highest claimed number) only moves forward: publishers raise it
+    under a short cache.add lock. It may briefly trail the newest hint, so a relay
+    reads hints by number and only takes a head below its position for a restart
+    once its own last hint is gone too.
+
+Clients that still poll the queue revalidate it with queue_version(), an opaque token in
+the shared cache. queue_changed() replaces the token whenever the queue may have changed,
+so a poll of an unchanged queue gets 304 from one cache read. The token also expires
+after QUEUE_VERSION_TTL. That bounds how stale the parts of a queue row that change
+without a hint can get, such as the blocked badge or the avatar.
+"""
+import asyncio
+import json
+import threading
+import time
+import uuid
+import weakref
+from contextlib import asynccontextmanager
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+
+HEARTBEAT = 25 # Seconds between keepalive comments on an idle stream
+RETRY_MS = 3000 # Client reconnect delay
+QUEUE = 'support:queue'
+RELAY_INTERVAL = 1.0
+RELAY_TTL = 120
+RELAY_BATCH = 100
+HEAD_KEY = 'events:head'
+HEAD_LOCK_KEY = 'events:head:lock'
+HEAD_LOCK_TTL = 5 # Seconds: outlives any head update, frees the lock of a crashed publisher
+HEAD_LOCK_TRIES = 5
+QUEUE_VERSION_KEY = 'support:queue:version'
+QUEUE_VERSION_TTL = 60
+ORIGIN = uuid.uuid4().hex # This process, so the relay skips hints it already delivered
+
+_subscribers = {} # channel -> {(loop, queue)}
+_lock = threading.Lock()
+_relays = weakref.WeakSet() # Event loops running a relay task
+_relay_tasks = set() # Strong references: the loop only keeps weak ones
+
+
+def broker():
+    return getattr(settings, 'EVENTS_BROKER', 'local')
+
+def user_channel(user_id):
+    return f"support:user:{user_id}"
+
+def frame(event, data, id=None):
+    """One SSE frame."""
+    return (f"id: {id}\n" if id is not None else '') + f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+def comment(text):
+    return f": {text}\n\n"
+
+
+def _dispatch(channel, data):
+    with _lock: targets = list(_subscribers.get(channel, ()))
+    for loop, queue in targets:
+        try: loop.call_soon_threadsafe(queue.put_nowait, (channel, data))
+        except RuntimeError: pass # Loop already closed; its subscriber is on its way out
+
+def publish(channel, data=None):
+    """Wakes every subscriber of channel: in this process, and in the others with the cache broker."""
+    _dispatch(channel, data)
+    if broker() == 'cache': _relay_out(channel, data)
+
+def publish_on_commit(channel, data=None):
+    transaction.on_commit(lambda: publish(channel, data))
+
+def queue_version():
+    """Opaque token that changes whenever the ops queue may have changed."""
+    version = cache.get(QUEUE_VERSION_KEY)
+    if version is None:
+        cache.add(QUEUE_VERSION_KEY, uuid.uuid4().hex, QUEUE_VERSION_TTL)
+        version = cache.get(QUEUE_VERSION_KEY)
+    return version
+
+def queue_changed(session_id):
+    """Once the transaction commits: a new queue version, and a hint to the queue streams."""
+    def changed():
+        cache.delete(QUEUE_VERSION_KEY)
+        publish(QUEUE, session_id)
+    transaction.on_commit(changed)
+
+
+def _relay_out(channel, data):
+    seq = (cache.get(HEAD_KEY) or 0) + 1
+    while not cache.add(f"events:{seq}", (ORIGIN, channel, data), RELAY_TTL): seq += 1
+    _advance_head(seq)
+
+def _advance_head(seq):
+    # A publisher that claimed an earlier number can get here after one that claimed a later
+    # one, so compare with the stored head under the lock instead of overwriting it
+    for attempt in range(HEAD_LOCK_TRIES):
+        if cache.add(HEAD_LOCK_KEY, ORIGIN, HEAD_LOCK_TTL):
+            try:
+                if (cache.get(HEAD_KEY) or 0) < seq: cache.set(HEAD_KEY, seq, None)
+            finally:
+                cache.delete(HEAD_LOCK_KEY)
+            return
+        time.sleep(0.002 * (attempt + 1))
+    # Still contended: the head trails seq until the next publisher raises it past
+
+def _relay_in(last):
+    """(new last sequence number, [(origin, channel, data)]) of the hints published after `last`."""
+    if last is None: return cache.get(HEAD_KEY) or 0, []
+    keys = [f"events:{n}" for n in range(last + 1, last + 1 + RELAY_BATCH)]
+    values = cache.get_many([HEAD_KEY, f"events:{last}"] + keys)
+    head = values.get(HEAD_KEY, 0)
+    if head < last and f"events:{last}" not in values: return head, [] # The sequence restarted (cache emptied)
+    present = [key for key in keys if key in values]
+    if not present: return last, []
+    return int(present[-1].rsplit(':', 1)[1]), [values[key] for key in present]
+
+async def _relay():
+    last = None
+    while True:
+        await asyncio.sleep(RELAY_INTERVAL)
+        with _lock: listening = bool(_subscribers)
+        if not listening:
+            last = None # Pick up from the head again once someone subscribes
+            continue
+        last, hints = await sync_to_async(_relay_in, thread_sensitive=False)(last)
+        for origin, channel, data in hints:
+            if origin != ORIGIN: _dispatch(channel, data)
+
+@asynccontextmanager
+async def subscribe(*channels):
+    """An asyncio.Queue receiving (channel, data) for every hint published on channels."""
+    loop, queue = asyncio.get_running_loop(), asyncio.Queue()
+    entry = (loop, queue)
+    with _lock:
+        for channel in channels: _subscribers.setdefault(channel, set()).add(entry)
+        if broker() == 'cache' and loop not in _relays:
+            _relays.add(loop)
+            task = loop.create_task(_relay())
+            _relay_tasks.add(task)
+            task.add_done_callback(_relay_tasks.discard)
+    try:
+        yield queue
+    finally:
+        with _lock:
+            for channel in channels:
+                _subscribers[channel].discard(entry)
+                if not _subscribers[channel]: del _subscribers[channel]
@@ -0,0 +1,104 @@
+"""
+Transaction history exports (CSV, OFX, QIF).
+
+Each writer is a generator of text chunks fed to a StreamingHttpResponse: the header
+goes out before the first query and rows follow as queries.iter_history() reads them,
+so memory stays flat however many years are exported. CSV carries every status;
+OFX and QIF are for bookkeeping imports and only carry settled (success) rows.
+"""
+import csv
+from datetime import datetime
+
+from django.utils import timezone
+
+from .queries import iter_history
+
+FORMATS = {
+    'csv': ('text/csv', 'csv'),
+    'ofx': ('application/x-ofx', 'ofx'),
+    'qif': ('application/qif', 'qif'),
+}
+BUFFER_SIZE = 64 * 1024
+
+
+def describe(txn, user):
+    """(counterparty, memo) for one row, worded like the history page."""
+    if txn.receiver_id == user.id:
+        party = f"{txn.sender.first_name} {txn.sender.last_name}".strip() if txn.sender else "Cash Deposit"
+    elif txn.receiver:
+        party = f"{txn.receiver.first_name} {txn.receiver.last_name}".strip()
+    else:
+        party = txn.receiver_bank_name or "External Payment"
+    return party or txn.note or "Transaction", txn.note or ''
+
+def signed_amount(txn, user):
+    return txn.amount if txn.receiver_id == user.id else -txn.amount
+
+def reference(txn):
+    return f"#{str(txn.id).zfill(8)}"
+
+
+class _Echo:
+    # csv.writer target that hands each formatted line straight back
+    def write(self, value): return value
+
+def export_csv(user, queryset, side=None, start=None):
+    writer = csv.writer(_Echo())
+    yield writer.writerow(['Date', 'Reference', 'Type', 'Counterparty', 'Memo', 'Amount', 'Status'])
+    for t in iter_history(user, queryset, side, start):
+        party, memo = describe(t, user)
+        yield writer.writerow([timezone.localtime(t.date).strftime('%Y-%m-%d %H:%M'), reference(t), t.get_transaction_type_display(),
+                               party, memo, f"{signed_amount(t, user):.2f}", t.status])
+
+
+def _ofx_date(value):
+    return timezone.localtime(value).strftime('%Y%m%d%H%M%S') if isinstance(value, datetime) else value.strftime('%Y%m%d')
+
+def _ofx_text(value):
+    return value.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')[:32]
+
+def export_ofx(user, queryset, side=None, start=None):
+    now = timezone.now()
+    account = user.account
+    yield ('<?xml version="1.0" encoding="UTF-8"?>\n<?OFX OFXHEADER="200" VERSION="220" SECURITY="NONE" OLDFILEUID="NONE" NEWFILEUID="NONE"?>\n'
+           f"<OFX><SIGNONMSGSRSV1><SONRS><STATUS><CODE>0</CODE><SEVERITY>INFO</SEVERITY></STATUS><DTSERVER>{_ofx_date(now)}</DTSERVER>"
+           "<LANGUAGE>ENG</LANGUAGE></SONRS></SIGNONMSGSRSV1>\n<BANKMSGSRSV1><STMTTRNRS><TRNUID>0</TRNUID>"
+           "<STATUS><CODE>0</CODE><SEVERITY>INFO</SEVERITY></STATUS>\n"
+           f"<STMTRS><CURDEF>USD</CURDEF><BANKACCTFROM><BANKID>VELTRIS</BANKID><ACCTID>{account.account_number}</ACCTID>"
+           f"<ACCTTYPE>CHECKING</ACCTTYPE></BANKACCTFROM>\n<BANKTRANLIST><DTSTART>{_ofx_date(start or user.date_joined)}</DTSTART><DTEND>{_ofx_date(now)}</DTEND>\n")
+    for t in iter_history(user, queryset, side, start, status='success'):
+        party, memo = describe(t, user)
+        amount = signed_amount(t, user)
+        yield (f"<STMTTRN><TRNTYPE>{'CREDIT' if amount > 0 else 'DEBIT'}</TRNTYPE><DTPOSTED>{_ofx_date(t.date)}</DTPOSTED>"
+               f"<TRNAMT>{amount:.2f}</TRNAMT><FITID>{t.id}</FITID><NAME>{_ofx_text(party)}</NAME>"
+               + (f"<MEMO>{_ofx_text(memo)}</MEMO>" if memo else '') + "</STMTTRN>\n")
+    yield (f"</BANKTRANLIST><LEDGERBAL><BALAMT>{account.balance:.2f}</BALAMT><DTASOF>{_ofx_date(now)}</DTASOF></LEDGERBAL>"
+           "</STMTRS></STMTTRNRS></BANKMSGSRSV1></OFX>\n")
+
+
+def export_qif(user, queryset, side=None, start=None):
+    yield "!Type:Bank\n"
+    for t in iter_history(user, queryset, side, start, status='success'):
+        party, memo = describe(t, user)
+        yield (f"D{timezone.localtime(t.date):%m/%d/%Y}\nT{signed_amount(t, user):.2f}\nN{reference(t)}\nP{party}\n"
+               + (f"M{memo}\n" if memo else '') + "^\n")
+
+
+def _buffered(parts, size=BUFFER_SIZE):
+    # The header goes out at once; rows are grouped into ~64KB writes instead of one per row
+    yield next(parts, '')
+    buffer, length = [], 0
+    for part in parts:
+        buffer.append(part)
+        length += len(part)
+        if length >= size:
+            yield ''.join(buffer)
+            buffer, length = [], 0
+    if buffer: yield ''.join(buffer)
+
+def export(fmt, user, queryset, side=None, start=None):
+    """Text chunk generator for one of FORMATS."""
+    if fmt == 'ofx': parts = export_ofx(user, queryset, side, start)
+    elif fmt == 'qif': parts = export_qif(user, queryset, side, start)
+    else: parts = export_csv(user, queryset, side, start)
+    return _buffered(parts)
@@ -0,0 +1,89 @@
+"""
+Idempotency keys for money-moving POSTs.
+
+Forms carry a one-time key (hidden `idempotency_key` field from the context
+processor, or an `Idempotency-Key` header on AJAX calls). The first request with a
+key takes a short cache lock, runs the view and stores its response for
+IDEMPOTENCY_TTL seconds; repeats get that stored response back without running the
+view again, and a duplicate that arrives while the first is still running waits for
+its result instead of posting a second time.
+"""
+import functools
+import hashlib
+import time
+
+from django.conf import settings
+from django.contrib import messages
+from django.core.cache import cache
+from django.http import HttpResponse, JsonResponse
+from django.shortcuts import redirect
+
+TTL = getattr(settings, 'IDEMPOTENCY_TTL', 24 * 60 * 60)
+LOCK_TIMEOUT = 60 # Longer than any money view should take; a crashed worker frees the key after this
+WAIT = 10 # How long a duplicate waits for the original before giving up
+POLL = 0.05
+IGNORED_FIELDS = {'csrfmiddlewaretoken', 'idempotency_key'}
+
+
+def request_key(request):
+    return request.headers.get('Idempotency-Key') or request.POST.get('idempotency_key')
+
+def _fingerprint(request):
+    # Same key + different payload is a client bug, not a retry
+    items = sorted((k, v) for k, values in request.POST.lists() if k not in IGNORED_FIELDS for v in values)
+    items += sorted((k, f.name, f.size) for k, f in request.FILES.items())
+    return hashlib.sha256(repr((request.path, items)).encode()).hexdigest()
+
+def _freeze(response):
+    return {'status': response.status_code, 'content': response.content,
+            'headers': [(k, v) for k, v in response.items() if k.lower() not in ('set-cookie', 'vary')]}
+
+def _replay(stored):
+    response = HttpResponse(stored['content'], status=stored['status'])
+    for name, value in stored['headers']: response[name] = value
+    response['Idempotent-Replayed'] = 'true'
+    return response
+
+def _conflict(request, message):
+    if request.headers.get('x-requested-with') == 'XMLHttpRequest':
+        return JsonResponse({'status': 'error', 'message': message}, status=409)
+    messages.error(request, message)
+    return redirect(request.path)
+
+def idempotent(view):
+    """Collapses repeated POSTs carrying the same idempotency key into one execution."""
+    @functools.wraps(view)
+    def wrapper(request, *args, **kwargs):
+        key = request_key(request) if request.method == 'POST' else None
+        if not key or not request.user.is_authenticated:
+            return view(request, *args, **kwargs)
+
+        base = f"idem:{request.user.pk}:{hashlib.sha256(key.encode()).hexdigest()}"
+        fingerprint = _fingerprint(request)
+        deadline = time.monotonic() + WAIT
+        while not cache.add(f"{base}:lock", fingerprint, LOCK_TIMEOUT):
+            # Someone holds the key: either it is finished (replay) or still running (wait)
+            stored = cache.get(base)
+            if stored: break
+            if time.monotonic() > deadline:
+                return _conflict(request, "This request is already being processed.")
+            time.sleep(POLL)
+        else:
+            stored = cache.get(base) # Lock expired after the original finished
+            if not stored:
+                try:
+                    response = view(request, *args, **kwargs)
+                except Exception:
+                    cache.delete(f"{base}:lock")
+                    raise
+                if response.status_code < 500 and not response.streaming:
+                    cache.set(base, {'fingerprint': fingerprint, **_freeze(response)}, TTL)
+                    cache.set(f"{base}:lock", fingerprint, TTL) # Keep the key claimed for as long as the result lives
+                else:
+                    cache.delete(f"{base}:lock") # Let the client retry a server error
+                return response
+
+        if stored['fingerprint'] != fingerprint:
+            return _conflict(request, "This idempotency key was already used for a different request.")
+        return _replay(stored)
+    return wrapper
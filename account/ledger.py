@@ -0,0 +1,156 @@
+"""
+Double-entry ledger engine.
+
+Every money movement goes through post(): it locks the touched Account rows in
+primary-key order (so two postings can never wait on each other in opposite
+order), checks funds against the locked values, moves Account.balance with F()
+expressions and appends balanced LedgerEntry rows. Deadlocks and lock timeouts
+are retried with a short jittered backoff.
+"""
+import functools
+import random
+import time
+import uuid
+from decimal import Decimal
+
+from django.db import OperationalError, connection, transaction
+from django.db.models import Case, DecimalField, F, Value, When
+
+from .models import Account, LedgerEntry
+
+MAX_ATTEMPTS = 10
+UPDATE_CHUNK = 500
+RETRYABLE_ERRORS = ('deadlock', 'could not serialize', 'lock timeout', 'database is locked', 'database table is locked')
+
+
+class LedgerError(Exception):
+    pass
+
+class InsufficientFunds(LedgerError):
+    def __init__(self, account_id, balance, amount):
+        self.account_id, self.balance, self.amount = account_id, balance, amount
+        super().__init__(f"Account {account_id} has ${balance:,.2f}, cannot debit ${amount:,.2f}")
+
+
+def _is_retryable(exc):
+    message = str(exc).lower()
+    return any(marker in message for marker in RETRYABLE_ERRORS)
+
+def retry_on_conflict(func):
+    """Runs func inside transaction.atomic(), retrying on deadlock/lock errors.
+
+    Inside an outer atomic block a retry is impossible (the outer transaction is already
+    aborted), so the error is re-raised for whoever owns that block.
+    """
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if connection.in_atomic_block:
+            with transaction.atomic():
+                return func(*args, **kwargs)
+        for attempt in range(1, MAX_ATTEMPTS + 1):
+            try:
+                with transaction.atomic():
+                    return func(*args, **kwargs)
+            except OperationalError as exc:
+                if attempt == MAX_ATTEMPTS or not _is_retryable(exc): raise
+                time.sleep(random.uniform(0, min(0.5, 0.005 * 2 ** attempt)))
+    return wrapper
+
+
+def _account_id(account):
+    return account.pk if isinstance(account, Account) else account
+
+def _normalize(deltas):
+    merged = {}
+    for account, amount in deltas:
+        key = _account_id(account)
+        if key is None: continue # The clearing side is implied
+        merged[key] = merged.get(key, Decimal('0.00')) + Decimal(amount)
+    return {pk: amount for pk, amount in merged.items() if amount}
+
+@retry_on_conflict
+def _post(postings, allow_overdraft):
+    # Net movement per account across every posting in the call
+    deltas = _normalize((pk, amount) for posting, _, _ in postings for pk, amount in posting.items())
+    ids = sorted(deltas)
+
+    # 1. Lock rows in a fixed order
+    locked = dict(Account.objects.select_for_update().filter(pk__in=ids).order_by('pk').values_list('pk', 'balance'))
+    if len(locked) != len(ids):
+        raise LedgerError(f"Unknown account(s): {sorted(set(ids) - set(locked))}")
+
+    # 2. Funds check against the locked values
+    if not allow_overdraft:
+        for pk in ids:
+            if deltas[pk] < 0 and locked[pk] + deltas[pk] < 0:
+                raise InsufficientFunds(pk, locked[pk], -deltas[pk])
+
+    # 3. Move the projection (one UPDATE per chunk of accounts)
+    for i in range(0, len(ids), UPDATE_CHUNK):
+        chunk = ids[i:i + UPDATE_CHUNK]
+        if len(chunk) == 1:
+            expression = F('balance') + deltas[chunk[0]]
+        else:
+            expression = Case(*[When(pk=pk, then=F('balance') + Value(deltas[pk])) for pk in chunk], output_field=DecimalField(max_digits=12, decimal_places=2))
+        Account.objects.filter(pk__in=chunk).update(balance=expression)
+
+    # 4. Journal, one balanced posting per item (the clearing side takes the remainder)
+    entries = []
+    for posting, memo, txn in postings:
+        posting_id = uuid.uuid4()
+        entries += [LedgerEntry(posting_id=posting_id, account_id=pk, txn=txn, amount=amount, memo=memo) for pk, amount in posting.items()]
+        clearing = -sum(posting.values(), Decimal('0.00'))
+        if clearing:
+            entries.append(LedgerEntry(posting_id=posting_id, account_id=None, txn=txn, amount=clearing, memo=memo))
+    LedgerEntry.objects.bulk_create(entries, batch_size=1000)
+    return {pk: locked[pk] + deltas[pk] for pk in ids}
+
+def post(deltas, memo='', txn=None, allow_overdraft=False):
+    """Posts signed balance changes atomically.
+
+    deltas is an iterable of (account or account id, signed amount) pairs; amounts for the
+    same account are merged. Whatever does not net to zero is booked against the clearing
+    side. Returns {account_id: new_balance}.
+    """
+    return post_batch([(deltas, memo, txn)], allow_overdraft)
+
+def post_batch(postings, allow_overdraft=False):
+    """Posts many (deltas, memo, txn) items in one transaction.
+
+    Accounts are locked once, the funds check runs on each account's net movement and
+    balances move in one grouped UPDATE per chunk, while every item keeps its own
+    posting_id and journal lines. Returns {account_id: new_balance}.
+    """
+    postings = [(_normalize(deltas), memo, txn) for deltas, memo, txn in postings]
+    postings = [item for item in postings if item[0]]
+    if not postings: return {}
+    return _post(postings, allow_overdraft)
+
+def posted(memos):
+    """Ids among {txn id: memo} whose transaction already has a journal line with that memo.
+
+    Lets callers that pay a transaction's receiver (settlement, approvals) book each credit once.
+    """
+    memos = {pk: memo for pk, memo in memos.items() if memo}
+    if not memos: return set()
+    found = LedgerEntry.objects.filter(txn_id__in=memos, memo__in=set(memos.values())).values_list('txn_id', 'memo').distinct()
+    return {pk for pk, memo in found if memos[pk] == memo}
+
+def _sync(balances, *accounts):
+    # Keep passed-in instances in step with the rows we just wrote
+    for account in accounts:
+        if isinstance(account, Account) and account.pk in balances:
+            account.balance = balances[account.pk]
+    return balances
+
+def transfer(from_account, to_account, amount, memo='', txn=None):
+    """Moves money between two customer accounts."""
+    return _sync(post([(from_account, -amount), (to_account, amount)], memo, txn), from_account, to_account)
+
+def debit(account, amount, memo='', txn=None):
+    """Takes money out of an account towards the clearing side (wires, bills, repayments)."""
+    return _sync(post([(account, -amount)], memo, txn), account)
+
+def credit(account, amount, memo='', txn=None):
+    """Brings money into an account from the clearing side (deposits, loans, incoming wires)."""
+    return _sync(post([(account, amount)], memo, txn), account)
@@ -0,0 +1,122 @@
+"""
+Loan pricing, amortization schedules and loan-book projections.
+
+A loan is priced from its term (APR_BY_TERM) as a fixed monthly payment. At approval
+schedule() writes its installments once as LoanInstallment rows: a due date plus the
+principal and interest for each month, rounded to cents, with the last installment
+clearing whatever rounding left over. total_repayment is the schedule's sum. Repayments
+are allocated oldest installment first, interest before principal (allocate()). The
+loans page and the ops forecast read those rows; nothing recomputes a schedule later.
+
+project() forecasts the whole book's scheduled cash flows per month in one query and
+one NumPy pass over every open installment (amounts handled as integer cents).
+"""
+import calendar
+from datetime import date
+from decimal import ROUND_HALF_UP, Decimal
+
+import numpy as np
+from django.db.models import F
+from django.db.models.functions import ExtractMonth, ExtractYear
+from django.utils import timezone
+
+from .models import LoanInstallment
+
+APR_BY_TERM = {12: Decimal('0.059'), 24: Decimal('0.065'), 36: Decimal('0.072')}
+PROJECTION_MONTHS = 12
+CENT = Decimal('0.01')
+ZERO = Decimal('0.00')
+
+
+def apr_for(term_months):
+    """APR offered for a term: that of the shortest published term covering it."""
+    return next((APR_BY_TERM[term] for term in sorted(APR_BY_TERM) if term_months <= term), APR_BY_TERM[max(APR_BY_TERM)])
+
+def add_months(day, months):
+    month = day.month - 1 + months
+    year, month = day.year + month // 12, month % 12 + 1
+    return date(year, month, min(day.day, calendar.monthrange(year, month)[1]))
+
+def monthly_payment(principal, apr, term_months):
+    rate = apr / 12
+    if not rate: return (principal / term_months).quantize(CENT, ROUND_HALF_UP)
+    return (principal * rate / (1 - (1 + rate) ** -term_months)).quantize(CENT, ROUND_HALF_UP)
+
+def amortize(principal, apr, term_months):
+    """[(principal, interest)] per month of a fixed-payment loan."""
+    rate, payment, balance, rows = apr / 12, monthly_payment(principal, apr, term_months), principal, []
+    for number in range(1, term_months + 1):
+        interest = (balance * rate).quantize(CENT, ROUND_HALF_UP)
+        part = balance if number == term_months else min(payment - interest, balance)
+        balance -= part
+        rows.append((part, interest))
+    return rows
+
+def quote(principal, term_months):
+    """(apr, monthly payment, total repayment) offered for an application."""
+    apr = apr_for(term_months)
+    return apr, monthly_payment(principal, apr, term_months), principal + sum((i for _, i in amortize(principal, apr, term_months)), ZERO)
+
+
+def schedule(loan, approved_at=None):
+    """Prices an approving loan and returns its (unsaved) installments; the caller saves both.
+
+    Installments fall due monthly from one month after approval.
+    """
+    loan.approved_at = approved_at or timezone.now()
+    if loan.apr is None: loan.apr = apr_for(loan.term_months)
+    first_due = add_months(timezone.localdate(loan.approved_at), 1)
+    rows = amortize(loan.amount, loan.apr, loan.term_months)
+    loan.total_repayment = loan.amount + sum((interest for _, interest in rows), ZERO)
+    return [LoanInstallment(loan=loan, number=n, due_date=add_months(first_due, n - 1), principal=p, interest=i)
+            for n, (p, i) in enumerate(rows, 1)]
+
+def allocate(loan, amount, paid_at=None):
+    """Applies a repayment to the loan's open installments, oldest first and interest before principal.
+
+    Call with the loan row locked. Returns (interest, principal) covered by `amount`.
+    """
+    paid_at = paid_at or timezone.now()
+    left, covered, touched = amount, [ZERO, ZERO], []
+    for row in loan.installments.filter(paid_at__isnull=True).order_by('number'):
+        if not left: break
+        for slot, (due, paid) in enumerate((('interest', 'interest_paid'), ('principal', 'principal_paid'))):
+            take = min(left, getattr(row, due) - getattr(row, paid))
+            setattr(row, paid, getattr(row, paid) + take)
+            covered[slot] += take
+            left -= take
+        if not row.amount_due: row.paid_at = paid_at
+        touched.append(row)
+    LoanInstallment.objects.bulk_update(touched, ['interest_paid', 'principal_paid', 'paid_at'])
+    return tuple(covered)
+
+
+def project(months=PROJECTION_MONTHS, start=None, installments=None):
+    """Scheduled cash flows of the active loan book for `months` months from `start` (default: this month).
+
+    Returns a dict of per-month lists ('months', 'principal', 'interest', 'outstanding' after
+    that month's payments) plus 'overdue' principal/interest already past due before `start`.
+    """
+    start = (start or timezone.localdate()).replace(day=1)
+    rows = (installments if installments is not None else LoanInstallment.objects).filter(loan__status='approved', paid_at__isnull=True).annotate(
+        due_year=ExtractYear('due_date'), due_month=ExtractMonth('due_date'),
+        principal_due=F('principal') - F('principal_paid'), interest_due=F('interest') - F('interest_paid'),
+    ).order_by().values_list('due_year', 'due_month', 'principal_due', 'interest_due')
+    data = np.array(list(rows), dtype=np.float64).reshape(-1, 4)
+
+    offset = (data[:, 0] * 12 + data[:, 1] - (start.year * 12 + start.month)).astype(np.int64)
+    principal, interest = np.rint(data[:, 2] * 100).astype(np.int64), np.rint(data[:, 3] * 100).astype(np.int64)
+    past, window = offset < 0, (offset >= 0) & (offset < months)
+    by_month = lambda cents: np.bincount(offset[window], weights=cents[window], minlength=months).astype(np.int64)
+    principal_by_month, interest_by_month = by_month(principal), by_month(interest)
+    # Overdue principal is still owed: it stays in the outstanding balance until it is collected
+    outstanding = principal.sum() - np.cumsum(principal_by_month)
+
+    dollars = lambda cents: [(Decimal(int(c)) / 100).quantize(CENT) for c in cents]
+    return {
+        'months': [add_months(start, i) for i in range(months)],
+        'principal': dollars(principal_by_month),
+        'interest': dollars(interest_by_month),
+        'outstanding': dollars(outstanding),
+        'overdue': {'principal': dollars([principal[past].sum()])[0], 'interest': dollars([interest[past].sum()])[0]},
+    }
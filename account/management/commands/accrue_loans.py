@@ -0,0 +1,27 @@
+import time
+from datetime import date
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from account import accrual, emails
+
+
+class Command(BaseCommand):
+    help = "Accrues daily interest and updates days past due on active loans. Idempotent per business date; safe to rerun or run as parallel workers."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--date', help="Business date (YYYY-MM-DD). Defaults to today.")
+        parser.add_argument('--chunk-size', type=int, default=accrual.CHUNK_SIZE)
+
+    def handle(self, *args, **options):
+        try: business_date = date.fromisoformat(options['date']) if options['date'] else timezone.localdate()
+        except ValueError: raise CommandError("--date must be YYYY-MM-DD.")
+
+        started, loans, interest = time.perf_counter(), 0, 0
+        for count, accrued in accrual.run(business_date, options['chunk_size']):
+            loans += count
+            interest += accrued
+            self.stdout.write(f"  {loans} loans accrued")
+        emails.flush_outbox()
+        self.stdout.write(f"{business_date}: accrued ${interest:,.4f} on {loans} loans in {time.perf_counter() - started:.2f}s")
@@ -0,0 +1,35 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from account import approvals, emails
+from account.models import Loan, Transaction
+
+
+class Command(BaseCommand):
+    help = "Approves queued transactions or loans in bulk (the same engine as the admin approve actions)."
+
+    def add_arguments(self, parser):
+        parser.add_argument('kind', choices=['transactions', 'loans'])
+        parser.add_argument('--ids', help="Comma-separated primary keys to approve.")
+        parser.add_argument('--type', dest='transaction_type', help="Only transactions of this type (e.g. deposit).")
+        parser.add_argument('--status', help="Only rows currently in this status (default: pending).", default='pending')
+        parser.add_argument('--all', action='store_true', help="Approve every row in --status without narrowing further.")
+        parser.add_argument('--batch-size', type=int, default=approvals.BATCH_SIZE)
+
+    def handle(self, *args, **options):
+        if not (options['ids'] or options['transaction_type'] or options['all']):
+            raise CommandError("Choose what to approve with --ids, --type or --all.")
+        model = Transaction if options['kind'] == 'transactions' else Loan
+        queryset = model.objects.filter(status=options['status'])
+        if options['ids']:
+            queryset = queryset.filter(pk__in=[int(pk) for pk in options['ids'].split(',') if pk.strip()])
+        if options['transaction_type']:
+            if model is Loan: raise CommandError("--type only applies to transactions.")
+            queryset = queryset.filter(transaction_type=options['transaction_type'])
+
+        started = time.perf_counter()
+        if model is Loan: approved = approvals.approve_loans(queryset, options['batch_size'])
+        else: approved = approvals.approve_transactions(queryset, options['batch_size'])
+        emails.flush_outbox()
+        self.stdout.write(f"Approved {approved} {options['kind']} in {time.perf_counter() - started:.2f}s")
@@ -0,0 +1,36 @@
+from datetime import datetime
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from account import checkpoints
+from account.models import Transaction
+
+
+class Command(BaseCommand):
+    help = "Writes month-close balance checkpoints used for statement opening balances. Run after each month ends."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--month', help="Month to close as YYYY-MM (default: the last closed month).")
+        parser.add_argument('--backfill', action='store_true', help="Close every month from the first transaction up to --month.")
+
+    def handle(self, *args, **options):
+        if options['month']:
+            try: target = datetime.strptime(options['month'], '%Y-%m').date()
+            except ValueError: raise CommandError("--month must look like 2025-11")
+        else:
+            target = checkpoints.last_closed_month()
+
+        month = target
+        if options['backfill']:
+            first = Transaction.objects.order_by('date').values_list('date', flat=True).first()
+            month = checkpoints.month_start(first) if first else target
+
+        while month <= target:
+            try:
+                with transaction.atomic():
+                    written = checkpoints.close_month(month)
+            except ValueError as exc:
+                raise CommandError(str(exc))
+            self.stdout.write(f"{month:%Y-%m}: {written} checkpoints")
+            month = checkpoints.next_month(month)
@@ -0,0 +1,68 @@
+import multiprocessing
+import time
+from datetime import datetime
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+
+from account import checkpoints, statements
+
+
+def _generate(args):
+    # Pool entry point; each forked worker opens its own DB connection on first use
+    return statements.generate_chunk(*args)
+
+
+class Command(BaseCommand):
+    help = ("Pre-renders and stores every account's statement for a closed month (run after close_month). "
+            "Already stored statements are skipped, so an interrupted run can simply be started again.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--month', help="Last month to generate as YYYY-MM (default: the last closed month).")
+        parser.add_argument('--since', help="Generate every month from this one (YYYY-MM) up to --month.")
+        parser.add_argument('--workers', type=int, default=multiprocessing.cpu_count(), help="Worker processes (1 = run in this process).")
+        parser.add_argument('--chunk-size', type=int, default=statements.CHUNK_SIZE, help="Users per chunk.")
+        parser.add_argument('--force', action='store_true', help="Re-render statements that are already stored.")
+
+    def parse_month(self, value, option):
+        try: return datetime.strptime(value, '%Y-%m').date()
+        except ValueError: raise CommandError(f"--{option} must look like 2025-11")
+
+    def handle(self, *args, **options):
+        target = self.parse_month(options['month'], 'month') if options['month'] else checkpoints.last_closed_month()
+        if target > checkpoints.last_closed_month():
+            raise CommandError(f"{target:%Y-%m} has not closed yet.")
+        month = self.parse_month(options['since'], 'since') if options['since'] else target
+
+        while month <= target:
+            self.generate(month, options)
+            month = checkpoints.next_month(month)
+
+    def generate(self, month, options):
+        chunks = statements.user_chunks(month, options['chunk_size'])
+        tasks = [(month, first_id, last_id, options['force']) for first_id, last_id in chunks]
+        started = time.perf_counter()
+        stored = skipped = 0
+
+        if options['workers'] > 1 and len(tasks) > 1:
+            # Forked children must not share the parent's open connections
+            connections.close_all()
+            with multiprocessing.get_context('fork').Pool(options['workers']) as pool:
+                results = list(self.progress(month, pool.imap_unordered(_generate, tasks), len(tasks), started))
+        else:
+            results = list(self.progress(month, map(_generate, tasks), len(tasks), started))
+        for chunk_stored, chunk_skipped in results:
+            stored += chunk_stored
+            skipped += chunk_skipped
+
+        elapsed = time.perf_counter() - started
+        self.stdout.write(self.style.SUCCESS(
+            f"{month:%Y-%m}: stored {stored} statements, {skipped} already done, in {elapsed:.1f}s ({stored / elapsed if elapsed else 0:,.0f}/s)"))
+
+    def progress(self, month, results, total, started):
+        stored = 0
+        for done, result in enumerate(results, 1):
+            stored += result[0]
+            elapsed = time.perf_counter() - started
+            self.stdout.write(f"{month:%Y-%m}: chunk {done}/{total}, {stored} stored ({stored / elapsed if elapsed else 0:,.0f}/s)")
+            yield result
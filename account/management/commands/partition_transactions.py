@@ -0,0 +1,32 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from account import archive, partitions
+
+
+class Command(BaseCommand):
+    help = ("Creates upcoming monthly Transaction partitions (Postgres) and, with --archive-years, moves months "
+            "older than that into the transaction archive. Run daily or at least monthly.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--ahead', type=int, default=partitions.PARTITIONS_AHEAD, help="Months of partitions to keep created in advance.")
+        parser.add_argument('--archive-years', type=int, default=getattr(settings, 'TRANSACTION_ARCHIVE_YEARS', None),
+                            help="Archive whole months older than this many years (default: TRANSACTION_ARCHIVE_YEARS; unset = no archiving).")
+
+    def handle(self, *args, **options):
+        if partitions.is_partitioned():
+            created = partitions.ensure(options['ahead'])
+            self.stdout.write(f"Created {len(created)} partitions" + (f": {', '.join(f'{m:%Y-%m}' for m in created)}" if created else '') + ".")
+        else:
+            self.stdout.write("Transaction table is not partitioned on this database; skipping partition upkeep.")
+
+        if options['archive_years'] is None: return
+        if options['archive_years'] < 1: raise CommandError("--archive-years must be at least 1.")
+        total = 0
+        try:
+            for month, moved in archive.archive_before(archive.horizon(options['archive_years'])):
+                total += moved
+                self.stdout.write(f"{month:%Y-%m}: archived {moved} transactions")
+        except archive.ArchiveError as exc:
+            raise CommandError(str(exc))
+        self.stdout.write(self.style.SUCCESS(f"Archived {total} transactions."))
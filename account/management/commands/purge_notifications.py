@@ -0,0 +1,22 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from account import notifications
+
+
+class Command(BaseCommand):
+    help = "Deletes notifications past their retention TTL or their user's cap, in short batches. Safe to rerun."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--read-days', type=int, default=notifications.READ_TTL_DAYS, help="Keep read notifications this many days.")
+        parser.add_argument('--unread-days', type=int, default=notifications.UNREAD_TTL_DAYS, help="Keep unread notifications this many days.")
+        parser.add_argument('--max-per-user', type=int, default=notifications.MAX_PER_USER, help="Keep at most this many per user (newest first).")
+        parser.add_argument('--batch-size', type=int, default=notifications.PURGE_BATCH)
+
+    def handle(self, *args, **options):
+        started, total = time.perf_counter(), 0
+        for deleted in notifications.purge(options['read_days'], options['unread_days'], options['max_per_user'], options['batch_size']):
+            total += deleted
+            self.stdout.write(f"  {total} notifications deleted")
+        self.stdout.write(f"Purged {total} notifications in {time.perf_counter() - started:.2f}s")
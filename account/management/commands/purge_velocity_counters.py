@@ -0,0 +1,10 @@
+from django.core.management.base import BaseCommand
+
+from account import velocity
+
+
+class Command(BaseCommand):
+    help = "Deletes velocity counters whose windows have passed. Safe to rerun."
+
+    def handle(self, *args, **options):
+        self.stdout.write(f"Purged {velocity.purge()} velocity counters")
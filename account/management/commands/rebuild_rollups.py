@@ -0,0 +1,16 @@
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+
+from account import rollups
+
+
+class Command(BaseCommand):
+    help = "Rebuilds the per-user monthly transaction rollups from the Transaction table (backfill or repair)."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--user', action='append', dest='usernames', help="Only rebuild these usernames (repeatable).")
+
+    def handle(self, *args, **options):
+        users = User.objects.filter(username__in=options['usernames']) if options['usernames'] else None
+        written = rollups.rebuild(users)
+        self.stdout.write(self.style.SUCCESS(f"Rebuilt {written} rollup rows."))
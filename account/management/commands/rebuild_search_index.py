@@ -0,0 +1,16 @@
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+
+from account import search
+
+
+class Command(BaseCommand):
+    help = "Recomputes the transaction search text (backfill, or after customers' names change)."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--user', action='append', dest='usernames', help="Only reindex these usernames' transactions (repeatable).")
+
+    def handle(self, *args, **options):
+        users = User.objects.filter(username__in=options['usernames']) if options['usernames'] else None
+        written = search.reindex(users)
+        self.stdout.write(self.style.SUCCESS(f"Updated {written} transaction search documents."))
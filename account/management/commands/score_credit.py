@@ -0,0 +1,20 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from account import scoring
+
+
+class Command(BaseCommand):
+    help = "Recomputes credit scores. Only users with activity since the last run are rescored unless --full."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--full', action='store_true', help="Rescore every account.")
+        parser.add_argument('--chunk-size', type=int, default=scoring.CHUNK_SIZE, help="Users per chunk.")
+
+    def handle(self, *args, **options):
+        started, total = time.perf_counter(), 0
+        for scored in scoring.score_users(options['full'], options['chunk_size']):
+            total += scored
+            self.stdout.write(f"  {total} users scored")
+        self.stdout.write(f"Scored {total} users in {time.perf_counter() - started:.2f}s")
@@ -0,0 +1,25 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from account import emails, settlement
+
+
+class Command(BaseCommand):
+    help = "Settles due 'processing' transfers and wires. Safe to run as several parallel workers."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=settlement.BATCH_SIZE)
+        parser.add_argument('--loop', action='store_true', help="Keep running as a daemon instead of exiting when idle.")
+        parser.add_argument('--interval', type=float, default=30, help="Seconds to sleep between idle passes with --loop.")
+
+    def handle(self, *args, **options):
+        while True:
+            started = time.perf_counter()
+            settled = settlement.settle_due(options['batch_size'])
+            if settled:
+                elapsed = time.perf_counter() - started
+                self.stdout.write(f"Settled {settled} transactions in {elapsed:.2f}s")
+            emails.flush_outbox()
+            if not options['loop']: return
+            time.sleep(options['interval'])
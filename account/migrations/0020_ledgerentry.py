@@ -0,0 +1,44 @@
+# Generated by Django 5.0.2 on 2026-10-18 09:07
+
+import uuid
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+def open_balances(apps, schema_editor):
+    # Existing balances become one opening posting per account so the journal reconciles
+    Account = apps.get_model('account', 'Account')
+    LedgerEntry = apps.get_model('account', 'LedgerEntry')
+    entries = []
+    for pk, balance in Account.objects.exclude(balance=0).values_list('pk', 'balance').iterator():
+        posting_id = uuid.uuid4()
+        entries.append(LedgerEntry(posting_id=posting_id, account_id=pk, amount=balance, memo='Opening balance'))
+        entries.append(LedgerEntry(posting_id=posting_id, account_id=None, amount=-balance, memo='Opening balance'))
+    LedgerEntry.objects.bulk_create(entries, batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('account', '0019_alter_transaction_transaction_type'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LedgerEntry',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('posting_id', models.UUIDField(db_index=True)),
+                ('amount', models.DecimalField(decimal_places=2, max_digits=12)),
+                ('memo', models.CharField(blank=True, max_length=255)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('account', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.PROTECT, related_name='ledger_entries', to='account.account')),
+                ('txn', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='ledger_entries', to='account.transaction')),
+            ],
+            options={
+                'verbose_name_plural': 'ledger entries',
+            },
+        ),
+        migrations.RunPython(open_balances, migrations.RunPython.noop),
+    ]
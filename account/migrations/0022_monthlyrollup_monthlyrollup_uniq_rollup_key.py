@@ -0,0 +1,51 @@
+# Generated by Django 5.0.2 on 2026-10-18 09:11
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Count, Sum
+from django.db.models.functions import TruncMonth
+from django.utils import timezone
+
+
+def backfill_rollups(apps, schema_editor):
+    Transaction = apps.get_model('account', 'Transaction')
+    MonthlyRollup = apps.get_model('account', 'MonthlyRollup')
+    rows = []
+    for direction, field in (('in', 'receiver'), ('out', 'sender')):
+        grouped = (Transaction.objects.filter(status='success', **{f"{field}__isnull": False})
+                   .annotate(month=TruncMonth('date')).values(f"{field}_id", 'month', 'transaction_type')
+                   .annotate(n=Count('id'), s=Sum('amount')).order_by())
+        for g in grouped:
+            month = timezone.localtime(g['month']) if timezone.is_aware(g['month']) else g['month']
+            rows.append(MonthlyRollup(user_id=g[f"{field}_id"], month=month.date().replace(day=1), direction=direction,
+                                      transaction_type=g['transaction_type'], count=g['n'], total=g['s']))
+    MonthlyRollup.objects.bulk_create(rows, batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('account', '0021_balancecheckpoint_and_more'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MonthlyRollup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('month', models.DateField()),
+                ('direction', models.CharField(choices=[('in', 'Money In'), ('out', 'Money Out')], max_length=3)),
+                ('transaction_type', models.CharField(choices=[('deposit', 'Deposit'), ('withdrawal', 'Withdrawal'), ('transfer', 'Transfer'), ('wire', 'Wire Transfer'), ('payment', 'Bill Payment'), ('loan', 'Loan Credit'), ('repayment', 'Loan Repayment'), ('refund', 'Refund / Reversal')], max_length=20)),
+                ('count', models.IntegerField(default=0)),
+                ('total', models.DecimalField(decimal_places=2, default=0.0, max_digits=14)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='monthly_rollups', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='monthlyrollup',
+            constraint=models.UniqueConstraint(fields=('user', 'month', 'direction', 'transaction_type'), name='uniq_rollup_key'),
+        ),
+        migrations.RunPython(backfill_rollups, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,43 @@
+# Generated by Django 5.0.2 on 2026-10-18 09:13
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+def create_date_index(apps, schema_editor):
+    # BRIN suits an append-mostly, date-correlated table on Postgres; SQLite has no BRIN
+    if schema_editor.connection.vendor == 'postgresql':
+        schema_editor.execute("CREATE INDEX IF NOT EXISTS txn_date_brin ON account_transaction USING brin (date)")
+    else:
+        schema_editor.execute("CREATE INDEX IF NOT EXISTS txn_date_brin ON account_transaction (date)")
+
+def drop_date_index(apps, schema_editor):
+    schema_editor.execute("DROP INDEX IF EXISTS txn_date_brin")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('account', '0022_monthlyrollup_monthlyrollup_uniq_rollup_key'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='transaction',
+            index=models.Index(fields=['sender', '-date', '-id'], name='txn_sender_date_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='transaction',
+            index=models.Index(fields=['receiver', '-date', '-id'], name='txn_receiver_date_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='transaction',
+            index=models.Index(condition=models.Q(('status', 'processing')), fields=['date'], name='txn_processing_due_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='transaction',
+            index=models.Index(fields=['status', 'transaction_type', '-date'], name='txn_admin_filter_idx'),
+        ),
+        migrations.RunPython(create_date_index, drop_date_index),
+    ]
@@ -0,0 +1,73 @@
+# Generated by Django 5.0.2 on 2026-10-18 09:33
+
+from django.db import migrations, models
+
+# SQLite: external-content FTS5 table kept in step by triggers. Any later migration that makes
+# Django rebuild account_transaction on SQLite drops these triggers and has to re-create them.
+SQLITE_FTS = [
+    "CREATE VIRTUAL TABLE IF NOT EXISTS account_transaction_fts USING fts5(search_document, content='account_transaction', content_rowid='id')",
+    """CREATE TRIGGER IF NOT EXISTS account_transaction_fts_ai AFTER INSERT ON account_transaction BEGIN
+           INSERT INTO account_transaction_fts(rowid, search_document) VALUES (new.id, new.search_document);
+       END""",
+    """CREATE TRIGGER IF NOT EXISTS account_transaction_fts_ad AFTER DELETE ON account_transaction BEGIN
+           INSERT INTO account_transaction_fts(account_transaction_fts, rowid, search_document) VALUES ('delete', old.id, old.search_document);
+       END""",
+    """CREATE TRIGGER IF NOT EXISTS account_transaction_fts_au AFTER UPDATE OF search_document ON account_transaction BEGIN
+           INSERT INTO account_transaction_fts(account_transaction_fts, rowid, search_document) VALUES ('delete', old.id, old.search_document);
+           INSERT INTO account_transaction_fts(rowid, search_document) VALUES (new.id, new.search_document);
+       END""",
+    "INSERT INTO account_transaction_fts(account_transaction_fts) VALUES ('rebuild')",
+]
+
+
+def backfill_search_documents(apps, schema_editor):
+    # Same text as Transaction.build_search_document()
+    Transaction = apps.get_model('account', 'Transaction')
+    batch = []
+    for t in Transaction.objects.select_related('sender', 'receiver').only(
+            'note', 'receiver_bank_name', 'transaction_type', 'sender__first_name', 'sender__last_name', 'sender__username',
+            'receiver__first_name', 'receiver__last_name', 'receiver__username').iterator(chunk_size=2000):
+        words = [t.note, t.receiver_bank_name, t.transaction_type]
+        for user in (t.sender, t.receiver):
+            if user: words += [user.first_name, user.last_name, user.username]
+        t.search_document = ' '.join([w.lower() for w in words if w] + [f"party{pk}" for pk in (t.sender_id, t.receiver_id) if pk])
+        batch.append(t)
+        if len(batch) == 2000:
+            Transaction.objects.bulk_update(batch, ['search_document'])
+            batch = []
+    Transaction.objects.bulk_update(batch, ['search_document'])
+
+def create_search_index(apps, schema_editor):
+    if schema_editor.connection.vendor == 'postgresql':
+        # Built from the same expression account.search filters on, so the planner can match it
+        from django.contrib.postgres.indexes import GinIndex
+        from django.contrib.postgres.search import SearchVector
+        schema_editor.add_index(apps.get_model('account', 'Transaction'), GinIndex(SearchVector('search_document', config='simple'), name='txn_search_gin'))
+    elif schema_editor.connection.vendor == 'sqlite':
+        for statement in SQLITE_FTS:
+            schema_editor.execute(statement)
+
+def drop_search_index(apps, schema_editor):
+    if schema_editor.connection.vendor == 'postgresql':
+        schema_editor.execute("DROP INDEX IF EXISTS txn_search_gin")
+    elif schema_editor.connection.vendor == 'sqlite':
+        for name in ('ai', 'ad', 'au'):
+            schema_editor.execute(f"DROP TRIGGER IF EXISTS account_transaction_fts_{name}")
+        schema_editor.execute("DROP TABLE IF EXISTS account_transaction_fts")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('account', '0023_transaction_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='transaction',
+            name='search_document',
+            field=models.TextField(blank=True, default='', editable=False),
+        ),
+        migrations.RunPython(backfill_search_documents, migrations.RunPython.noop),
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 5.0.2 on 2026-10-18 09:42
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('account', '0024_transaction_search_document'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StatementArtifact',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('month', models.DateField()),
+                ('html_etag', models.CharField(max_length=64)),
+                ('pdf_etag', models.CharField(max_length=64)),
+                ('rendered_at', models.DateTimeField(auto_now=True)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='statement_artifacts', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='statementartifact',
+            constraint=models.UniqueConstraint(fields=('user', 'month'), name='uniq_statement_user_month'),
+        ),
+    ]
@@ -0,0 +1,107 @@
+# Generated by Django 5.0.2 on 2026-10-18 09:48
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+# Postgres only: account_transaction becomes a table range-partitioned by month on `date`
+# (account_transaction_pYYYY_MM plus a DEFAULT partition). The primary key has to include
+# the partition key, so it becomes (id, date); ids still come from one sequence and stay
+# unique. Secondary indexes and foreign keys are re-created on the parent, which cascades
+# them to every partition. Later partitions come from `partition_transactions`.
+PARENT = 'account_transaction'
+PARTITIONS_AHEAD = 3
+
+
+def _month_starts(cursor):
+    from datetime import date
+    from django.utils import timezone
+    cursor.execute(f"SELECT min(date) FROM {PARENT}_unpartitioned")
+    first = cursor.fetchone()[0]
+    today = timezone.localdate()
+    month = date(*(timezone.localtime(first).timetuple()[:2] if first else (today.year, today.month)), 1)
+    last = date(today.year + (today.month + PARTITIONS_AHEAD - 1) // 12, (today.month + PARTITIONS_AHEAD - 1) % 12 + 1, 1)
+    while month <= last:
+        following = date(month.year + month.month // 12, month.month % 12 + 1, 1)
+        yield month, following
+        month = following
+
+def _rebuild(schema_editor, partitioned):
+    from datetime import datetime
+    from django.utils import timezone
+    bound = lambda day: timezone.make_aware(datetime(day.year, day.month, 1)).isoformat()
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute("SELECT indexdef FROM pg_indexes WHERE tablename = %s AND indexname <> %s", [PARENT, f"{PARENT}_pkey"])
+        indexes = [row[0] for row in cursor.fetchall()]
+        cursor.execute("SELECT conname, pg_get_constraintdef(oid) FROM pg_constraint WHERE conrelid = %s::regclass AND contype IN ('f', 'c')", [PARENT])
+        constraints = cursor.fetchall()
+        cursor.execute("SELECT coalesce(max(id), 0) + 1 FROM " + PARENT)
+        next_id = cursor.fetchone()[0]
+
+        cursor.execute(f"ALTER TABLE {PARENT} RENAME TO {PARENT}_unpartitioned")
+        cursor.execute(f"ALTER TABLE {PARENT}_unpartitioned RENAME CONSTRAINT {PARENT}_pkey TO {PARENT}_old_pkey")
+        # Detach the id generator (identity or sequence default) so LIKE does not copy a reference to it
+        cursor.execute(f"ALTER TABLE {PARENT}_unpartitioned ALTER COLUMN id DROP IDENTITY IF EXISTS")
+        cursor.execute(f"ALTER TABLE {PARENT}_unpartitioned ALTER COLUMN id DROP DEFAULT")
+        if partitioned:
+            cursor.execute(f"CREATE TABLE {PARENT} (LIKE {PARENT}_unpartitioned INCLUDING DEFAULTS) PARTITION BY RANGE (date)")
+            cursor.execute(f"ALTER TABLE {PARENT} ADD CONSTRAINT {PARENT}_pkey PRIMARY KEY (id, date)")
+            for start, end in _month_starts(cursor):
+                cursor.execute(f"CREATE TABLE {PARENT}_p{start:%Y_%m} PARTITION OF {PARENT} FOR VALUES FROM (%s) TO (%s)", [bound(start), bound(end)])
+            cursor.execute(f"CREATE TABLE {PARENT}_default PARTITION OF {PARENT} DEFAULT")
+        else:
+            cursor.execute(f"CREATE TABLE {PARENT} (LIKE {PARENT}_unpartitioned INCLUDING DEFAULTS)")
+            cursor.execute(f"ALTER TABLE {PARENT} ADD CONSTRAINT {PARENT}_pkey PRIMARY KEY (id)")
+        cursor.execute(f"INSERT INTO {PARENT} SELECT * FROM {PARENT}_unpartitioned")
+        cursor.execute(f"DROP TABLE {PARENT}_unpartitioned CASCADE")
+
+        for definition in indexes:
+            cursor.execute(definition)
+        for name, definition in constraints:
+            cursor.execute(f"ALTER TABLE {PARENT} ADD CONSTRAINT {schema_editor.quote_name(name)} {definition}")
+        cursor.execute(f"CREATE SEQUENCE {PARENT}_id_seq OWNED BY {PARENT}.id START WITH %s", [next_id])
+        cursor.execute(f"ALTER TABLE {PARENT} ALTER COLUMN id SET DEFAULT nextval('{PARENT}_id_seq')")
+
+def partition_transactions(apps, schema_editor):
+    if schema_editor.connection.vendor == 'postgresql':
+        _rebuild(schema_editor, partitioned=True)
+
+def unpartition_transactions(apps, schema_editor):
+    if schema_editor.connection.vendor == 'postgresql':
+        _rebuild(schema_editor, partitioned=False)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('account', '0025_statementartifact'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='ledgerentry',
+            name='txn',
+            field=models.ForeignKey(blank=True, db_constraint=False, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='ledger_entries', to='account.transaction'),
+        ),
+        migrations.CreateModel(
+            name='ArchivedTransaction',
+            fields=[
+                ('id', models.BigIntegerField(primary_key=True, serialize=False)),
+                ('amount', models.DecimalField(decimal_places=2, max_digits=12)),
+                ('transaction_type', models.CharField(choices=[('deposit', 'Deposit'), ('withdrawal', 'Withdrawal'), ('transfer', 'Transfer'), ('wire', 'Wire Transfer'), ('payment', 'Bill Payment'), ('loan', 'Loan Credit'), ('repayment', 'Loan Repayment'), ('refund', 'Refund / Reversal')], max_length=20)),
+                ('status', models.CharField(choices=[('success', 'Success'), ('pending', 'Pending'), ('failed', 'Failed'), ('processing', 'Processing')], max_length=20)),
+                ('date', models.DateTimeField()),
+                ('rejection_reason', models.CharField(blank=True, max_length=255, null=True)),
+                ('receiver_account_number', models.CharField(blank=True, max_length=100, null=True)),
+                ('receiver_bank_name', models.CharField(blank=True, max_length=100, null=True)),
+                ('note', models.CharField(blank=True, max_length=100, null=True)),
+                ('receiver', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.DO_NOTHING, related_name='+', to=settings.AUTH_USER_MODEL)),
+                ('sender', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.DO_NOTHING, related_name='+', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['sender', '-date', '-id'], name='archive_sender_date_idx'), models.Index(fields=['receiver', '-date', '-id'], name='archive_receiver_date_idx'), models.Index(fields=['date'], name='archive_date_idx')],
+            },
+        ),
+        migrations.RunPython(partition_transactions, unpartition_transactions),
+    ]
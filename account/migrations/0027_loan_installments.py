@@ -0,0 +1,80 @@
+# Generated by Django 5.0.2 on 2026-10-18 10:02
+
+import calendar
+from datetime import date
+from decimal import Decimal
+
+import django.db.models.deletion
+from django.db import migrations, models
+from django.utils import timezone
+
+
+def _add_months(day, months):
+    month = day.month - 1 + months
+    year, month = day.year + month // 12, month % 12 + 1
+    return date(year, month, min(day.day, calendar.monthrange(year, month)[1]))
+
+def _split(total, parts):
+    # Equal cents per part, the last one taking the remainder
+    each = (total / parts).quantize(Decimal('0.01'))
+    return [each] * (parts - 1) + [total - each * (parts - 1)]
+
+def schedule_active_loans(apps, schema_editor):
+    # Loans approved before schedules existed were priced at a flat 5%: spread what they owe
+    # evenly over the term from their application month and apply what was already repaid
+    Loan, LoanInstallment = apps.get_model('account', 'Loan'), apps.get_model('account', 'LoanInstallment')
+    rows, now = [], timezone.now()
+    for loan in Loan.objects.filter(status='approved').iterator(chunk_size=2000):
+        term = max(loan.term_months, 1)
+        paid, first_due = loan.amount_paid, _add_months(loan.date_applied.date(), 1)
+        for n, (principal, interest) in enumerate(zip(_split(loan.amount, term), _split(loan.total_repayment - loan.amount, term)), 1):
+            interest_paid = min(paid, interest)
+            principal_paid = min(paid - interest_paid, principal)
+            paid -= interest_paid + principal_paid
+            rows.append(LoanInstallment(loan=loan, number=n, due_date=_add_months(first_due, n - 1), principal=principal, interest=interest,
+                                        principal_paid=principal_paid, interest_paid=interest_paid,
+                                        paid_at=now if interest_paid + principal_paid == principal + interest else None))
+    LoanInstallment.objects.bulk_create(rows, batch_size=2000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('account', '0026_transaction_partitions_archive'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='loan',
+            name='approved_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='loan',
+            name='apr',
+            field=models.DecimalField(blank=True, decimal_places=4, max_digits=5, null=True),
+        ),
+        migrations.CreateModel(
+            name='LoanInstallment',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('number', models.PositiveSmallIntegerField()),
+                ('due_date', models.DateField()),
+                ('principal', models.DecimalField(decimal_places=2, max_digits=12)),
+                ('interest', models.DecimalField(decimal_places=2, max_digits=12)),
+                ('principal_paid', models.DecimalField(decimal_places=2, default=0, max_digits=12)),
+                ('interest_paid', models.DecimalField(decimal_places=2, default=0, max_digits=12)),
+                ('paid_at', models.DateTimeField(blank=True, null=True)),
+                ('loan', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='installments', to='account.loan')),
+            ],
+            options={
+                'ordering': ['loan', 'number'],
+                'indexes': [models.Index(condition=models.Q(('paid_at__isnull', True)), fields=['due_date'], name='installment_open_due_idx')],
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='loaninstallment',
+            constraint=models.UniqueConstraint(fields=('loan', 'number'), name='installment_loan_number_uniq'),
+        ),
+        migrations.RunPython(schedule_active_loans, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,59 @@
+# Generated by Django 5.0.2 on 2026-10-18 10:05
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('account', '0027_loan_installments'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LoanAccrual',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('business_date', models.DateField()),
+                ('days', models.PositiveSmallIntegerField()),
+                ('principal', models.DecimalField(decimal_places=2, max_digits=12)),
+                ('interest', models.DecimalField(decimal_places=4, max_digits=14)),
+                ('days_past_due', models.PositiveIntegerField(default=0)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='loan',
+            name='accrued_interest',
+            field=models.DecimalField(decimal_places=4, default=0, max_digits=14),
+        ),
+        migrations.AddField(
+            model_name='loan',
+            name='days_past_due',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='loan',
+            name='last_accrual_date',
+            field=models.DateField(blank=True, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='loan',
+            index=models.Index(condition=models.Q(('status', 'approved')), fields=['id'], name='loan_active_idx'),
+        ),
+        migrations.AddField(
+            model_name='loanaccrual',
+            name='loan',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='accruals', to='account.loan'),
+        ),
+        migrations.AddIndex(
+            model_name='loanaccrual',
+            index=models.Index(fields=['business_date'], name='accrual_date_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='loanaccrual',
+            constraint=models.UniqueConstraint(fields=('loan', 'business_date'), name='accrual_loan_date_uniq'),
+        ),
+    ]
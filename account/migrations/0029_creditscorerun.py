@@ -0,0 +1,23 @@
+# Generated by Django 5.0.2 on 2026-10-18 10:07
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('account', '0028_loan_accrual'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CreditScoreRun',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('started_at', models.DateTimeField(auto_now_add=True)),
+                ('finished_at', models.DateTimeField(blank=True, null=True)),
+                ('full', models.BooleanField(default=False)),
+                ('users', models.IntegerField(default=0)),
+            ],
+        ),
+    ]
@@ -0,0 +1,35 @@
+# Generated by Django 5.0.2 on 2026-10-18 10:15
+
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+
+def count_unread(apps, schema_editor):
+    # One UPDATE with a correlated count per account
+    Account, Notification = apps.get_model('account', 'Account'), apps.get_model('account', 'Notification')
+    unread = (Notification.objects.filter(user_id=OuterRef('user_id'), is_read=False).order_by()
+              .values('user_id').annotate(n=Count('id')).values('n'))
+    Account.objects.update(unread_notifications=Coalesce(Subquery(unread), 0))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('account', '0029_creditscorerun'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='account',
+            name='unread_notifications',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddIndex(
+            model_name='notification',
+            index=models.Index(fields=['user', '-id'], name='notification_user_latest_idx'),
+        ),
+        migrations.RunPython(count_unread, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 5.0.2 on 2026-10-18 10:18
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('account', '0030_notification_counters'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='notification',
+            index=models.Index(fields=['user', 'is_read', 'date'], name='notification_user_read_idx'),
+        ),
+    ]
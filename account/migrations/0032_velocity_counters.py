@@ -0,0 +1,21 @@
+# Generated by Django 5.0.2 on 2026-10-18 10:41
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('account', '0031_notification_retention_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='VelocityCounter',
+            fields=[
+                ('key', models.CharField(max_length=120, primary_key=True, serialize=False)),
+                ('used', models.BigIntegerField(default=0)),
+                ('expires_at', models.DateTimeField(db_index=True)),
+            ],
+        ),
+    ]
@@ -1,7 +1,8 @@
-from django.db import models
+from django.db import models, transaction
 import uuid
+from contextlib import nullcontext
 from django.contrib.auth.models import User
-from django.db.models.signals import pre_save
+from django.db.models.signals import pre_save, post_save, post_delete
 from django.dispatch import receiver
 from django.utils import timezone
 from decimal import Decimal
@@ -11,9 +12,50 @@ ACCOUNT_STATUS = (('active', 'Active'), ('pending', 'Pending'), ('blocked', 'Blo
 TRANSACTION_TYPE = (('deposit', 'Deposit'), ('withdrawal', 'Withdrawal'), ('transfer', 'Transfer'), ('wire', 'Wire Transfer'), ('payment', 'Bill Payment'), ('loan', 'Loan Credit'), ('repayment', 'Loan Repayment'), ('refund', 'Refund / Reversal'))
 TRANSACTION_STATUS = (('success', 'Success'), ('pending', 'Pending'), ('failed', 'Failed'), ('processing', 'Processing'))
 LOAN_STATUS = (('pending', 'Pending'), ('approved', 'Active'), ('rejected', 'Rejected'), ('paid', 'Paid Off'))
+ROLLUP_DIRECTION = (('in', 'Money In'), ('out', 'Money Out'))
 
 # --- MODELS ---
-class Account(models.Model):
+class LoadedValues:
+    """Remembers the column values a row was loaded with, so a save can diff against them without a SELECT."""
+
+    STATUS_FIELD = 'status' # Changes of it carry balance effects; None for models without such a field
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._loaded_values = dict(zip(field_names, values))
+        return instance
+
+    def refresh_from_db(self, *args, **kwargs):
+        super().refresh_from_db(*args, **kwargs)
+        self.remember_loaded()
+
+    def remember_loaded(self):
+        # The row now holds what the instance holds (after a save or refresh)
+        self._loaded_values = {f.attname: getattr(self, f.attname) for f in self._meta.concrete_fields if f.attname in self.__dict__}
+
+    def loaded_values(self, *attnames):
+        """{attname: value as loaded} for a saved row, or None for a new one.
+
+        Only queries for fields that were deferred, or when the instance was built by hand.
+        """
+        if self._state.adding: return None
+        loaded = self.__dict__.setdefault('_loaded_values', {})
+        missing = [f for f in attnames if f not in loaded]
+        if missing:
+            loaded.update(type(self)._base_manager.filter(pk=self.pk).values(*missing).first() or dict.fromkeys(missing))
+        return {f: loaded[f] for f in attnames}
+
+    def status_changed(self):
+        field = self.STATUS_FIELD
+        return bool(field) and not self._state.adding and self.loaded_values(field)[field] != getattr(self, field)
+
+    def save(self, *args, **kwargs):
+        # A status change carries balance effects (post_save -> account.approvals): write both or neither
+        with transaction.atomic() if self.status_changed() else nullcontext():
+            super().save(*args, **kwargs)
+
+class Account(LoadedValues, models.Model):
     user = models.OneToOneField(User, on_delete=models.CASCADE)
     account_number = models.CharField(max_length=12, unique=True, default=uuid.uuid4)
     balance = models.DecimalField(max_digits=12, decimal_places=2, default=0.00)
@@ -29,6 +71,7 @@ class Account(models.Model):
     transaction_pin = models.CharField(max_length=4, blank=True, null=True)
     pin_attempts = models.IntegerField(default=0)
     credit_score = models.IntegerField(default=680)
+    unread_notifications = models.PositiveIntegerField(default=0) # Maintained by account.notifications
     
     # PERSONAL INFO
     phone = models.CharField(max_length=15, blank=True)
@@ -45,9 +88,20 @@ class Account(models.Model):
     kyc_submitted = models.BooleanField(default=False)
     kyc_confirmed = models.BooleanField(default=False)
     
+    COUNTER_FIELDS = ('balance', 'unread_notifications') # Moved with F() updates only
+    STATUS_FIELD = None # Blocking or unblocking moves no money
+
     def __str__(self): return f"{self.user.username} - {self.account_number}"
 
-class Loan(models.Model):
+    def save(self, *args, **kwargs):
+        # Balance is a projection of the ledger and only account.ledger moves it (with F() updates);
+        # the unread counter is likewise only moved by account.notifications. A plain save() of an
+        # existing row must never write a stale in-memory value of either back.
+        if not self._state.adding and kwargs.get('update_fields') is None:
+            kwargs['update_fields'] = [f.name for f in self._meta.concrete_fields if not f.primary_key and f.name not in self.COUNTER_FIELDS]
+        super().save(*args, **kwargs)
+
+class Loan(LoadedValues, models.Model):
     user = models.ForeignKey(User, on_delete=models.CASCADE)
     amount = models.DecimalField(max_digits=12, decimal_places=2) # Principal
     term_months = models.IntegerField(default=12)
@@ -56,11 +110,33 @@ class Loan(models.Model):
     date_applied = models.DateTimeField(auto_now_add=True)
     
     # Repayment Tracking
-    total_repayment = models.DecimalField(max_digits=12, decimal_places=2, default=0.00) # Principal + Interest
+    apr = models.DecimalField(max_digits=5, decimal_places=4, null=True, blank=True) # Quoted at application; None = priced by term at approval
+    approved_at = models.DateTimeField(null=True, blank=True)
+    total_repayment = models.DecimalField(max_digits=12, decimal_places=2, default=0.00) # Principal + Interest (sum of the schedule)
     amount_paid = models.DecimalField(max_digits=12, decimal_places=2, default=0.00)
+
+    # Nightly accrual (account.accrual)
+    accrued_interest = models.DecimalField(max_digits=14, decimal_places=4, default=0)
+    days_past_due = models.PositiveIntegerField(default=0)
+    last_accrual_date = models.DateField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            # Keyset walk over active loans by the accrual job
+            models.Index(fields=['id'], name='loan_active_idx', condition=models.Q(status='approved')),
+        ]
     
     def __str__(self): return f"{self.user.username} - ${self.amount} ({self.status})"
-    
+
+    @property
+    def next_installment(self):
+        # Reads the prefetched schedule (loans_view prefetches it in order)
+        return next((i for i in self.installments.all() if not i.paid_at), None)
+
+    @property
+    def apr_percent(self):
+        return None if self.apr is None else self.apr * 100
+
     # Template Helpers
     @property
     def remaining_amount(self):
@@ -71,7 +147,58 @@ class Loan(models.Model):
         if self.total_repayment == 0: return 0
         return int((self.amount_paid / self.total_repayment) * 100)
 
-class Transaction(models.Model):
+class LoanInstallment(models.Model):
+    """One month of a loan's amortization schedule, written at approval (see account.loans)."""
+    loan = models.ForeignKey(Loan, on_delete=models.CASCADE, related_name='installments')
+    number = models.PositiveSmallIntegerField()
+    due_date = models.DateField()
+    principal = models.DecimalField(max_digits=12, decimal_places=2)
+    interest = models.DecimalField(max_digits=12, decimal_places=2)
+    principal_paid = models.DecimalField(max_digits=12, decimal_places=2, default=0)
+    interest_paid = models.DecimalField(max_digits=12, decimal_places=2, default=0)
+    paid_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        ordering = ['loan', 'number']
+        constraints = [models.UniqueConstraint(fields=['loan', 'number'], name='installment_loan_number_uniq')]
+        indexes = [
+            # Open installments by due date: loan-book projections and overdue scans
+            models.Index(fields=['due_date'], name='installment_open_due_idx', condition=models.Q(paid_at__isnull=True)),
+        ]
+
+    def __str__(self): return f"Loan #{self.loan_id} installment {self.number} due {self.due_date}"
+
+    @property
+    def payment(self): return self.principal + self.interest
+
+    @property
+    def amount_due(self): return self.payment - self.principal_paid - self.interest_paid
+
+class LoanAccrual(models.Model):
+    """Interest accrued on one loan for one business date (the days since its previous accrual)."""
+    loan = models.ForeignKey(Loan, on_delete=models.CASCADE, related_name='accruals')
+    business_date = models.DateField()
+    days = models.PositiveSmallIntegerField()
+    principal = models.DecimalField(max_digits=12, decimal_places=2) # Outstanding principal the interest was computed on
+    interest = models.DecimalField(max_digits=14, decimal_places=4)
+    days_past_due = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        constraints = [models.UniqueConstraint(fields=['loan', 'business_date'], name='accrual_loan_date_uniq')]
+        indexes = [models.Index(fields=['business_date'], name='accrual_date_idx')]
+
+    def __str__(self): return f"Loan #{self.loan_id} accrual {self.business_date}: {self.interest}"
+
+class CreditScoreRun(models.Model):
+    """One pass of the credit scoring pipeline (account.scoring); incremental runs start from the last finished one."""
+    started_at = models.DateTimeField(auto_now_add=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+    full = models.BooleanField(default=False)
+    users = models.IntegerField(default=0)
+
+    def __str__(self): return f"{'Full' if self.full else 'Incremental'} scoring {self.started_at:%Y-%m-%d %H:%M}: {self.users} users"
+
+class Transaction(LoadedValues, models.Model):
     sender = models.ForeignKey(User, on_delete=models.DO_NOTHING, related_name="sent_transactions", null=True, blank=True)
     receiver = models.ForeignKey(User, on_delete=models.DO_NOTHING, related_name="received_transactions", null=True, blank=True)
     amount = models.DecimalField(max_digits=12, decimal_places=2, default=0.00)
@@ -89,8 +216,135 @@ class Transaction(models.Model):
     check_image = models.ImageField(upload_to='checks', blank=True, null=True)
     check_back_image = models.ImageField(upload_to='checks', blank=True, null=True)
 
+    # Denormalised text for history search (note, bank, counterparty names); indexed per backend, see account.search
+    search_document = models.TextField(blank=True, default='', editable=False)
+
+    class Meta:
+        # Hot paths: per-user history in date order (either side), the settlement queue and admin filters.
+        # A BRIN (Postgres) / B-tree (SQLite) index on date alone is created in migration 0023.
+        indexes = [
+            models.Index(fields=['sender', '-date', '-id'], name='txn_sender_date_idx'),
+            models.Index(fields=['receiver', '-date', '-id'], name='txn_receiver_date_idx'),
+            models.Index(fields=['date'], name='txn_processing_due_idx', condition=models.Q(status='processing')),
+            models.Index(fields=['status', 'transaction_type', '-date'], name='txn_admin_filter_idx'),
+        ]
+
+    # Fields that feed statement checkpoints, monthly rollups and stored statements (see the signals below)
+    TRACKED_FIELDS = ('sender_id', 'receiver_id', 'amount', 'date', 'status', 'transaction_type', 'note')
+    PARTY_FIELDS = ('first_name', 'last_name', 'username') # Of sender and receiver, in search_document
+
     def __str__(self): return f"{self.transaction_type} - {self.amount} - {self.status}"
 
+    def tracked_state(self): return {f: getattr(self, f) for f in self.TRACKED_FIELDS}
+
+    def build_search_document(self):
+        # party<id> tokens scope a full-text match to one user's rows inside the text index itself
+        words = [self.note, self.receiver_bank_name, self.transaction_type]
+        for user in (self.sender, self.receiver):
+            if user: words += [getattr(user, f) for f in self.PARTY_FIELDS]
+        parties = [f"party{pk}" for pk in (self.sender_id, self.receiver_id) if pk]
+        return ' '.join([w.lower() for w in words if w] + parties)
+
+    def save(self, *args, **kwargs):
+        update_fields = kwargs.get('update_fields')
+        if update_fields is None or {'note', 'receiver_bank_name', 'sender', 'receiver'} & set(update_fields):
+            self.search_document = self.build_search_document()
+            if update_fields is not None: kwargs['update_fields'] = {*update_fields, 'search_document'}
+        super().save(*args, **kwargs)
+
+class ArchivedTransaction(models.Model):
+    """A transaction moved out of the hot table by account.archive; same id, only the columns history prints."""
+    id = models.BigIntegerField(primary_key=True)
+    sender = models.ForeignKey(User, on_delete=models.DO_NOTHING, related_name='+', null=True, blank=True)
+    receiver = models.ForeignKey(User, on_delete=models.DO_NOTHING, related_name='+', null=True, blank=True)
+    amount = models.DecimalField(max_digits=12, decimal_places=2)
+    transaction_type = models.CharField(max_length=20, choices=TRANSACTION_TYPE)
+    status = models.CharField(max_length=20, choices=TRANSACTION_STATUS)
+    date = models.DateTimeField()
+    rejection_reason = models.CharField(max_length=255, blank=True, null=True)
+    receiver_account_number = models.CharField(max_length=100, blank=True, null=True)
+    receiver_bank_name = models.CharField(max_length=100, blank=True, null=True)
+    note = models.CharField(max_length=100, blank=True, null=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['sender', '-date', '-id'], name='archive_sender_date_idx'),
+            models.Index(fields=['receiver', '-date', '-id'], name='archive_receiver_date_idx'),
+            models.Index(fields=['date'], name='archive_date_idx'),
+        ]
+
+    def __str__(self): return f"Archived TRX-{self.id} {self.date:%Y-%m-%d} {self.amount}"
+
+class LedgerEntry(models.Model):
+    """Append-only journal line. The lines of one posting always sum to zero; account=None is the bank's clearing side."""
+    posting_id = models.UUIDField(db_index=True)
+    account = models.ForeignKey(Account, on_delete=models.PROTECT, related_name='ledger_entries', null=True, blank=True)
+    # No DB constraint: the transaction may live in a partition or in the archive (see account.archive)
+    txn = models.ForeignKey(Transaction, on_delete=models.SET_NULL, related_name='ledger_entries', null=True, blank=True, db_constraint=False)
+    amount = models.DecimalField(max_digits=12, decimal_places=2) # Signed: + credit / - debit
+    memo = models.CharField(max_length=255, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        verbose_name_plural = 'ledger entries'
+
+    def __str__(self): return f"{self.posting_id} {self.account_id or 'clearing'} {self.amount:+}"
+
+    def save(self, *args, **kwargs):
+        if not self._state.adding: raise ValueError("Ledger entries are append-only.")
+        super().save(*args, **kwargs)
+
+    def delete(self, *args, **kwargs): raise ValueError("Ledger entries are append-only.")
+
+class BalanceCheckpoint(models.Model):
+    """Statement running balance (money in - money out) at the close of a month."""
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='balance_checkpoints')
+    month = models.DateField() # First day of the closed month
+    balance = models.DecimalField(max_digits=14, decimal_places=2, default=0.00)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        constraints = [models.UniqueConstraint(fields=['user', 'month'], name='uniq_checkpoint_user_month')]
+
+    def __str__(self): return f"{self.user.username} {self.month:%Y-%m}: {self.balance}"
+
+class MonthlyRollup(models.Model):
+    """Count and sum of successful transactions per user, month, direction and type."""
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='monthly_rollups')
+    month = models.DateField() # First day of the month
+    direction = models.CharField(max_length=3, choices=ROLLUP_DIRECTION)
+    transaction_type = models.CharField(max_length=20, choices=TRANSACTION_TYPE)
+    count = models.IntegerField(default=0)
+    total = models.DecimalField(max_digits=14, decimal_places=2, default=0.00)
+
+    class Meta:
+        constraints = [models.UniqueConstraint(fields=['user', 'month', 'direction', 'transaction_type'], name='uniq_rollup_key')]
+
+    def __str__(self): return f"{self.user.username} {self.month:%Y-%m} {self.direction} {self.transaction_type}: {self.count} / {self.total}"
+
+class VelocityCounter(models.Model):
+    """Usage of one velocity rule by one subject in one window (account.velocity)."""
+    key = models.CharField(max_length=120, primary_key=True) # rule:subject:window index
+    used = models.BigIntegerField(default=0) # Transfers, or cents
+    expires_at = models.DateTimeField(db_index=True) # Once the next window has passed too
+
+    def __str__(self): return f"{self.key}: {self.used}"
+
+class StatementArtifact(models.Model):
+    """A closed month's statement rendered once and stored under STATEMENT_ROOT (see account.statements)."""
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='statement_artifacts')
+    month = models.DateField() # First day of the closed month
+    html_etag = models.CharField(max_length=64)
+    pdf_etag = models.CharField(max_length=64)
+    rendered_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        constraints = [models.UniqueConstraint(fields=['user', 'month'], name='uniq_statement_user_month')]
+
+    def __str__(self): return f"{self.user.username} {self.month:%Y-%m} statement"
+
+    def etag(self, fmt): return f'"{getattr(self, f"{fmt}_etag")}"'
+
 class CreditCard(models.Model):
     user = models.ForeignKey(User, on_delete=models.CASCADE) 
     card_number = models.CharField(max_length=16, unique=True)
@@ -106,6 +360,15 @@ class Notification(models.Model):
     message = models.TextField()
     is_read = models.BooleanField(default=False)
     date = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            # Newest-first dropdown and keyset pages of one user's notifications
+            models.Index(fields=['user', '-id'], name='notification_user_latest_idx'),
+            # Unread counts and retention by read state and age
+            models.Index(fields=['user', 'is_read', 'date'], name='notification_user_read_idx'),
+        ]
+
 class SupportSession(models.Model):
     user = models.ForeignKey(User, on_delete=models.CASCADE)
     status = models.CharField(max_length=20, default='active') # 'active' or 'closed'
@@ -122,39 +385,96 @@ class SupportMessage(models.Model):
     timestamp = models.DateTimeField(auto_now_add=True)
 
 # --- SIGNALS ---
+# Status changes are diffed against the values each row was loaded with (LoadedValues), so saves cost no extra
+# SELECT; their balance effects and notices live in account.approvals
+@receiver(pre_save, sender=Loan)
+def remember_loan_status(sender, instance, **kwargs):
+    before = instance.loaded_values('status')
+    instance._status_before = before and before['status']
+
+@receiver(post_save, sender=Loan)
+def disburse_approved_loan(sender, instance, created, **kwargs):
+    from . import approvals
+    if not created and instance._status_before != 'approved' and instance.status == 'approved':
+        approvals.loan_approved(instance)
+    instance.remember_loaded()
+
+# Unread counters for single-row creates; bulk paths go through account.notifications directly
+@receiver(post_save, sender=Notification)
+def count_new_notification(sender, instance, created, **kwargs):
+    from . import notifications
+    if created: notifications.created(instance)
+
+# Wake the support chat and ops queue streams and move the queue version (account.events) once a message or session change commits
+@receiver(post_save, sender=SupportMessage)
+def push_support_message(sender, instance, **kwargs):
+    from . import events
+    events.publish_on_commit(events.user_channel(instance.user_id), instance.session_id)
+    events.queue_changed(instance.session_id)
+
+@receiver(post_save, sender=SupportSession)
+def push_support_session(sender, instance, **kwargs):
+    from . import events
+    events.queue_changed(instance.pk)
+
+# Keep the transfer form's recipient cache (account.recipients) in step with renames and (re)numbering;
+# saves diff the number and owner against the loaded values, so most saves invalidate nothing
+@receiver(pre_save, sender=Account)
+def remember_recipient(sender, instance, **kwargs):
+    instance._recipient_before = instance.loaded_values('account_number', 'user_id')
+
+@receiver(post_save, sender=Account)
+def invalidate_recipient_on_account_save(sender, instance, created, **kwargs):
+    from . import recipients
+    before = instance._recipient_before
+    if before != {'account_number': instance.account_number, 'user_id': instance.user_id}:
+        recipients.invalidate(instance.account_number, before and before['account_number'])
+    instance.remember_loaded()
+
+@receiver(post_delete, sender=Account)
+def invalidate_recipient_on_account_delete(sender, instance, **kwargs):
+    from . import recipients
+    recipients.invalidate(instance.account_number)
+
+@receiver(post_save, sender=User)
+def invalidate_recipient_on_rename(sender, instance, created, update_fields=None, **kwargs):
+    from . import recipients
+    if created or (update_fields is not None and not {'first_name', 'last_name'} & set(update_fields)): return
+    recipients.invalidate(*Account.objects.filter(user_id=instance.pk).values_list('account_number', flat=True))
+
+# Keep the search text of a user's transactions (account.search) in step with renames; only a save that may
+# touch a name reads the old ones
+@receiver(pre_save, sender=User)
+def remember_party_names(sender, instance, update_fields=None, **kwargs):
+    touched = instance._state.adding or update_fields is None or set(Transaction.PARTY_FIELDS) & set(update_fields)
+    instance._names_before = None if instance._state.adding or not touched else User.objects.filter(pk=instance.pk).values_list(*Transaction.PARTY_FIELDS).first()
+
+@receiver(post_save, sender=User)
+def reindex_search_on_rename(sender, instance, created, **kwargs):
+    from . import search
+    before = getattr(instance, '_names_before', None)
+    if before and before != tuple(getattr(instance, f) for f in Transaction.PARTY_FIELDS):
+        search.reindex([instance])
+
+# Keep closed-month checkpoints, monthly rollups and stored statements in step with inserts, edits and deletes
 @receiver(pre_save, sender=Transaction)
-def trigger_notification(sender, instance, **kwargs):
-    if instance.pk: 
-        try:
-            old_txn = Transaction.objects.get(pk=instance.pk)
-            # Balance Update on Approval (Deposit)
-            if old_txn.status != 'success' and instance.status == 'success':
-                if instance.transaction_type == 'deposit' and instance.receiver:
-                    instance.receiver.account.balance += instance.amount
-                    instance.receiver.account.save()
-            # Notification Logic
-            if old_txn.status != instance.status:
-                target = instance.sender or instance.receiver
-                if target: 
-                    msg = f"Transaction Update: ${instance.amount} is now {instance.status.upper()}."
-                    if instance.status == 'failed' and instance.rejection_reason: msg += f" Reason: {instance.rejection_reason}"
-                    Notification.objects.create(user=target, message=msg)
-        except: pass
+def remember_tracked_fields(sender, instance, **kwargs):
+    instance._tracked_before = instance.loaded_values(*Transaction.TRACKED_FIELDS)
 
-@receiver(pre_save, sender=Loan)
-def loan_approval_handler(sender, instance, **kwargs):
-    if instance.pk:
-        try:
-            old_loan = Loan.objects.get(pk=instance.pk)
-            # Loan Approval Logic
-            if old_loan.status != 'approved' and instance.status == 'approved':
-                instance.user.account.balance += instance.amount; instance.user.account.save()
-                
-                # Interest Calculation (Default 5%) - Handled here if not set in view
-                if instance.total_repayment == 0:
-                    interest = instance.amount * Decimal('0.05')
-                    instance.total_repayment = instance.amount + interest
-                
-                Transaction.objects.create(receiver=instance.user, amount=instance.amount, transaction_type='loan', status='success', note=f"Loan Approved: {instance.purpose}")
-                Notification.objects.create(user=instance.user, message=f"Congratulations! Your loan of ${instance.amount} has been approved.")
-        except: pass
\ No newline at end of file
+@receiver(post_save, sender=Transaction)
+def maintain_aggregates_on_save(sender, instance, **kwargs):
+    from . import approvals, checkpoints, rollups, statements
+    before, after = instance._tracked_before, instance.tracked_state()
+    checkpoints.record_change(before, after)
+    rollups.record_change(before, after)
+    statements.record_change(before, after)
+    if before and before['status'] != after['status']:
+        approvals.transaction_status_changed(instance, before['status'])
+    instance.remember_loaded()
+
+@receiver(post_delete, sender=Transaction)
+def maintain_aggregates_on_delete(sender, instance, **kwargs):
+    from . import checkpoints, rollups, statements
+    checkpoints.record_change(instance.tracked_state(), None)
+    rollups.record_change(instance.tracked_state(), None)
+    statements.record_change(instance.tracked_state(), None)
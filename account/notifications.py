@@ -0,0 +1,136 @@
+"""
+In-app notifications: a denormalized unread counter and a cached dropdown.
+
+Every page renders the notification dropdown, so its cost must not grow with a user's
+history. Account.unread_notifications is kept in step with every create, read and
+delete:
+  - single creates, through the post_save signal;
+  - bulk creates, through bulk_create() here;
+  - reads and deletes, through mark_read() and delete() here.
+The dropdown shows the LATEST newest rows. Those rows and the counter are cached per
+user as one entry (summary()), so a page costs one cache read. A miss costs two small
+queries: the counter by primary key and LATEST + 1 rows by index. Each write drops the
+entry, again once the transaction commits so a concurrent reader cannot re-cache stale
+rows. Older notifications load page by page from the JSON endpoint (page()).
+
+Retention (purge(), run nightly by purge_notifications) deletes read notifications older
+than READ_TTL_DAYS, unread ones older than UNREAD_TTL_DAYS, and anything past a user's
+newest MAX_PER_USER. It deletes PURGE_BATCH rows per short transaction, so locks are never
+held for long.
+"""
+from collections import Counter, defaultdict
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Count, F, Q
+from django.utils import timezone
+from django.utils.timesince import timesince
+
+from .models import Account, Notification
+
+LATEST = 10 # Rows in the dropdown
+PAGE_SIZE = 20 # Rows per page of the JSON endpoint
+CACHE_TTL = 5 * 60
+FIELDS = ('id', 'message', 'date', 'is_read')
+READ_TTL_DAYS = getattr(settings, 'NOTIFICATION_READ_TTL_DAYS', 30)
+UNREAD_TTL_DAYS = getattr(settings, 'NOTIFICATION_UNREAD_TTL_DAYS', 180)
+MAX_PER_USER = getattr(settings, 'NOTIFICATION_MAX_PER_USER', 500)
+PURGE_BATCH = 1000
+
+
+def _key(user_id):
+    return f"notifications:{user_id}"
+
+def invalidate(*user_ids):
+    keys = [_key(user_id) for user_id in set(user_ids)]
+    cache.delete_many(keys)
+    transaction.on_commit(lambda: cache.delete_many(keys))
+
+def _adjust(counts):
+    """Moves each user's unread counter by the given amount, one UPDATE per distinct amount."""
+    by_amount = defaultdict(list)
+    for user_id, amount in counts.items():
+        if amount: by_amount[amount].append(user_id)
+    for amount, user_ids in by_amount.items():
+        Account.objects.filter(user_id__in=user_ids).update(unread_notifications=F('unread_notifications') + amount)
+    invalidate(*counts)
+
+def created(notification):
+    if not notification.is_read: _adjust({notification.user_id: 1})
+
+def bulk_create(notifications):
+    """Notification.objects.bulk_create with the counters kept in step."""
+    notifications = Notification.objects.bulk_create(notifications)
+    _adjust(Counter(n.user_id for n in notifications if not n.is_read))
+    return notifications
+
+def mark_read(queryset):
+    """Marks the unread notifications in queryset as read. Returns how many changed."""
+    unread = queryset.filter(is_read=False)
+    counts = dict(unread.values_list('user_id').annotate(n=Count('id')).order_by())
+    if not counts: return 0
+    changed = unread.update(is_read=True)
+    _adjust({user_id: -n for user_id, n in counts.items()})
+    return changed
+
+def mark_all_read(user_id):
+    """Marks every notification of the user as read with one UPDATE. Returns how many changed."""
+    changed = Notification.objects.filter(user_id=user_id, is_read=False).update(is_read=True)
+    if changed:
+        Account.objects.filter(user_id=user_id).update(unread_notifications=0)
+        invalidate(user_id)
+    return changed
+
+@transaction.atomic
+def delete(queryset):
+    """Deletes the notifications in queryset. Returns how many were deleted."""
+    counts = dict(queryset.values_list('user_id').annotate(unread=Count('id', filter=Q(is_read=False))).order_by())
+    if not counts: return 0
+    deleted = queryset.delete()[0] # Nothing cascades from Notification: one DELETE
+    _adjust({user_id: -n for user_id, n in counts.items()})
+    return deleted
+
+def summary(user_id):
+    """{'unread': count, 'latest': newest LATEST rows as dicts, 'more': whether older rows exist}, cached."""
+    entry = cache.get(_key(user_id))
+    if entry is None:
+        rows = list(Notification.objects.filter(user_id=user_id).order_by('-id').values(*FIELDS)[:LATEST + 1])
+        unread = Account.objects.filter(user_id=user_id).values_list('unread_notifications', flat=True).first() or 0
+        entry = {'unread': unread, 'latest': rows[:LATEST], 'more': len(rows) > LATEST}
+        cache.set(_key(user_id), entry, CACHE_TTL)
+    return entry
+
+def page(user_id, before=None, size=PAGE_SIZE):
+    """The user's notifications older than id `before` (newest first), as JSON-ready dicts, plus the next cursor."""
+    rows = Notification.objects.filter(user_id=user_id).order_by('-id')
+    if before: rows = rows.filter(id__lt=before)
+    rows = list(rows.values(*FIELDS)[:size + 1])
+    more, rows = len(rows) > size, rows[:size]
+    items = [{'id': r['id'], 'message': r['message'], 'date': r['date'].isoformat(), 'since': timesince(r['date']), 'is_read': r['is_read']} for r in rows]
+    return items, (rows[-1]['id'] if more else None)
+
+
+def _purge_batches(queryset, batch_size):
+    # Ids first, then a DELETE by primary key: each batch is its own short transaction
+    while True:
+        ids = list(queryset.order_by('id').values_list('id', flat=True)[:batch_size])
+        if not ids: return
+        yield delete(Notification.objects.filter(pk__in=ids))
+        if len(ids) < batch_size: return
+
+def purge(read_days=None, unread_days=None, max_per_user=None, batch_size=PURGE_BATCH, now=None):
+    """Deletes notifications past their TTL or their user's cap. Yields rows deleted per batch."""
+    now = now or timezone.now()
+    read_days = READ_TTL_DAYS if read_days is None else read_days
+    unread_days = UNREAD_TTL_DAYS if unread_days is None else unread_days
+    max_per_user = MAX_PER_USER if max_per_user is None else max_per_user
+
+    yield from _purge_batches(Notification.objects.filter(is_read=True, date__lt=now - timedelta(days=read_days)), batch_size)
+    yield from _purge_batches(Notification.objects.filter(date__lt=now - timedelta(days=unread_days)), batch_size)
+    over_cap = Notification.objects.values('user_id').annotate(n=Count('id')).filter(n__gt=max_per_user).order_by().values_list('user_id', flat=True)
+    for user_id in list(over_cap):
+        # Everything at or below the id of the user's first row past the cap goes
+        cutoff = Notification.objects.filter(user_id=user_id).order_by('-id').values_list('id', flat=True)[max_per_user]
+        yield from _purge_batches(Notification.objects.filter(user_id=user_id, id__lte=cutoff), batch_size)
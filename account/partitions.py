@@ -0,0 +1,72 @@
+"""
+Monthly range partitions of the Transaction table (Postgres).
+
+Migration 0026 turns account_transaction into a table partitioned by month on `date`:
+account_transaction_pYYYY_MM per month plus account_transaction_default for anything
+outside them. Queries bounded by date (statements, settlement, recent history) only
+touch the partitions they need. `partition_transactions` keeps PARTITIONS_AHEAD months
+created in advance and, with --archive-years, moves old months into the archive (see
+account.archive) and drops their partitions, so the number of live partitions stays
+bounded as history grows. On other backends the table stays a plain table and these
+helpers do nothing.
+"""
+from datetime import date
+
+from django.db import connection, transaction
+from django.utils import timezone
+
+from . import checkpoints
+
+PARENT = 'account_transaction'
+DEFAULT = f'{PARENT}_default'
+PARTITIONS_AHEAD = 3
+
+
+def is_partitioned():
+    if connection.vendor != 'postgresql': return False
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT 1 FROM pg_partitioned_table WHERE partrelid = to_regclass(%s)", [PARENT])
+        return cursor.fetchone() is not None
+
+def partition_name(month):
+    return f"{PARENT}_p{month:%Y_%m}"
+
+def existing():
+    """{month: partition name} for the monthly partitions that exist now."""
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid WHERE i.inhparent = %s::regclass", [PARENT])
+        names = [row[0] for row in cursor.fetchall()]
+    prefix = f"{PARENT}_p"
+    return {date(int(name[-7:-3]), int(name[-2:]), 1): name for name in names if name.startswith(prefix)}
+
+@transaction.atomic
+def create(month):
+    """Adds the partition for one month. Rows that already landed in DEFAULT for it are moved across."""
+    name, (start, end) = partition_name(month), checkpoints.month_bounds(month)
+    with connection.cursor() as cursor:
+        # Build it detached, fill it from DEFAULT, then attach: attaching checks DEFAULT holds nothing for the range
+        cursor.execute(f"CREATE TABLE {name} (LIKE {PARENT} INCLUDING DEFAULTS)")
+        cursor.execute(f"WITH moved AS (DELETE FROM {DEFAULT} WHERE date >= %s AND date < %s RETURNING *) INSERT INTO {name} SELECT * FROM moved", [start, end])
+        moved = cursor.rowcount
+        cursor.execute(f"ALTER TABLE {PARENT} ATTACH PARTITION {name} FOR VALUES FROM (%s) TO (%s)", [start, end])
+    return moved
+
+def ensure(ahead=PARTITIONS_AHEAD, today=None):
+    """Creates any missing partition from the current month to `ahead` months out. Returns the months created."""
+    if not is_partitioned(): return []
+    have = existing()
+    month, created = checkpoints.month_start(today or timezone.now()), []
+    for _ in range(ahead + 1):
+        if month not in have:
+            create(month)
+            created.append(month)
+        month = checkpoints.next_month(month)
+    return created
+
+def drop(month):
+    """Drops an (emptied) month partition. Returns False if it did not exist."""
+    name = existing().get(month)
+    if not name: return False
+    with connection.cursor() as cursor:
+        cursor.execute(f"DROP TABLE {name}")
+    return True
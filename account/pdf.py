@@ -0,0 +1,59 @@
+"""
+Minimal text-only PDF writer.
+
+Enough for statements: pages of positioned text in the standard Helvetica/Courier
+fonts (which every reader ships, so nothing is embedded) and thin rules. Text is
+encoded as Latin-1; anything outside it is replaced with '?'.
+"""
+PAGE_WIDTH, PAGE_HEIGHT = 612, 792 # US Letter, in points
+FONTS = {'F1': 'Helvetica', 'F2': 'Helvetica-Bold', 'F3': 'Courier'}
+
+
+def _escape(text):
+    return str(text).replace('\\', '\\\\').replace('(', '\\(').replace(')', '\\)').replace('\r', '').replace('\n', ' ')
+
+class Document:
+    def __init__(self):
+        self.pages = []
+
+    def add_page(self):
+        self.pages.append([])
+
+    def text(self, x, y, value, size=10, font='F1', gray=0):
+        """Draws one line of text with its baseline at (x, y) from the top-left corner."""
+        self.pages[-1].append(f"BT {gray} g /{font} {size} Tf {x:.1f} {PAGE_HEIGHT - y:.1f} Td ({_escape(value)}) Tj ET")
+
+    def text_right(self, x, y, value, size=10):
+        # Courier is fixed-width (0.6em per glyph), so the right edge is exact
+        self.text(x - len(str(value)) * size * 0.6, y, value, size, 'F3')
+
+    def rule(self, x1, x2, y, gray=0.8):
+        self.pages[-1].append(f"{gray} G 0.5 w {x1:.1f} {PAGE_HEIGHT - y:.1f} m {x2:.1f} {PAGE_HEIGHT - y:.1f} l S")
+
+    def render(self):
+        """The finished file as bytes."""
+        fonts = list(FONTS.items())
+        font_ids = {name: 3 + i for i, (name, _) in enumerate(fonts)}
+        first_page = 3 + len(fonts)
+        objects = [
+            b"<< /Type /Catalog /Pages 2 0 R >>",
+            f"<< /Type /Pages /Kids [{' '.join(f'{first_page + 2 * i} 0 R' for i in range(len(self.pages)))}] /Count {len(self.pages)} >>".encode(),
+        ]
+        objects += [f"<< /Type /Font /Subtype /Type1 /BaseFont /{base} /Encoding /WinAnsiEncoding >>".encode() for _, base in fonts]
+        resources = ' '.join(f"/{name} {font_ids[name]} 0 R" for name, _ in fonts)
+        for i, commands in enumerate(self.pages):
+            stream = '\n'.join(commands).encode('latin-1', 'replace')
+            objects.append(f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 {PAGE_WIDTH} {PAGE_HEIGHT}] "
+                           f"/Resources << /Font << {resources} >> >> /Contents {first_page + 2 * i + 1} 0 R >>".encode())
+            objects.append(b"<< /Length %d >>\nstream\n" % len(stream) + stream + b"\nendstream")
+
+        out = bytearray(b"%PDF-1.4\n")
+        offsets = []
+        for number, body in enumerate(objects, 1):
+            offsets.append(len(out))
+            out += b"%d 0 obj\n" % number + body + b"\nendobj\n"
+        xref = len(out)
+        out += b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1)
+        out += b''.join(b"%010d 00000 n \n" % offset for offset in offsets)
+        out += b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (len(objects) + 1, xref)
+        return bytes(out)
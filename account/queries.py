@@ -0,0 +1,105 @@
+"""
+Shared Transaction queries for the "everything this user sent or received" pattern.
+
+Transactions are indexed on (sender, date, id) and (receiver, date, id). An OR over
+both columns cannot walk either index in date order, so any "newest N" read would
+fetch and sort the user's whole history. recent_transactions() instead reads each
+side in index order with its own LIMIT and merges the two short lists.
+
+Paging uses a keyset cursor on (date, id) rather than OFFSET/COUNT, so page N costs
+the same as page 1. Archived rows are all older than hot ones, so paging and exports
+continue into the archive (account.archive) once the hot table runs out.
+"""
+import base64
+import heapq
+from datetime import datetime
+
+from django.db import connection
+from django.db.models import Q
+
+from . import archive
+from .models import Transaction
+
+NEWEST_FIRST = ('-date', '-id')
+
+
+def user_transactions(user):
+    """Filterable queryset of the user's transactions (for aggregates and filtered scans)."""
+    return Transaction.objects.filter(Q(sender=user) | Q(receiver=user))
+
+def encode_cursor(txn):
+    """Opaque token for "everything older than this transaction"."""
+    return base64.urlsafe_b64encode(f"{txn.date.isoformat()}|{txn.id}".encode()).decode().rstrip('=')
+
+def decode_cursor(token):
+    """(date, id) from encode_cursor(), or None for a missing/garbled token."""
+    if not token: return None
+    try:
+        stamp, pk = base64.urlsafe_b64decode(token + '=' * (-len(token) % 4)).decode().rsplit('|', 1)
+        return datetime.fromisoformat(stamp), int(pk)
+    except ValueError:
+        return None
+
+def older_than(queryset, cursor):
+    """Rows strictly after `cursor` in NEWEST_FIRST order (row-value comparison, index friendly)."""
+    if not cursor: return queryset
+    stamp, pk = cursor
+    return queryset.filter(Q(date__lt=stamp) | Q(date=stamp, id__lt=pk))
+
+def recent_transactions(user, limit, queryset=None, before=None):
+    """The user's newest `limit` transactions as a list, from two bounded index scans.
+
+    `queryset` can narrow both sides (extra filters, select_related) before the split;
+    `before` is a decoded cursor to continue from.
+    """
+    base = older_than(Transaction.objects.all() if queryset is None else queryset, before)
+    sent = base.filter(sender=user).order_by(*NEWEST_FIRST)[:limit]
+    received = base.filter(receiver=user).order_by(*NEWEST_FIRST)[:limit]
+
+    if connection.features.supports_slicing_ordering_in_compound:
+        # Postgres: one round trip, id IN ((SELECT id .. LIMIT n) UNION (SELECT id .. LIMIT n))
+        ids = sent.values('pk').union(received.values('pk'))
+        return list(base.filter(pk__in=ids).order_by(*NEWEST_FIRST)[:limit])
+
+    # Two index-ordered reads merged in Python (SQLite cannot LIMIT inside a compound select)
+    merged, seen = [], set()
+    for txn in heapq.merge(sent, received, key=lambda t: (t.date, t.id), reverse=True):
+        if txn.id in seen: continue
+        seen.add(txn.id)
+        merged.append(txn)
+        if len(merged) == limit: break
+    return merged
+
+def transaction_page(user, size, cursor=None, queryset=None, side=None, since=None):
+    """One page of history: (transactions, next_cursor or None). No COUNT, no OFFSET.
+
+    side='sent' / 'received' reads just that index; otherwise both are merged. `since`
+    is the date filter already applied to `queryset`, repeated for the archive.
+    """
+    base = Transaction.objects.all() if queryset is None else queryset
+    if side:
+        base = base.filter(**{'sender' if side == 'sent' else 'receiver': user})
+        rows = list(older_than(base, cursor).order_by(*NEWEST_FIRST)[:size + 1])
+    else:
+        rows = recent_transactions(user, size + 1, base, before=cursor)
+    if len(rows) <= size:
+        # Hot history ran out on this page: the rest continues in the archive
+        rows += list(older_than(archive.user_rows(user, side, since), cursor).order_by(*NEWEST_FIRST)[:size + 1 - len(rows)])
+    return rows[:size], (encode_cursor(rows[size - 1]) if len(rows) > size else None)
+
+def iter_history(user, queryset=None, side=None, since=None, chunk_size=2000, **filters):
+    """Every matching transaction of the user, oldest first, for exports.
+
+    Streams each side's index in order and merges them, so memory stays flat and the
+    first row is available as soon as the first chunk is read. Archived rows (all older)
+    come first; `since` is the date filter already applied to `queryset`, and `filters`
+    (e.g. status='success') apply to both.
+    """
+    yield from archive.user_rows(user, side, since).filter(**filters).order_by('date', 'id').iterator(chunk_size=chunk_size)
+    base = (Transaction.objects.all() if queryset is None else queryset).filter(**filters)
+    streams = [base.filter(**{field: user}).order_by('date', 'id').iterator(chunk_size=chunk_size)
+               for field, name in (('sender', 'sent'), ('receiver', 'received')) if side in (None, name)]
+    last_id = None
+    for txn in heapq.merge(*streams, key=lambda t: (t.date, t.id)):
+        if txn.id != last_id: yield txn # A self-transfer appears on both sides
+        last_id = txn.id
@@ -0,0 +1,82 @@
+"""
+Recipient lookup for the transfer form (account number -> owner's display name).
+
+The form asks on every keystroke, so lookups are cached in two tiers:
+  1. a per-process LRU (LOCAL_SIZE entries, each trusted for LOCAL_TTL seconds);
+  2. the shared cache, so every worker profits from the others' lookups.
+Only a miss in both runs a query: one select_related of the account and its owner.
+Unknown numbers are cached too (for MISSING_TTL, shorter than the positive TTL) so
+typing through partial numbers does not query on every character.
+
+Renaming a user, opening, renumbering or deleting an account invalidates the
+number's entry in the shared cache and in this process's LRU. Other processes'
+LRUs catch up within LOCAL_TTL.
+"""
+import threading
+import time
+from collections import OrderedDict
+
+from django.core.cache import cache
+
+from .models import Account
+
+CACHE_TTL = 60 * 60
+MISSING_TTL = 60
+LOCAL_TTL = 30
+LOCAL_SIZE = 10000
+MISSING = 'missing' # Stored for numbers with no account
+
+
+class _LRU:
+    """Small thread-safe LRU with a per-entry expiry."""
+
+    def __init__(self, size, ttl):
+        self.size, self.ttl, self.entries, self.lock = size, ttl, OrderedDict(), threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            value, expires = self.entries.get(key, (None, 0))
+            if expires < time.monotonic():
+                self.entries.pop(key, None)
+                return None
+            self.entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self.lock:
+            self.entries[key] = (value, time.monotonic() + self.ttl)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.size: self.entries.popitem(last=False)
+
+    def delete(self, key):
+        with self.lock: self.entries.pop(key, None)
+
+    def clear(self):
+        with self.lock: self.entries.clear()
+
+local = _LRU(LOCAL_SIZE, LOCAL_TTL)
+
+
+def _key(account_number):
+    return f"recipient:{account_number}"
+
+def _load(account_number):
+    account = Account.objects.select_related('user').only('user_id', 'user__first_name', 'user__last_name').filter(account_number=account_number).first()
+    return (account.user_id, f"{account.user.first_name} {account.user.last_name}") if account else MISSING
+
+def resolve(account_number):
+    """(user_id, display name) of the account's owner, or None when there is no such account."""
+    key = _key(account_number)
+    entry = local.get(key)
+    if entry is None:
+        entry = cache.get(key)
+        if entry is None:
+            entry = _load(account_number)
+            cache.set(key, entry, MISSING_TTL if entry == MISSING else CACHE_TTL)
+        local.set(key, entry)
+    return None if entry == MISSING else entry
+
+def invalidate(*account_numbers):
+    keys = [_key(n) for n in account_numbers if n]
+    for key in keys: local.delete(key)
+    cache.delete_many(keys)
@@ -0,0 +1,106 @@
+"""
+Per-user monthly rollups of successful transactions.
+
+Each MonthlyRollup row holds the count and sum for one (user, month, direction,
+transaction_type). The rows are adjusted whenever a transaction enters or leaves the
+'success' state (or a successful one is edited or deleted), so the dashboard,
+analytics and documents pages read a handful of small rows instead of scanning the
+account history.
+"""
+from collections import defaultdict
+from decimal import Decimal
+from itertools import product
+
+from django.db import connection, transaction
+from django.db.models import Count, DateField, Q, Sum
+from django.db.models.functions import TruncMonth
+
+from .checkpoints import month_start
+from .models import ArchivedTransaction, MonthlyRollup, Transaction
+
+ZERO = Decimal('0.00')
+
+
+def _keys(state):
+    """Rollup keys a successful transaction contributes to."""
+    if not state or state['status'] != 'success': return []
+    month = month_start(state['date'])
+    keys = []
+    if state['receiver_id']: keys.append((state['receiver_id'], month, 'in', state['transaction_type']))
+    if state['sender_id']: keys.append((state['sender_id'], month, 'out', state['transaction_type']))
+    return keys
+
+def _upsert(deltas):
+    # INSERT .. ON CONFLICT DO UPDATE (SQLite 3.24+ / Postgres): increments without a read, one statement per batch
+    table = connection.ops.quote_name(MonthlyRollup._meta.db_table)
+    sql = (f"INSERT INTO {table} (user_id, month, direction, transaction_type, count, total) VALUES (%s, %s, %s, %s, %s, %s) "
+           f"ON CONFLICT (user_id, month, direction, transaction_type) "
+           f"DO UPDATE SET count = {table}.count + excluded.count, total = {table}.total + excluded.total")
+    params = [(user_id, connection.ops.adapt_datefield_value(month), direction, t_type, count, connection.ops.adapt_decimalfield_value(total))
+              for (user_id, month, direction, t_type), (count, total) in deltas.items() if count or total]
+    if params:
+        with connection.cursor() as cursor:
+            cursor.executemany(sql, params)
+
+def _apply(signed_states):
+    deltas = defaultdict(lambda: [0, ZERO])
+    for state, sign in signed_states:
+        for key in _keys(state):
+            deltas[key][0] += sign
+            deltas[key][1] += Decimal(state['amount']) * sign
+    _upsert(deltas)
+
+def apply(states, sign=1):
+    """Adds (sign=1) or removes (sign=-1) many tracked states in one upsert batch."""
+    _apply((state, sign) for state in states)
+
+def record_change(before, after):
+    """Adjusts rollups for a transaction that was inserted, edited or deleted.
+
+    before/after are Transaction.tracked_state() dicts; None means the row did not exist.
+    """
+    if before == after or not (_keys(before) or _keys(after)): return
+    _apply([(before, -1), (after, 1)])
+
+
+def rebuild(users=None):
+    """Recomputes rollups from scratch, archived months included (backfill / repair). Returns rows written."""
+    existing = MonthlyRollup.objects.all()
+    if users is not None:
+        existing = existing.filter(user__in=users)
+    rows = []
+    for model, (direction, field) in product((Transaction, ArchivedTransaction), (('in', 'receiver'), ('out', 'sender'))):
+        scoped = model.objects.filter(status='success', **{f"{field}__isnull": False})
+        if users is not None: scoped = scoped.filter(**{f"{field}__in": users})
+        grouped = (scoped.annotate(month=TruncMonth('date')).values(f"{field}_id", 'month', 'transaction_type')
+                   .annotate(n=Count('id'), s=Sum('amount')).order_by())
+        rows += [MonthlyRollup(user_id=g[f"{field}_id"], month=month_start(g['month']), direction=direction,
+                               transaction_type=g['transaction_type'], count=g['n'], total=g['s']) for g in grouped]
+    with transaction.atomic():
+        existing.delete()
+        MonthlyRollup.objects.bulk_create(rows, batch_size=1000)
+    return len(rows)
+
+
+# --- READERS ---
+def month_totals(user, month):
+    """(money_in, money_out) of successful transactions in one month."""
+    totals = dict(MonthlyRollup.objects.filter(user=user, month=month).values_list('direction').annotate(Sum('total')).order_by())
+    return totals.get('in') or ZERO, totals.get('out') or ZERO
+
+def lifetime_totals(user):
+    """{(direction, transaction_type): total} over the whole history."""
+    rows = MonthlyRollup.objects.filter(user=user).values_list('direction', 'transaction_type').annotate(Sum('total')).order_by()
+    return {(direction, t_type): total for direction, t_type, total in rows}
+
+def active_months(user):
+    """Months with at least one transaction of the user's, in any status, newest first.
+
+    Statements print every status, so months the rollups miss (only processing, pending or
+    failed rows) come from the user's rows that have not succeeded, hot and archived.
+    """
+    unsettled = [model.objects.filter(Q(sender=user) | Q(receiver=user)).exclude(status='success')
+                 .annotate(month=TruncMonth('date', output_field=DateField())).values_list('month', flat=True).order_by()
+                 for model in (Transaction, ArchivedTransaction)]
+    months = MonthlyRollup.objects.filter(user=user, count__gt=0).values_list('month', flat=True).order_by().union(*unsettled) # One query
+    return sorted({month_start(month) for month in months}, reverse=True)
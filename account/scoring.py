@@ -0,0 +1,124 @@
+"""
+Credit scores from account behaviour.
+
+score_users() rescores accounts CHUNK_SIZE users at a time. Per chunk it reads three
+grouped queries: the accounts (current balance), their monthly rollups over the last
+WINDOW_MONTHS months (inflows and outflows, from which month-end balances are rebuilt
+backwards from today's balance) and their loan installments (due, paid late, missed, worst
+days past due). Everything after that is NumPy over the whole chunk: feature arrays, a
+weighted sum squashed onto the 300-850 range, one bulk_update of credit_score.
+
+A user with no history scores BASE_SCORE. Each run is recorded as a CreditScoreRun; an
+incremental run (the default once a full run exists) only rescores users with activity
+since the previous run started: new transactions, installment payments, or a loan that
+is past due (its score keeps moving while it stays late).
+"""
+import math
+
+import numpy as np
+from django.db.models import Count, F, Max, Q, Sum
+from django.utils import timezone
+
+from . import checkpoints
+from .models import Account, CreditScoreRun, Loan, LoanInstallment, MonthlyRollup, Transaction
+
+CHUNK_SIZE = 2000
+WINDOW_MONTHS = 6
+MIN_SCORE, MAX_SCORE, BASE_SCORE = 300, 850, 680
+# Weights on the logistic scale (see _score)
+W_SAVINGS = 0.8 # Share of inflow kept, -1..1
+W_VOLATILITY = 0.6 # Std of month-end balances over their mean, capped at 2
+W_BALANCE = 0.4 # log10 of the average balance, 4 = $10k
+W_PUNCTUALITY = 2.5 # On-time share of due installments, against a 90% norm
+W_MISSED = 0.5 # Per installment past due and unpaid
+W_DAYS_PAST_DUE = 0.8 # Per 30 days of the worst current delinquency, capped at 90
+
+
+def _months(today):
+    month, months = checkpoints.month_start(today), []
+    for _ in range(WINDOW_MONTHS):
+        months.insert(0, month)
+        month = checkpoints.previous_month(month)
+    return months
+
+def features(user_ids, today=None):
+    """(accounts as (user_id, pk) pairs, dict of feature arrays aligned with them) for the given users."""
+    today = today or timezone.localdate()
+    accounts = {user_id: (pk, balance) for user_id, pk, balance in Account.objects.filter(user_id__in=user_ids).values_list('user_id', 'pk', 'balance')}
+    ids = sorted(accounts)
+    index = {user_id: i for i, user_id in enumerate(ids)}
+    months = _months(today)
+    month_index = {m: i for i, m in enumerate(months)}
+
+    flows = np.zeros((2, len(ids), len(months))) # [in/out, user, month]
+    for row in (MonthlyRollup.objects.filter(user_id__in=ids, month__gte=months[0]).values('user_id', 'month', 'direction')
+                .annotate(total=Sum('total')).order_by()):
+        flows[int(row['direction'] == 'out'), index[row['user_id']], month_index[row['month']]] = float(row['total'])
+
+    loans = np.zeros((4, len(ids))) # [due, late, missed, worst days past due]
+    for row in (LoanInstallment.objects.filter(loan__user_id__in=ids, due_date__lt=today).values('loan__user_id').annotate(
+            due=Count('id'),
+            late=Count('id', filter=Q(paid_at__date__gt=F('due_date'))),
+            missed=Count('id', filter=Q(paid_at__isnull=True)),
+            worst=Max('loan__days_past_due', filter=Q(loan__status='approved'))).order_by()):
+        loans[:, index[row['loan__user_id']]] = (row['due'], row['late'], row['missed'], row['worst'] or 0)
+
+    inflow, outflow = flows[0], flows[1]
+    # Month-end balances, walked back from today's balance through each later month's net flow
+    net = inflow - outflow
+    balance_now = np.array([float(accounts[user_id][1]) for user_id in ids])
+    later_net = np.cumsum(net[:, ::-1], axis=1)[:, ::-1] - net
+    month_end = balance_now[:, None] - later_net
+    return [(user_id, accounts[user_id][0]) for user_id in ids], {
+        'inflow': inflow.sum(axis=1),
+        'outflow': outflow.sum(axis=1),
+        'average_balance': month_end.mean(axis=1),
+        'volatility': month_end.std(axis=1) / np.maximum(np.abs(month_end.mean(axis=1)), 100),
+        'installments_due': loans[0],
+        'installments_late': loans[1],
+        'installments_missed': loans[2],
+        'days_past_due': loans[3],
+    }
+
+def _score(f):
+    base = math.log((BASE_SCORE - MIN_SCORE) / (MAX_SCORE - BASE_SCORE)) # A user with no history lands on BASE_SCORE
+    savings = np.where(f['inflow'] > 0, (f['inflow'] - f['outflow']) / np.maximum(f['inflow'], 1), 0).clip(-1, 1)
+    on_time = np.where(f['installments_due'] > 0, 1 - (f['installments_late'] + f['installments_missed']) / np.maximum(f['installments_due'], 1), 0.9)
+    z = (base + W_SAVINGS * savings
+         - W_VOLATILITY * np.minimum(f['volatility'], 2)
+         + W_BALANCE * np.log10(1 + np.maximum(f['average_balance'], 0)) / 4
+         + W_PUNCTUALITY * (on_time - 0.9)
+         - W_MISSED * f['installments_missed']
+         - W_DAYS_PAST_DUE * np.minimum(f['days_past_due'], 90) / 30)
+    return np.rint(MIN_SCORE + (MAX_SCORE - MIN_SCORE) / (1 + np.exp(-z))).astype(int)
+
+def score_chunk(user_ids, today=None):
+    """Rescores the given users. Returns how many accounts were updated."""
+    owners, f = features(user_ids, today)
+    if not owners: return 0
+    accounts = [Account(pk=pk, user_id=user_id, credit_score=int(score)) for (user_id, pk), score in zip(owners, _score(f))]
+    Account.objects.bulk_update(accounts, ['credit_score'], batch_size=CHUNK_SIZE)
+    return len(accounts)
+
+
+def active_since(since):
+    """Ids of users with activity since `since` (a datetime), plus everyone with a late loan."""
+    users = {user_id for pair in Transaction.objects.filter(date__gte=since).values_list('sender_id', 'receiver_id') for user_id in pair}
+    users |= set(LoanInstallment.objects.filter(paid_at__gte=since).values_list('loan__user_id', flat=True))
+    users |= set(Loan.objects.filter(status='approved', days_past_due__gt=0).values_list('user_id', flat=True))
+    return sorted(users - {None})
+
+def score_users(full=False, chunk_size=CHUNK_SIZE, today=None):
+    """Runs the pipeline (incrementally unless `full` or no earlier run). Yields users scored per chunk."""
+    previous = CreditScoreRun.objects.filter(finished_at__isnull=False).order_by('-started_at').first()
+    run = CreditScoreRun.objects.create(full=full or previous is None)
+    if run.full:
+        ids = list(Account.objects.order_by('user_id').values_list('user_id', flat=True))
+    else:
+        ids = active_since(previous.started_at)
+    for i in range(0, len(ids), chunk_size):
+        scored = score_chunk(ids[i:i + chunk_size], today)
+        run.users += scored
+        yield scored
+    run.finished_at = timezone.now()
+    run.save(update_fields=['users', 'finished_at'])
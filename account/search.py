@@ -0,0 +1,111 @@
+"""
+Transaction history search.
+
+Free text is matched against Transaction.search_document (note, bank name, type and
+counterparty names) through a full-text index: a GIN index over to_tsvector('simple')
+on Postgres, an FTS5 table on SQLite (both created in migration 0024). Every document
+also carries party<user id> tokens, so the index itself narrows a match to the
+searching user's rows. Results come back ranked.
+
+The query can also hold:
+  #00001234 / TRX-1234   exact transaction reference
+  50 / $50.00            exact amount
+  50-100, >100, <=20     amount range
+"""
+import re
+from decimal import Decimal
+
+from django.db import connection
+from django.db.models import Q
+from django.db.models.expressions import RawSQL
+
+from .models import Transaction
+from .queries import NEWEST_FIRST
+
+RESULT_LIMIT = 50
+REFERENCE = re.compile(r'^(?:#|trx-?)(\d+)$', re.I)
+AMOUNT = re.compile(r'^\$?(\d+(?:\.\d{1,2})?)$')
+AMOUNT_RANGE = re.compile(r'^\$?(\d+(?:\.\d{1,2})?)-\$?(\d+(?:\.\d{1,2})?)$')
+AMOUNT_BOUND = re.compile(r'^([<>]=?)\$?(\d+(?:\.\d{1,2})?)$')
+BOUND_LOOKUPS = {'<': 'lt', '<=': 'lte', '>': 'gt', '>=': 'gte'}
+
+
+def parse_query(text):
+    """Splits a search box value into (reference ids, amount Q, free-text words)."""
+    references, amount, words = [], Q(), []
+    for token in text.split():
+        if match := REFERENCE.match(token):
+            references.append(int(match[1]))
+        elif match := AMOUNT_RANGE.match(token):
+            low, high = sorted((Decimal(match[1]), Decimal(match[2])))
+            amount &= Q(amount__gte=low, amount__lte=high)
+        elif match := AMOUNT_BOUND.match(token):
+            amount &= Q(**{f"amount__{BOUND_LOOKUPS[match[1]]}": Decimal(match[2])})
+        elif match := AMOUNT.match(token):
+            amount &= Q(amount=Decimal(match[1]))
+        else:
+            words += re.findall(r'\w+', token.lower())
+    return references, amount, words
+
+
+def _postgres_matches(user, words, queryset, limit):
+    from django.contrib.postgres.search import SearchQuery, SearchRank, SearchVector
+
+    # Prefix match per word ("amaz" finds "amazon"); tokens are \w+ only, so the raw query is safe
+    query = SearchQuery(' & '.join([f"{w}:*" for w in words] + [f"party{user.pk}"]), search_type='raw', config='simple')
+    vector = SearchVector('search_document', config='simple')
+    return list(queryset.annotate(document=vector, rank=SearchRank(vector, query)).filter(document=query)
+                .order_by('-rank', *NEWEST_FIRST)[:limit])
+
+def _sqlite_matches(user, words, queryset, limit):
+    match = ' AND '.join([f'"{w}"*' for w in words] + [f'"party{user.pk}"'])
+    fts = "SELECT rowid, rank FROM account_transaction_fts WHERE account_transaction_fts MATCH %s"
+    with connection.cursor() as cursor:
+        cursor.execute(fts, [match])
+        ranks = dict(cursor.fetchall()) # bm25: lower is better
+    if not ranks: return []
+    hits = list(queryset.filter(pk__in=RawSQL(fts.replace(', rank', ''), [match])))
+    hits.sort(key=lambda t: (ranks[t.pk], -t.date.timestamp(), -t.pk))
+    return hits[:limit]
+
+def _text_matches(user, words, queryset, limit):
+    if connection.vendor == 'postgresql': return _postgres_matches(user, words, queryset, limit)
+    if connection.vendor == 'sqlite': return _sqlite_matches(user, words, queryset, limit)
+    # No full-text index on this backend: plain substring match on the document
+    for word in words: queryset = queryset.filter(search_document__contains=word)
+    return list(queryset.order_by(*NEWEST_FIRST)[:limit])
+
+
+def search(user, text, queryset=None, limit=RESULT_LIMIT):
+    """The user's transactions matching `text`, best first (exact references, then text rank, then date).
+
+    `queryset` can carry extra filters (date range, side, select_related).
+    """
+    base = (Transaction.objects.all() if queryset is None else queryset).filter(Q(sender=user) | Q(receiver=user))
+    references, amount, words = parse_query(text)
+
+    results = list(base.filter(pk__in=references)) if references else []
+    if words:
+        results += _text_matches(user, words, base.filter(amount), limit)
+    elif amount:
+        results += list(base.filter(amount).order_by(*NEWEST_FIRST)[:limit])
+
+    seen = set()
+    return [t for t in results if not (t.pk in seen or seen.add(t.pk))][:limit]
+
+
+def reindex(users=None, chunk_size=2000):
+    """Recomputes search_document. Renaming a user runs it for their rows (account.models); the
+    rebuild_search_index command runs it for repairs. The text index follows via its triggers/expression."""
+    txns = Transaction.objects.select_related('sender', 'receiver')
+    if users is not None: txns = txns.filter(Q(sender__in=users) | Q(receiver__in=users))
+    batch, written = [], 0
+    for txn in txns.iterator(chunk_size=chunk_size):
+        document = txn.build_search_document()
+        if document != txn.search_document:
+            txn.search_document = document
+            batch.append(txn)
+        if len(batch) == chunk_size:
+            written += Transaction.objects.bulk_update(batch, ['search_document'])
+            batch = []
+    return written + (Transaction.objects.bulk_update(batch, ['search_document']) if batch else 0)
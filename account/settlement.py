@@ -0,0 +1,64 @@
+"""
+Background settlement of 'processing' transfers and wires.
+
+Customer-initiated transactions that are still 'processing' once SETTLEMENT_DELAY has
+passed are flipped to 'success' in batches. Each batch is claimed with
+SELECT ... FOR UPDATE SKIP LOCKED, so any number of `settle_transactions` workers can
+run side by side without waiting on, or double-settling, each other's rows. Receivers
+of internal transfers are credited through one ledger batch posting. Notifications
+are bulk-inserted and emails are queued for after commit.
+"""
+from datetime import timedelta
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.utils import timezone
+
+from . import emails, ledger, notifications, rollups
+from .models import Account, Notification, Transaction
+
+SETTLEMENT_DELAY = timedelta(minutes=getattr(settings, 'SETTLEMENT_DELAY_MINUTES', 10))
+BATCH_SIZE = 500
+
+
+def due_transactions(now=None):
+    """Customer-initiated transactions whose review window has passed (deposits wait for an admin)."""
+    return Transaction.objects.filter(status='processing', sender__isnull=False, date__lt=(now or timezone.now()) - SETTLEMENT_DELAY)
+
+@ledger.retry_on_conflict
+def settle_batch(batch_size=BATCH_SIZE, now=None):
+    """Settles up to batch_size due transactions in one DB transaction. Returns how many."""
+    batch = list(due_transactions(now).select_for_update(skip_locked=True).order_by('date')
+                 .only(*Transaction.TRACKED_FIELDS)[:batch_size])
+    if not batch: return 0
+
+    # 1. Flip statuses in one UPDATE
+    Transaction.objects.filter(pk__in=[t.pk for t in batch]).update(status='success')
+    for t in batch: t.status = 'success'
+    rollups.apply(t.tracked_state() for t in batch)
+
+    # 2. Credit internal receivers (money has been waiting on the clearing side)
+    credits = [t for t in batch if t.transaction_type == 'transfer' and t.receiver_id]
+    paid = ledger.posted({t.pk: f"Settlement of TRX-{t.pk}" for t in credits}) # Never pay a receiver twice
+    credits = [t for t in credits if t.pk not in paid]
+    accounts = dict(Account.objects.filter(user_id__in={t.receiver_id for t in credits}).values_list('user_id', 'pk'))
+    ledger.post_batch([([(accounts[t.receiver_id], t.amount)], f"Settlement of TRX-{t.pk}", t) for t in credits if t.receiver_id in accounts], allow_overdraft=True)
+
+    # 3. Notifications + alerts
+    users = User.objects.select_related('account').in_bulk({t.sender_id for t in batch} | {t.receiver_id for t in credits})
+    notes = [Notification(user_id=t.sender_id, message=f"Transaction Update: ${t.amount} is now SUCCESS.") for t in batch]
+    notes += [Notification(user_id=t.receiver_id, message=f"Credit Alert: You received ${t.amount} from {users[t.sender_id].username}.") for t in credits]
+    notifications.bulk_create(notes)
+    for t in batch:
+        emails.queue_transaction_alert(users[t.sender_id], t.amount, t.transaction_type, 'Successful')
+    for t in credits:
+        emails.queue_transaction_alert(users[t.receiver_id], t.amount, "Incoming Transfer", "Successful")
+    return len(batch)
+
+def settle_due(batch_size=BATCH_SIZE, now=None):
+    """Settles batches until nothing is due. Returns the total settled."""
+    total = 0
+    while True:
+        settled = settle_batch(batch_size, now)
+        total += settled
+        if settled < batch_size: return total
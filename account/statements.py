@@ -0,0 +1,240 @@
+"""
+Stored statements for closed months.
+
+Once a month has closed its statement only changes through a back-dated edit, so the
+first request renders it once, as HTML and as PDF, into STATEMENT_ROOT (private local
+disk, never the public media storage) and records a StatementArtifact row holding a
+strong ETag per format. Later requests serve the stored bytes, or a 304. The current
+month is always rendered live. At month close the `generate_statements` command
+pre-renders every account's statement in chunks (generate_chunk) so the first visits
+do not all render at once.
+
+Any insert, edit or delete of a transaction dated in a closed month drops the affected
+users' artifacts from that month on (every later opening balance moves with it); the
+Transaction signals call record_change(). Bulk status updates (settlement, admin
+rejection) leave stored statements alone because status is not printed on them.
+Names and addresses are printed as they were when the statement was first issued.
+"""
+import hashlib
+import os
+from collections import defaultdict
+from datetime import timedelta
+from decimal import Decimal
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import transaction
+from django.db.models import Q
+from django.template.loader import render_to_string
+from django.utils import timezone
+
+from . import checkpoints
+from .models import ArchivedTransaction, BalanceCheckpoint, StatementArtifact, Transaction
+from .pdf import Document
+
+FORMATS = {'html': 'text/html; charset=utf-8', 'pdf': 'application/pdf'}
+RENDERED_FIELDS = ('sender_id', 'receiver_id', 'amount', 'date', 'transaction_type', 'note')
+ROWS_PER_PAGE = 40
+CHUNK_SIZE = 500 # Users per generate_chunk() call
+ZERO = Decimal('0.00')
+
+
+def _path(user_id, month, fmt):
+    return os.path.join(settings.STATEMENT_ROOT, str(user_id), f"{month:%Y-%m}.{fmt}")
+
+def _etag(content):
+    return hashlib.sha256(content).hexdigest()
+
+def _write(path, content):
+    # Write-then-rename so a concurrent reader never sees half a file
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temp = f"{path}.{os.getpid()}.tmp"
+    with open(temp, 'wb') as f: f.write(content)
+    os.replace(temp, path)
+
+
+def _context(user, month, txns, beginning_balance):
+    total_in = sum((t.amount for t in txns if t.receiver_id == user.id), ZERO)
+    total_out = sum((t.amount for t in txns if t.sender_id == user.id), ZERO)
+    return {
+        'user': user,
+        'account': user.account,
+        'transactions': txns,
+        'date': month,
+        'total_in': total_in,
+        'total_out': total_out,
+        'beginning_balance': beginning_balance,
+        'closing_balance': beginning_balance + total_in - total_out,
+    }
+
+def _month_rows(condition, month):
+    # A month is either wholly hot or wholly archived (account.archive moves whole months)
+    start, end = checkpoints.month_bounds(month)
+    for model in (Transaction, ArchivedTransaction):
+        rows = list(model.objects.filter(condition, date__gte=start, date__lt=end).select_related('sender', 'receiver').order_by('date', 'id'))
+        if rows: return rows
+    return []
+
+def statement_context(user, month):
+    txns = _month_rows(Q(sender=user) | Q(receiver=user), month)
+    return _context(user, month, txns, checkpoints.opening_balance(user, month))
+
+def describe(txn, user):
+    """Statement line for one transaction, worded like statement_pdf.html."""
+    if txn.transaction_type in ('wire', 'refund'): return txn.note or ''
+    if txn.sender_id == user.id:
+        return f"To: {txn.receiver.first_name} {txn.receiver.last_name}" if txn.receiver else (txn.note or "Payment")
+    return f"From: {txn.sender.first_name} {txn.sender.last_name}" if txn.sender else "Deposit"
+
+def render_html(context):
+    return render_to_string('account/statement_pdf.html', context).encode()
+
+def render_pdf(context):
+    user, account, month = context['user'], context['account'], context['date']
+    txns = context['transactions']
+    pages = [txns[i:i + ROWS_PER_PAGE] for i in range(0, len(txns), ROWS_PER_PAGE)] or [[]]
+    doc = Document()
+    for number, rows in enumerate(pages, 1):
+        doc.add_page()
+        doc.text(50, 60, "VELTRIS BANK", 18, 'F2')
+        doc.text(50, 76, "123 Financial District, Suite 500, New York, NY 10005", 8, gray=0.4)
+        doc.text(430, 60, "STATEMENT", 16, 'F2')
+        doc.text(430, 76, f"{month:%B} 1 - {checkpoints.next_month(month) - timedelta(days=1):%B %d, %Y}", 8, gray=0.4)
+        y = 110
+        if number == 1:
+            doc.text(50, y, "ACCOUNT HOLDER", 8, 'F2', 0.4)
+            doc.text(330, y, "ACCOUNT DETAILS", 8, 'F2', 0.4)
+            for line, (left, right) in enumerate(((f"{user.first_name} {user.last_name}", "Checking Account"),
+                                                  (account.address, f"xxxx-{account.account_number[-4:]}"),
+                                                  (f"{account.city}, {account.zip_code}", "Routing: 026009593"))):
+                doc.text(50, y + 14 * (line + 1), left)
+                doc.text(330, y + 14 * (line + 1), right)
+            y += 75
+            for column, (label, value) in enumerate((("Beginning Balance", f"${context['beginning_balance']:,.2f}"),
+                                                     ("Total Deposits", f"+${context['total_in']:,.2f}"),
+                                                     ("Total Withdrawals", f"-${context['total_out']:,.2f}"),
+                                                     ("Ending Balance", f"${context['closing_balance']:,.2f}"))):
+                doc.text(50 + column * 130, y, label.upper(), 7, 'F2', 0.4)
+                doc.text(50 + column * 130, y + 15, value, 11, 'F2')
+            y += 45
+        doc.text(50, y, "DATE", 8, 'F2', 0.4)
+        doc.text(110, y, "DESCRIPTION", 8, 'F2', 0.4)
+        doc.text(390, y, "REFERENCE", 8, 'F2', 0.4)
+        doc.text(520, y, "AMOUNT", 8, 'F2', 0.4)
+        doc.rule(50, 562, y + 6)
+        y += 20
+        for t in rows:
+            incoming = t.receiver_id == user.id
+            doc.text(50, y, f"{timezone.localtime(t.date):%b %d}", 9)
+            doc.text(110, y, describe(t, user)[:48], 9)
+            doc.text(390, y, f"#TRX-{t.id}9928", 8, 'F3')
+            doc.text_right(562, y, f"{'+' if incoming else '-'}${t.amount:,.2f}", 9)
+            y += 14
+        if not txns:
+            doc.text(200, y, "No transactions recorded for this period.", 9, gray=0.6)
+        doc.rule(50, 562, 740)
+        doc.text(50, 755, "Veltris Bank N.A. Member FDIC. Equal Housing Lender. Electronically generated, valid without signature.", 7, gray=0.5)
+        doc.text(50, 765, f"Generated on {timezone.localtime():%B %d, %Y at %H:%M}", 7, gray=0.5)
+        doc.text(520, 765, f"Page {number} of {len(pages)}", 7, gray=0.5)
+    return doc.render()
+
+def render(user, month, fmt):
+    context = statement_context(user, month)
+    return render_pdf(context) if fmt == 'pdf' else render_html(context)
+
+
+def lookup(user, month):
+    """The stored artifact for a closed month, or None (open month, or not rendered yet)."""
+    if month > checkpoints.last_closed_month(): return None
+    return StatementArtifact.objects.filter(user=user, month=month).first()
+
+def load(user, month, fmt, artifact=None):
+    """(content bytes, quoted ETag or None) for a statement; closed months are rendered at most once."""
+    if month > checkpoints.last_closed_month():
+        return render(user, month, fmt), None
+    if artifact:
+        try:
+            with open(_path(user.pk, month, fmt), 'rb') as f: return f.read(), artifact.etag(fmt)
+        except FileNotFoundError:
+            pass # Local disk was wiped (e.g. a redeploy): render again below
+
+    stored, content = _store(user, month, statement_context(user, month))
+    artifact, _ = StatementArtifact.objects.update_or_create(
+        user=user, month=month, defaults={'html_etag': stored.html_etag, 'pdf_etag': stored.pdf_etag})
+    return content[fmt], artifact.etag(fmt)
+
+def _store(user, month, context):
+    # Writes both formats to disk; the caller saves the returned (unsaved) artifact row
+    content = {'html': render_html(context), 'pdf': render_pdf(context)}
+    for kind, data in content.items():
+        _write(_path(user.pk, month, kind), data)
+    artifact = StatementArtifact(user=user, month=month, html_etag=_etag(content['html']), pdf_etag=_etag(content['pdf']))
+    return artifact, content
+
+
+def user_chunks(month, size=CHUNK_SIZE):
+    """(first_id, last_id) ranges of account holders, `size` users each, for generate_chunk()."""
+    ids = list(User.objects.filter(account__isnull=False).order_by('id').values_list('id', flat=True))
+    return [(ids[i], ids[min(i + size, len(ids)) - 1]) for i in range(0, len(ids), size)]
+
+def generate_chunk(month, first_id, last_id, force=False):
+    """Renders and stores the `month` statements of every user in [first_id, last_id] with activity that month.
+
+    A fixed handful of queries per chunk (artifacts, transactions, users, checkpoints, one
+    upsert) instead of several per user. Users already stored are skipped unless `force`,
+    so an interrupted run picks up where it stopped. Returns (stored, skipped).
+    """
+    start, end = checkpoints.month_bounds(month)
+    in_range = lambda side: Q(**{f"{side}_id__gte": first_id, f"{side}_id__lte": last_id})
+    done = set() if force else {user_id for user_id in StatementArtifact.objects.filter(
+        month=month, user_id__gte=first_id, user_id__lte=last_id).values_list('user_id', flat=True)
+        if os.path.exists(_path(user_id, month, 'pdf'))}
+
+    by_user = defaultdict(list)
+    for t in _month_rows(in_range('sender') | in_range('receiver'), month):
+        for user_id in {t.sender_id, t.receiver_id}:
+            if user_id and first_id <= user_id <= last_id and user_id not in done: by_user[user_id].append(t)
+    if not by_user: return 0, len(done)
+
+    users = User.objects.filter(account__isnull=False).select_related('account').in_bulk(list(by_user))
+    # close_month leaves a previous-month checkpoint for everyone with history; the rest (new customers) are summed together
+    openings = dict(BalanceCheckpoint.objects.filter(user_id__in=list(users), month=checkpoints.previous_month(month))
+                    .values_list('user_id', 'balance'))
+    missing = set(users) - set(openings)
+    if missing:
+        openings.update(checkpoints.net_by_user(Transaction.objects.filter(Q(sender_id__in=missing) | Q(receiver_id__in=missing), date__lt=start), missing))
+    artifacts = [_store(user, month, _context(user, month, by_user[user_id], openings.get(user_id, ZERO)))[0] for user_id, user in users.items()]
+    StatementArtifact.objects.bulk_create(artifacts, update_conflicts=True, unique_fields=['user', 'month'],
+                                          update_fields=['html_etag', 'pdf_etag', 'rendered_at'])
+    return len(artifacts), len(done)
+
+
+def invalidate(user_id, month):
+    """Drops a user's stored statements from `month` on. Returns how many months were dropped."""
+    artifacts = StatementArtifact.objects.filter(user_id=user_id, month__gte=month)
+    months = list(artifacts.values_list('month', flat=True))
+    if not months: return 0
+    artifacts.delete()
+
+    def remove_files():
+        for stale in months:
+            for fmt in FORMATS:
+                try: os.remove(_path(user_id, stale, fmt))
+                except FileNotFoundError: pass
+    # A rolled-back edit keeps its rows; load() re-renders if their files are already gone
+    transaction.on_commit(remove_files)
+    return len(months)
+
+def record_change(before, after):
+    """Invalidates stored statements touched by a transaction insert, edit or delete.
+
+    before/after are Transaction.tracked_state() dicts; None means the row did not exist.
+    """
+    if before and after and all(before[f] == after[f] for f in RENDERED_FIELDS): return
+    closed = checkpoints.last_closed_month()
+    for state in (before, after):
+        if not state: continue
+        month = checkpoints.month_start(state['date'])
+        if month > closed: continue # Open months are never stored
+        for user_id in {state['sender_id'], state['receiver_id']} - {None}:
+            invalidate(user_id, month)
@@ -1,3 +1,1569 @@
-from django.test import TestCase
+import asyncio
+import random
+import shutil
+import tempfile
+import threading
+import time
+from datetime import date, datetime, timedelta
+from decimal import Decimal
+from io import StringIO
+from itertools import product
+from unittest import mock, skipUnless
 
-# Create your tests here.
+from asgiref.sync import sync_to_async
+
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import connection, transaction
+from django.db.models import Q, Sum
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from . import accrual, approvals, archive, checkpoints, events, ledger, loans, notifications, partitions, queries, recipients, rollups, scoring, search, settlement, statements, velocity
+from .models import Account, ArchivedTransaction, BalanceCheckpoint, CreditScoreRun, LedgerEntry, Loan, LoanAccrual, LoanInstallment, MonthlyRollup, Notification, StatementArtifact, SupportMessage, SupportSession, Transaction
+
+
+def make_user(username, balance='0.00', **extra):
+    user = User.objects.create_user(username=username, first_name=username.title(), last_name='Tester')
+    account = Account.objects.create(user=user, account_number=str(abs(hash(username)))[:10], transaction_pin='1234', **extra)
+    if Decimal(balance): ledger.credit(account, Decimal(balance), 'Test funding')
+    return user
+
+
+def at(year, month, day=15):
+    return timezone.make_aware(datetime(year, month, day, 12))
+
+
+def explain(queryset):
+    """Query plan with index names as declared: on a partitioned table each partition's index is named after its parent's."""
+    if connection.vendor != 'postgresql': return queryset.explain()
+    with connection.cursor() as cursor:
+        cursor.execute('SET LOCAL enable_seqscan = off') # Make the planner's choice about index usability, not table size
+        cursor.execute("SELECT child.relname, parent.relname FROM pg_inherits i JOIN pg_class child ON child.oid = i.inhrelid "
+                       "JOIN pg_class parent ON parent.oid = i.inhparent WHERE parent.relkind = 'I'")
+        names = sorted(cursor.fetchall(), key=lambda pair: -len(pair[0]))
+    plan = queryset.explain()
+    for child, parent in names: plan = plan.replace(child, parent)
+    return plan
+
+
+# ==========================================
+# LEDGER
+# ==========================================
+
+class LedgerTests(TestCase):
+    def setUp(self):
+        self.alice = make_user('alice', '100.00')
+        self.bob = make_user('bob')
+
+    def test_transfer_moves_balance_and_journals(self):
+        ledger.transfer(self.alice.account, self.bob.account, Decimal('40.00'), 'Rent')
+        self.assertEqual(Account.objects.get(user=self.alice).balance, Decimal('60.00'))
+        self.assertEqual(Account.objects.get(user=self.bob).balance, Decimal('40.00'))
+        # Every posting nets to zero, including the clearing side
+        self.assertEqual(LedgerEntry.objects.aggregate(s=Sum('amount'))['s'], Decimal('0.00'))
+
+    def test_insufficient_funds_leaves_no_trace(self):
+        entries = LedgerEntry.objects.count()
+        with self.assertRaises(ledger.InsufficientFunds):
+            ledger.debit(self.bob.account, Decimal('0.01'))
+        self.assertEqual(Account.objects.get(user=self.bob).balance, Decimal('0.00'))
+        self.assertEqual(LedgerEntry.objects.count(), entries)
+
+    def test_plain_save_never_overwrites_balance(self):
+        stale = Account.objects.get(user=self.alice)
+        ledger.credit(self.alice.account, Decimal('5.00'))
+        stale.dark_mode = True
+        stale.save()
+        self.assertEqual(Account.objects.get(user=self.alice).balance, Decimal('105.00'))
+
+    def test_entries_are_append_only(self):
+        entry = LedgerEntry.objects.first()
+        entry.amount = 0
+        with self.assertRaises(ValueError): entry.save()
+        with self.assertRaises(ValueError): entry.delete()
+
+
+# Threaded tests exercise row locks (SELECT .. FOR UPDATE [SKIP LOCKED]) on Postgres. SQLite has none: on its
+# file test database (core/settings.py) writers queue on the database lock, and conflicts are retried.
+class LedgerConcurrencyTests(TransactionTestCase):
+    WORKERS = 8
+    TRANSFERS_PER_WORKER = 25
+
+    def test_parallel_transfers_conserve_money(self):
+        users = [make_user(f"stress{i}", '1000.00') for i in range(6)]
+        account_ids = [u.account.pk for u in users]
+        total_before = Account.objects.aggregate(s=Sum('balance'))['s']
+        done, errors = [], []
+
+        def worker(seed):
+            rng = random.Random(seed)
+            try:
+                for _ in range(self.TRANSFERS_PER_WORKER):
+                    src, dst = rng.sample(account_ids, 2)
+                    try:
+                        ledger.transfer(src, dst, Decimal(rng.randint(1, 400)))
+                        done.append(1)
+                    except ledger.InsufficientFunds:
+                        pass
+            except Exception as exc:
+                errors.append(exc)
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=worker, args=(n,)) for n in range(self.WORKERS)]
+        started = time.perf_counter()
+        for t in threads: t.start()
+        for t in threads: t.join()
+        elapsed = time.perf_counter() - started
+        print(f"\nledger: {len(done)} transfers across {self.WORKERS} threads in {elapsed:.2f}s ({len(done) / elapsed:,.0f} transfers/s)")
+
+        self.assertEqual(errors, [])
+        self.assertTrue(done)
+        self.assertEqual(Account.objects.aggregate(s=Sum('balance'))['s'], total_before)
+        for account in Account.objects.all():
+            self.assertGreaterEqual(account.balance, 0)
+            self.assertEqual(account.ledger_entries.aggregate(s=Sum('amount'))['s'], account.balance)
+        # Exactly one posting per transfer that went through (plus the funding credits)
+        self.assertEqual(LedgerEntry.objects.values('posting_id').distinct().count(), len(done) + len(users))
+
+
+# ==========================================
+# STATEMENT CHECKPOINTS
+# ==========================================
+
+class CheckpointTests(TestCase):
+    def setUp(self):
+        self.alice = make_user('alice')
+        self.bob = make_user('bob')
+        for month in (1, 2, 3):
+            Transaction.objects.create(sender=None, receiver=self.alice, amount=Decimal('100.00'), transaction_type='deposit', status='success', date=at(2024, month))
+            Transaction.objects.create(sender=self.alice, receiver=self.bob, amount=Decimal('30.00'), status='success', date=at(2024, month))
+
+    def full_scan(self, user, month):
+        start = checkpoints.month_bounds(month)[0]
+        received = Transaction.objects.filter(receiver=user, date__lt=start).aggregate(s=Sum('amount'))['s'] or 0
+        sent = Transaction.objects.filter(sender=user, date__lt=start).aggregate(s=Sum('amount'))['s'] or 0
+        return received - sent
+
+    def test_opening_balance_matches_full_history(self):
+        call_command('close_month', month='2024-02', backfill=True, stdout=StringIO())
+        self.assertEqual(BalanceCheckpoint.objects.get(user=self.alice, month=date(2024, 2, 1)).balance, Decimal('140.00'))
+        for month in (date(2024, 2, 1), date(2024, 3, 1), date(2024, 4, 1)):
+            for user in (self.alice, self.bob):
+                self.assertEqual(checkpoints.opening_balance(user, month), self.full_scan(user, month))
+
+    def test_back_dated_edit_shifts_later_checkpoints(self):
+        call_command('close_month', month='2024-03', backfill=True, stdout=StringIO())
+        txn = Transaction.objects.filter(receiver=self.bob).latest('date')
+        txn.date = at(2024, 1, 2)
+        txn.save()
+        Transaction.objects.create(sender=None, receiver=self.bob, amount=Decimal('7.00'), transaction_type='deposit', date=at(2024, 2))
+        Transaction.objects.filter(sender=self.alice, date__month=2).get().delete()
+        for month in (date(2024, 2, 1), date(2024, 3, 1), date(2024, 4, 1)):
+            for user in (self.alice, self.bob):
+                self.assertEqual(checkpoints.opening_balance(user, month), self.full_scan(user, month))
+
+    def test_statement_opening_uses_checkpoint(self):
+        call_command('close_month', month='2024-03', backfill=True, stdout=StringIO())
+        self.client.force_login(self.alice)
+        response = self.client.get('/statement/', {'month': '2024-03-01'})
+        self.assertEqual(response.context['beginning_balance'], Decimal('140.00'))
+
+
+class StatementCacheTests(TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root, ignore_errors=True)
+        self.enterContext(override_settings(STATEMENT_ROOT=self.root))
+        self.alice = make_user('alice')
+        self.bob = make_user('bob')
+        for month in (1, 2, 3):
+            Transaction.objects.create(sender=None, receiver=self.alice, amount=Decimal('100.00'), transaction_type='deposit', status='success', date=at(2024, month))
+            Transaction.objects.create(sender=self.alice, receiver=self.bob, amount=Decimal('30.00'), status='success', date=at(2024, month))
+        self.client.force_login(self.alice)
+
+    def get(self, month, **extra):
+        return self.client.get('/statement/', {'month': month, **extra.pop('params', {})}, **extra)
+
+    def test_closed_month_renders_once(self):
+        first = self.get('2024-02-01')
+        self.assertEqual(first.context['closing_balance'], Decimal('140.00'))
+        self.assertTrue(StatementArtifact.objects.filter(user=self.alice, month=date(2024, 2, 1)).exists())
+
+        with CaptureQueriesContext(connection) as queries_run:
+            second = self.get('2024-02-01')
+        self.assertFalse([q for q in queries_run.captured_queries if 'account_transaction' in q['sql']])
+        self.assertEqual(second.templates, [])
+        self.assertEqual(second.content, first.content)
+        self.assertEqual(second['ETag'], first['ETag'])
+        self.assertEqual(self.get('2024-02-01', HTTP_IF_NONE_MATCH=first['ETag']).status_code, 304)
+
+    def test_pdf_is_stored_alongside_html(self):
+        html = self.get('2024-02-01')
+        pdf = self.get('2024-02-01', params={'format': 'pdf'})
+        self.assertEqual(pdf['Content-Type'], 'application/pdf')
+        self.assertTrue(pdf.content.startswith(b'%PDF-'))
+        self.assertIn(b'$140.00', pdf.content)
+        self.assertNotEqual(pdf['ETag'], html['ETag'])
+        self.assertEqual(pdf.templates, []) # Rendered together with the HTML on the first request
+
+    def test_back_dated_edit_invalidates_from_its_month(self):
+        for month in ('2024-01-01', '2024-02-01', '2024-03-01'): self.get(month)
+        txn = Transaction.objects.get(sender=self.alice, date=at(2024, 2))
+        txn.amount = Decimal('50.00')
+        txn.save()
+        self.assertEqual(list(StatementArtifact.objects.filter(user=self.alice).values_list('month', flat=True)), [date(2024, 1, 1)])
+        self.assertEqual(self.get('2024-03-01').context['beginning_balance'], Decimal('120.00'))
+
+        # Status is not printed, so settling or rejecting a row keeps the stored statements
+        txn.status = 'failed'
+        txn.save()
+        self.assertEqual(StatementArtifact.objects.filter(user=self.alice).count(), 2)
+
+    def test_generate_statements_command(self):
+        for n in range(20): # Extra customers with February activity, to show queries do not grow per user
+            Transaction.objects.create(sender=None, receiver=make_user(f'user{n}'), amount=Decimal('10.00'), transaction_type='deposit', status='success', date=at(2024, 2))
+        call_command('close_month', month='2024-01', backfill=True, stdout=StringIO())
+        with CaptureQueriesContext(connection) as queries_run:
+            out = StringIO()
+            call_command('generate_statements', month='2024-02', workers=1, stdout=out)
+        self.assertIn('stored 22 statements', out.getvalue())
+        self.assertLess(len(queries_run), 10)
+        self.assertEqual(StatementArtifact.objects.filter(month=date(2024, 2, 1)).count(), 22)
+
+        response = self.get('2024-02-01')
+        self.assertEqual(response.templates, []) # Served from storage
+        self.assertIn(b'$140.00', response.content)
+
+        out = StringIO()
+        call_command('generate_statements', since='2024-01', month='2024-02', workers=1, stdout=out) # Resumes: February is done
+        self.assertIn('2024-01: stored 2 statements', out.getvalue())
+        self.assertIn('2024-02: stored 0 statements, 22 already done', out.getvalue())
+
+    def test_open_month_is_rendered_live(self):
+        Transaction.objects.create(sender=None, receiver=self.alice, amount=Decimal('5.00'), transaction_type='deposit', status='success')
+        response = self.get(timezone.now().strftime('%Y-%m-01'))
+        self.assertFalse(response.has_header('ETag'))
+        self.assertFalse(StatementArtifact.objects.exists())
+
+
+# ==========================================
+# MONTHLY ROLLUPS
+# ==========================================
+
+class RollupTests(TestCase):
+    def setUp(self):
+        self.alice = make_user('alice')
+        self.bob = make_user('bob')
+        Transaction.objects.create(sender=None, receiver=self.alice, amount=Decimal('500.00'), transaction_type='deposit', status='success', date=at(2024, 1))
+        Transaction.objects.create(sender=self.alice, receiver=self.bob, amount=Decimal('50.00'), status='success', date=at(2024, 2))
+        Transaction.objects.create(sender=self.alice, amount=Decimal('80.00'), transaction_type='wire', status='processing', date=at(2024, 2))
+
+    def snapshot(self):
+        return sorted(MonthlyRollup.objects.filter(count__gt=0).values_list('user_id', 'month', 'direction', 'transaction_type', 'count', 'total'))
+
+    def test_incremental_matches_rebuild(self):
+        wire = Transaction.objects.get(transaction_type='wire')
+        wire.status = 'success'; wire.save()
+        moved = Transaction.objects.get(transaction_type='transfer')
+        moved.date = at(2024, 3); moved.amount = Decimal('55.00'); moved.save()
+        Transaction.objects.get(transaction_type='deposit').delete()
+        incremental = self.snapshot()
+        rollups.rebuild()
+        self.assertEqual(incremental, self.snapshot())
+
+    def test_only_successful_transactions_count(self):
+        self.assertEqual(rollups.month_totals(self.alice, date(2024, 2, 1)), (Decimal('0.00'), Decimal('50.00')))
+        self.assertEqual(list(rollups.active_months(self.bob)), [date(2024, 2, 1)])
+
+    def test_views_read_rollups(self):
+        self.client.force_login(self.alice)
+        response = self.client.get('/analytics/')
+        self.assertEqual((response.context['money_in'], response.context['money_out'], response.context['transfer_total']), (Decimal('500.00'), Decimal('50.00'), Decimal('50.00')))
+        response = self.client.get('/documents/')
+        self.assertEqual(list(response.context['txn_dates']), [date(2024, 2, 1), date(2024, 1, 1)])
+
+    def test_months_without_successful_rows_stay_listed(self):
+        Transaction.objects.create(sender=self.alice, amount=Decimal('20.00'), transaction_type='wire', status='failed', date=at(2024, 4))
+        self.assertEqual(rollups.active_months(self.alice), [date(2024, 4, 1), date(2024, 2, 1), date(2024, 1, 1)])
+        self.assertEqual(rollups.month_totals(self.alice, date(2024, 4, 1)), (Decimal('0.00'), Decimal('0.00')))
+
+
+# ==========================================
+# TRANSACTION INDEXES
+# ==========================================
+
+class TransactionIndexTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.users = [make_user(f"idx{i}") for i in range(20)]
+        for year, month in product((2023, 2024, 2025), range(1, 13)):
+            if partitions.is_partitioned(): partitions.create(date(year, month, 1))
+        rng = random.Random(4)
+        Transaction.objects.bulk_create([
+            Transaction(sender=rng.choice(cls.users), receiver=rng.choice(cls.users), amount=Decimal(rng.randint(1, 500)),
+                        status=rng.choice(['success'] * 9 + ['processing']), date=at(2023 + n % 3, n % 12 + 1, n % 28 + 1))
+            for n in range(2000)
+        ])
+        with connection.cursor() as cursor:
+            cursor.execute('ANALYZE')
+
+    def plan(self, queryset):
+        return explain(queryset)
+
+    def test_history_reads_walk_the_composite_indexes(self):
+        user = self.users[0]
+        self.assertIn('txn_sender_date_idx', self.plan(Transaction.objects.filter(sender=user).order_by('-date', '-id')[:20]))
+        self.assertIn('txn_receiver_date_idx', self.plan(Transaction.objects.filter(receiver=user).order_by('-date', '-id')[:20]))
+
+    def test_settlement_scan_uses_partial_index(self):
+        self.assertIn('txn_processing_due_idx', self.plan(Transaction.objects.filter(status='processing', date__lt=at(2024, 6))))
+
+    def test_recent_transactions_matches_or_query(self):
+        for user in self.users[:5]:
+            expected = list(Transaction.objects.filter(Q(sender=user) | Q(receiver=user)).order_by('-date', '-id')[:7])
+            self.assertEqual(queries.recent_transactions(user, 7), expected)
+
+    def test_cursor_pages_cover_history_once(self):
+        user = self.users[1]
+        for side, filters in ((None, Q(sender=user) | Q(receiver=user)), ('received', Q(receiver=user))):
+            pages, cursor = [], None
+            while True:
+                page, cursor = queries.transaction_page(user, 7, queries.decode_cursor(cursor), side=side)
+                pages += page
+                if not cursor: break
+            self.assertEqual(pages, list(Transaction.objects.filter(filters).order_by('-date', '-id')))
+
+    def test_deep_pages_stay_on_the_index(self):
+        user = self.users[0]
+        oldest = Transaction.objects.filter(sender=user).order_by('date', 'id')[5]
+        deep = queries.older_than(Transaction.objects.filter(sender=user), (oldest.date, oldest.id)).order_by('-date', '-id')[:21]
+        plan = self.plan(deep)
+        self.assertIn('txn_sender_date_idx', plan)
+        self.assertNotIn('OFFSET', str(deep.query).upper())
+
+    def test_history_api_uses_cursor_without_count(self):
+        self.client.force_login(self.users[2])
+        seen, cursor = [], ''
+        with CaptureQueriesContext(connection) as captured:
+            while True:
+                data = self.client.get('/api/history/', {'cursor': cursor}).json()
+                seen += [t['id'] for t in data['transactions']]
+                cursor = data['next_cursor']
+                if not data['has_next']: break
+        self.assertEqual(len(seen), len(set(seen)))
+        self.assertEqual(len(seen), queries.user_transactions(self.users[2]).count())
+        self.assertFalse([q['sql'] for q in captured if 'COUNT(' in q['sql'].upper() or 'OFFSET' in q['sql'].upper()])
+        self.assertEqual(self.client.get('/api/history/', {'cursor': 'garbage!'}).json()['transactions'][0]['id'], seen[0])
+
+
+# ==========================================
+# SETTLEMENT WORKER
+# ==========================================
+
+def queue_pending_transfers(sender, receivers, amount='10.00', minutes_ago=30):
+    """Books 'processing' internal transfers the way execute_transfer does (sender debited, receiver not yet)."""
+    txns = []
+    for receiver in receivers:
+        txn = Transaction.objects.create(sender=sender, receiver=receiver, amount=Decimal(amount), status='processing', date=timezone.now() - timedelta(minutes=minutes_ago))
+        ledger.debit(sender.account, Decimal(amount), txn=txn)
+        txns.append(txn)
+    return txns
+
+class SettlementTests(TestCase):
+    def setUp(self):
+        self.alice = make_user('alice', '1000.00')
+        self.bob = make_user('bob')
+
+    def test_settles_due_transfers_and_credits_receiver(self):
+        queue_pending_transfers(self.alice, [self.bob] * 3)
+        fresh = queue_pending_transfers(self.alice, [self.bob], minutes_ago=1)[0]
+        with self.captureOnCommitCallbacks(execute=True):
+            self.assertEqual(settlement.settle_due(batch_size=2), 3)
+        self.assertEqual(Account.objects.get(user=self.bob).balance, Decimal('30.00'))
+        self.assertEqual(Transaction.objects.get(pk=fresh.pk).status, 'processing')
+        self.assertEqual(Notification.objects.filter(user=self.bob).count(), 3)
+        self.assertEqual(rollups.month_totals(self.bob, checkpoints.month_start(timezone.now()))[0], Decimal('30.00'))
+        self.assertEqual(settlement.settle_due(), 0)
+
+    def test_dashboard_does_no_settlement(self):
+        queue_pending_transfers(self.alice, [self.bob])
+        self.client.force_login(self.alice)
+        self.client.get('/dashboard/')
+        self.assertEqual(Transaction.objects.filter(status='processing').count(), 1)
+
+
+class SettlementConcurrencyTests(TransactionTestCase):
+    def test_parallel_workers_settle_each_transaction_once(self):
+        alice = make_user('alice', '5000.00')
+        receivers = [make_user(f"r{i}") for i in range(5)]
+        queue_pending_transfers(alice, receivers * 40)
+        settled, errors = [], []
+
+        def worker():
+            try: settled.append(settlement.settle_due(batch_size=15))
+            except Exception as exc: errors.append(exc)
+            finally: connection.close()
+
+        threads = [threading.Thread(target=worker) for _ in range(4)]
+        for t in threads: t.start()
+        for t in threads: t.join()
+
+        self.assertEqual(errors, [])
+        self.assertEqual(sum(settled), 200)
+        self.assertFalse(Transaction.objects.filter(status='processing').exists())
+        for receiver in receivers:
+            self.assertEqual(Account.objects.get(user=receiver).balance, Decimal('400.00'))
+
+
+# ==========================================
+# APPROVALS
+# ==========================================
+
+class ApprovalTests(TestCase):
+    def setUp(self):
+        self.alice = make_user('alice')
+
+    def test_status_change_is_diffed_without_a_select(self):
+        deposit = Transaction.objects.create(receiver=self.alice, amount=Decimal('50.00'), transaction_type='deposit', status='pending')
+        deposit = Transaction.objects.get(pk=deposit.pk)
+        deposit.status = 'success'
+        with CaptureQueriesContext(connection) as ctx, self.captureOnCommitCallbacks() as callbacks:
+            deposit.save()
+        self.assertFalse([q['sql'] for q in ctx.captured_queries if q['sql'].startswith('SELECT') and 'FROM "account_transaction"' in q['sql']])
+        self.assertEqual(Account.objects.get(user=self.alice).balance, Decimal('50.00'))
+
+        # Notices wait for the commit
+        self.assertFalse(Notification.objects.filter(user=self.alice).exists())
+        for callback in callbacks: callback()
+        self.assertIn('SUCCESS', Notification.objects.get(user=self.alice).message)
+
+        # Saving again changes nothing further
+        deposit.note = 'Checked'
+        with self.captureOnCommitCallbacks() as callbacks: deposit.save()
+        self.assertEqual(callbacks, [])
+        self.assertEqual(Account.objects.get(user=self.alice).balance, Decimal('50.00'))
+
+    def test_loan_approval_disburses_once(self):
+        loan = Loan.objects.create(user=self.alice, amount=Decimal('1000.00'), purpose='Car')
+        loan = Loan.objects.get(pk=loan.pk)
+        loan.status = 'approved'
+        with self.captureOnCommitCallbacks(execute=True): loan.save()
+        loan.save()
+        self.assertEqual(Loan.objects.get(pk=loan.pk).total_repayment, loans.quote(Decimal('1000.00'), 12)[2])
+        self.assertEqual(loan.installments.count(), 12)
+        self.assertEqual(Account.objects.get(user=self.alice).balance, Decimal('1000.00'))
+        self.assertEqual(Transaction.objects.filter(receiver=self.alice, transaction_type='loan').count(), 1)
+        self.assertEqual(Notification.objects.filter(user=self.alice).count(), 1)
+
+    def test_failed_disbursement_keeps_loan_pending(self):
+        bob = User.objects.create_user(username='bob')
+        loan = Loan.objects.create(user=bob, amount=Decimal('500.00'), purpose='Rent')
+        loan.status = 'approved'
+        with self.assertRaises(ledger.LedgerError): loan.save()
+        self.assertEqual(Loan.objects.get(pk=loan.pk).status, 'pending')
+        self.assertFalse(Transaction.objects.filter(receiver=bob).exists())
+
+
+class BulkApprovalTests(TestCase):
+    def setUp(self):
+        self.users = [make_user(f'user{i}') for i in range(3)]
+
+    def queue_deposits(self, count):
+        return [Transaction.objects.create(receiver=self.users[i % 3], amount=Decimal('10.00'), transaction_type='deposit', status='pending') for i in range(count)]
+
+    def test_query_count_does_not_grow_with_rows(self):
+        counts = []
+        for rows in (5, 50):
+            self.queue_deposits(rows)
+            with CaptureQueriesContext(connection) as ctx, self.captureOnCommitCallbacks(execute=True):
+                self.assertEqual(approvals.approve_transactions(Transaction.objects.filter(status='pending')), rows)
+            counts.append(len(ctx.captured_queries))
+        self.assertEqual(counts[0], counts[1])
+        self.assertEqual(Account.objects.get(user=self.users[0]).balance, Decimal('190.00'))
+        self.assertEqual(LedgerEntry.objects.filter(memo__startswith='Deposit', account__isnull=False).count(), 55)
+        self.assertEqual(Notification.objects.count(), 55)
+        self.assertEqual(rollups.month_totals(self.users[0], checkpoints.month_start(timezone.now()))[0], Decimal('190.00'))
+
+    def test_deposits_without_an_account_stay_pending(self):
+        orphan = User.objects.create_user(username='orphan')
+        stuck = Transaction.objects.create(receiver=orphan, amount=Decimal('5.00'), transaction_type='deposit', status='pending')
+        self.queue_deposits(3)
+        self.assertEqual(approvals.approve_transactions(Transaction.objects.all(), batch_size=2), 3)
+        self.assertEqual(Transaction.objects.get(pk=stuck.pk).status, 'pending')
+
+    def test_approving_held_transfers_pays_the_receiver(self):
+        sender = make_user('sender', '5000.00')
+        held = queue_pending_transfers(sender, self.users[:2], amount='2000.00', minutes_ago=1)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.assertEqual(approvals.approve_transactions(Transaction.objects.filter(pk=held[0].pk)), 1)
+        self.assertEqual(Account.objects.get(user=sender).balance, Decimal('1000.00'))
+        self.assertEqual(Account.objects.get(user=self.users[0]).balance, Decimal('2000.00'))
+        self.assertIn('Credit Alert', Notification.objects.get(user=self.users[0]).message)
+
+        # A single save does the same; settlement then finds nothing left to pay
+        txn = Transaction.objects.get(pk=held[1].pk)
+        txn.status = 'success'
+        txn.save()
+        self.assertEqual(Account.objects.get(user=self.users[1]).balance, Decimal('2000.00'))
+        self.assertEqual(settlement.settle_due(now=timezone.now() + timedelta(days=1)), 0)
+        self.assertEqual(LedgerEntry.objects.aggregate(s=Sum('amount'))['s'], Decimal('0.00'))
+
+    def test_settled_rows_are_never_paid_twice(self):
+        sender = make_user('sender', '5000.00')
+        held = queue_pending_transfers(sender, [self.users[0]], amount='2000.00')[0]
+        deposit = self.queue_deposits(1)[0]
+        settlement.settle_due()
+        approvals.approve_transactions(Transaction.objects.filter(pk=deposit.pk))
+
+        # Moving a successful row back is refused, whether to be settled or approved again
+        for txn, status in ((held, 'processing'), (deposit, 'pending')):
+            txn = Transaction.objects.get(pk=txn.pk)
+            txn.status = status
+            with self.assertRaises(ledger.LedgerError): txn.save()
+            self.assertEqual(Transaction.objects.get(pk=txn.pk).status, 'success')
+
+        # A row flipped back behind the signals' back still gets its receiver credit only once
+        Transaction.objects.filter(pk__in=[held.pk, deposit.pk]).update(status='processing')
+        self.assertEqual(settlement.settle_due(), 1)
+        Transaction.objects.filter(pk=held.pk).update(status='processing')
+        self.assertEqual(approvals.approve_transactions(Transaction.objects.filter(pk__in=[held.pk, deposit.pk])), 2)
+        self.assertEqual(Account.objects.get(user=sender).balance, Decimal('3000.00'))
+        self.assertEqual(Account.objects.get(user=self.users[0]).balance, Decimal('2010.00'))
+        self.assertEqual(LedgerEntry.objects.aggregate(s=Sum('amount'))['s'], Decimal('0.00'))
+
+    def test_rejection_reverses_what_was_booked(self):
+        sender = make_user('sender', '5000.00')
+        held = queue_pending_transfers(sender, [self.users[0]], amount='2000.00')[0]
+        paid = Transaction.objects.create(sender=sender, receiver=self.users[1], amount=Decimal('300.00'), transaction_type='transfer', status='success')
+        ledger.transfer(sender.account, self.users[1].account, Decimal('300.00'), txn=paid)
+        deposit = self.queue_deposits(1)[0] # Pending: nothing booked yet
+
+        admin_user = User.objects.create_superuser('boss', 'boss@example.com', 'pw')
+        self.client.force_login(admin_user)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post('/admin/account/transaction/', {'action': 'reject_transactions', '_selected_action': [held.pk, paid.pk, deposit.pk]})
+        self.assertEqual(set(Transaction.objects.filter(pk__in=[held.pk, paid.pk, deposit.pk]).values_list('status', flat=True)), {'failed'})
+        self.assertEqual(Account.objects.get(user=sender).balance, Decimal('5000.00'))
+        self.assertEqual(Account.objects.get(user=self.users[1]).balance, Decimal('0.00'))
+        self.assertEqual(Transaction.objects.filter(transaction_type='refund').count(), 2)
+        self.assertEqual(LedgerEntry.objects.aggregate(s=Sum('amount'))['s'], Decimal('0.00'))
+        # The refund rows keep the statement running balance and the rollups in step with the ledger
+        month = checkpoints.month_start(timezone.now())
+        self.assertEqual(checkpoints.opening_balance(sender, checkpoints.next_month(month)), Decimal('0.00')) # Funded without a row
+        self.assertEqual(rollups.month_totals(self.users[1], month), (Decimal('0.00'), Decimal('300.00')))
+        self.assertIn('Compliance Review Failed', Notification.objects.filter(user=sender).latest('id').message)
+
+        # Refunded rows cannot be approved back into money; settlement skips them too
+        self.assertEqual(approvals.approve_transactions(Transaction.objects.filter(pk=held.pk)), 0)
+        self.assertEqual(settlement.settle_due(now=timezone.now() + timedelta(days=1)), 0)
+        self.assertEqual(Account.objects.get(user=self.users[0]).balance, Decimal('0.00'))
+
+    def test_single_save_to_failed_refunds_the_sender(self):
+        sender = make_user('sender', '5000.00')
+        held = Transaction.objects.get(pk=queue_pending_transfers(sender, [self.users[0]], amount='1500.00')[0].pk)
+        held.status, held.rejection_reason = 'failed', "Suspicious"
+        held.save()
+        self.assertEqual(Account.objects.get(user=sender).balance, Decimal('5000.00'))
+        held.status = 'success'
+        with self.assertRaises(ledger.LedgerError): held.save()
+        self.assertEqual(Transaction.objects.get(pk=held.pk).status, 'failed')
+
+    def test_admin_actions_and_command(self):
+        admin_user = User.objects.create_superuser('boss', 'boss@example.com', 'pw')
+        self.client.force_login(admin_user)
+        applied = [Loan.objects.create(user=user, amount=Decimal('100.00'), purpose='Tools') for user in self.users]
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post('/admin/account/loan/', {'action': 'approve_loans', '_selected_action': [l.pk for l in applied]})
+        self.assertFalse(Loan.objects.exclude(status='approved').exists())
+        self.assertEqual(set(Loan.objects.values_list('total_repayment', flat=True)), {loans.quote(Decimal('100.00'), 12)[2]})
+        self.assertEqual(LoanInstallment.objects.count(), 36)
+        self.assertEqual(Account.objects.get(user=self.users[1]).balance, Decimal('100.00'))
+        self.assertEqual(len(search.search(self.users[1], 'tools')), 1)
+
+        deposits = self.queue_deposits(3)
+        out = StringIO()
+        call_command('approve_pending', 'transactions', '--type', 'deposit', stdout=out)
+        self.assertIn('Approved 3 transactions', out.getvalue())
+        self.assertFalse(Transaction.objects.filter(pk__in=[t.pk for t in deposits], status='pending').exists())
+
+
+class LoanScheduleTests(TestCase):
+    def setUp(self):
+        self.alice = make_user('alice', '5000.00')
+
+    def approve(self, amount='1200.00', term=12):
+        loan = Loan.objects.create(user=self.alice, amount=Decimal(amount), term_months=term, purpose='Car')
+        loan.status = 'approved'
+        loan.save()
+        return Loan.objects.get(pk=loan.pk)
+
+    def test_schedule_amortizes_to_the_cent(self):
+        for amount, term in (('1200.00', 12), ('5000.00', 24), ('999.99', 36)):
+            loan = self.approve(amount, term)
+            rows = list(loan.installments.all())
+            self.assertEqual([r.number for r in rows], list(range(1, term + 1)))
+            self.assertEqual(sum(r.principal for r in rows), loan.amount)
+            self.assertEqual(sum(r.payment for r in rows), loan.total_repayment)
+            self.assertEqual(loan.apr, loans.apr_for(term))
+            # Fixed payment; only the last one absorbs rounding
+            self.assertEqual({r.payment for r in rows[:-1]}, {loans.monthly_payment(loan.amount, loan.apr, term)})
+            self.assertEqual(rows[1].due_date, loans.add_months(rows[0].due_date, 1))
+
+    def test_repayments_cover_interest_first_and_pay_off(self):
+        loan = self.approve()
+        first = loan.installments.get(number=1)
+        self.client.force_login(self.alice)
+        self.client.post('/loans/', {'action': 'repay', 'pin': '1234', 'loan_id': loan.pk, 'repay_amount': '5.00'})
+        first.refresh_from_db()
+        self.assertEqual((first.interest_paid, first.principal_paid, first.paid_at), (min(first.interest, Decimal('5.00')), Decimal('5.00') - min(first.interest, Decimal('5.00')), None))
+
+        self.client.post('/loans/', {'action': 'repay', 'pin': '1234', 'loan_id': loan.pk, 'repay_amount': str(loan.total_repayment)})
+        self.assertEqual(Loan.objects.get(pk=loan.pk).amount_paid, Decimal('5.00')) # Over the balance: refused
+        self.client.post('/loans/', {'action': 'repay', 'pin': '1234', 'loan_id': loan.pk, 'repay_amount': str(loan.total_repayment - Decimal('5.00'))})
+        self.assertEqual(Loan.objects.get(pk=loan.pk).status, 'paid')
+        self.assertFalse(loan.installments.filter(paid_at__isnull=True).exists())
+
+    def test_projection_matches_the_schedules(self):
+        for amount, term in (('1200.00', 12), ('3000.00', 24), ('700.00', 36)):
+            self.approve(amount, term)
+        start = timezone.localdate().replace(day=1)
+        forecast = loans.project(6, start)
+        for i, month in enumerate(forecast['months']):
+            due = LoanInstallment.objects.filter(due_date__year=month.year, due_date__month=month.month)
+            self.assertEqual(forecast['principal'][i], sum((r.principal for r in due), Decimal('0.00')))
+            self.assertEqual(forecast['interest'][i], sum((r.interest for r in due), Decimal('0.00')))
+        self.assertEqual(forecast['outstanding'][-1], Decimal('4900.00') - sum(forecast['principal']))
+
+        staff = User.objects.create_superuser('opsadmin', 'ops@example.com', None)
+        self.client.force_login(staff)
+        with CaptureQueriesContext(connection) as ctx:
+            data = self.client.get('/ops/api/loan-forecast/', {'months': 6}).json()
+        self.assertEqual(len([q for q in ctx.captured_queries if 'account_loaninstallment' in q['sql']]), 1)
+        self.assertEqual(data['principal'], [str(v) for v in forecast['principal']])
+
+
+class AccrualTests(TestCase):
+    def setUp(self):
+        self.alice = make_user('alice')
+        self.approved_on = date(2025, 1, 10)
+        self.loans = []
+        for amount in ('1200.00', '2400.00', '3650.00'):
+            loan = Loan.objects.create(user=self.alice, amount=Decimal(amount), term_months=12, purpose='Tools')
+            LoanInstallment.objects.bulk_create(loans.schedule(loan, at(2025, 1, 10)))
+            loan.status = 'approved'
+            Loan.objects.filter(pk=loan.pk).update(status='approved', apr=loan.apr, approved_at=loan.approved_at, total_repayment=loan.total_repayment)
+            self.loans.append(loan)
+
+    def accrue(self, day, chunk_size=2):
+        with self.captureOnCommitCallbacks(execute=True):
+            return list(accrual.run(day, chunk_size))
+
+    def test_interest_accrues_once_per_business_date(self):
+        self.assertEqual([count for count, _ in self.accrue(date(2025, 1, 20))], [2, 1])
+        loan = Loan.objects.get(pk=self.loans[2].pk)
+        self.assertEqual(loan.accrued_interest, (Decimal('3650.00') * loan.apr * 10 / 365).quantize(Decimal('0.0001')))
+        self.assertEqual(self.accrue(date(2025, 1, 20)), []) # Rerun: nothing left to do
+        self.accrue(date(2025, 1, 21))
+        entries = LoanAccrual.objects.filter(loan=loan).order_by('business_date')
+        self.assertEqual([(e.days, e.principal) for e in entries], [(10, Decimal('3650.00')), (1, Decimal('3650.00'))])
+        self.assertEqual(Loan.objects.get(pk=loan.pk).accrued_interest, sum(e.interest for e in entries))
+
+    def test_interrupted_run_resumes(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            last, count, _ = accrual.accrue_chunk(date(2025, 1, 20), chunk_size=1)
+        self.assertEqual((last, count), (self.loans[0].pk, 1))
+        self.assertEqual(sum(count for count, _ in self.accrue(date(2025, 1, 20))), 2)
+        self.assertEqual(LoanAccrual.objects.count(), 3)
+
+    def test_delinquency_is_notified_once_per_threshold(self):
+        first_due = self.loans[0].installments.get(number=1).due_date
+        for offset in (0, 1, 2, 29, 30):
+            self.accrue(first_due + timedelta(days=offset), chunk_size=10)
+        self.assertEqual(Loan.objects.get(pk=self.loans[0].pk).days_past_due, 30)
+        # Three loans crossing day 1 and day 30
+        self.assertEqual(Notification.objects.filter(user=self.alice, message__contains='past due').count(), 6)
+
+        # Paying what is overdue clears it on the next run
+        loan, today = Loan.objects.get(pk=self.loans[0].pk), first_due + timedelta(days=31)
+        loans.allocate(loan, sum(i.amount_due for i in loan.installments.filter(due_date__lt=today)))
+        self.accrue(today, chunk_size=10)
+        self.assertEqual(Loan.objects.get(pk=loan.pk).days_past_due, 0)
+
+    def test_queries_per_chunk_are_fixed(self):
+        with CaptureQueriesContext(connection) as ctx:
+            accrual.accrue_chunk(date(2025, 1, 20), chunk_size=10)
+        self.assertLessEqual(len(ctx.captured_queries), 6)
+        out = StringIO()
+        call_command('accrue_loans', '--date', '2025-01-21', stdout=out)
+        self.assertIn('on 3 loans', out.getvalue())
+
+
+class ScoringTests(TestCase):
+    def setUp(self):
+        self.today = timezone.localdate()
+        self.saver, self.spender, self.late, self.newbie = (make_user(name, balance) for name, balance in
+                                                            (('saver', '9000.00'), ('spender', '50.00'), ('late', '200.00'), ('newbie', '0.00')))
+        for months_ago in range(1, 6):
+            day = timezone.now() - timedelta(days=30 * months_ago)
+            Transaction.objects.create(receiver=self.saver, amount=Decimal('3000.00'), transaction_type='deposit', status='success', date=day)
+            Transaction.objects.create(sender=self.saver, amount=Decimal('1500.00'), transaction_type='payment', status='success', date=day)
+            Transaction.objects.create(receiver=self.spender, amount=Decimal('3000.00'), transaction_type='deposit', status='success', date=day)
+            Transaction.objects.create(sender=self.spender, amount=Decimal('500.00' if months_ago % 2 else '5400.00'), transaction_type='payment', status='success', date=day)
+        loan = Loan.objects.create(user=self.late, amount=Decimal('1200.00'), term_months=12, purpose='Car', status='approved', days_past_due=65)
+        LoanInstallment.objects.bulk_create(loans.schedule(loan, timezone.now() - timedelta(days=100)))
+
+    def score(self, user): return Account.objects.get(user=user).credit_score
+
+    def test_full_run_orders_behaviour(self):
+        self.assertEqual(sum(scoring.score_users(chunk_size=3)), 4)
+        self.assertEqual(self.score(self.newbie), scoring.BASE_SCORE)
+        self.assertGreater(self.score(self.saver), self.score(self.newbie))
+        self.assertLess(self.score(self.spender), self.score(self.saver))
+        self.assertLess(self.score(self.late), self.score(self.newbie))
+        self.assertTrue(all(scoring.MIN_SCORE <= self.score(u) <= scoring.MAX_SCORE for u in (self.saver, self.spender, self.late)))
+
+    def test_chunk_is_a_fixed_number_of_queries(self):
+        ids = list(Account.objects.values_list('user_id', flat=True))
+        with CaptureQueriesContext(connection) as ctx:
+            self.assertEqual(scoring.score_chunk(ids), 4)
+        self.assertEqual(len(ctx.captured_queries), 4) # Accounts, rollups, installments, one update
+
+    def test_incremental_run_only_rescores_active_users(self):
+        list(scoring.score_users())
+        CreditScoreRun.objects.update(started_at=timezone.now() - timedelta(minutes=5))
+        Account.objects.update(credit_score=1)
+        Transaction.objects.create(receiver=self.newbie, amount=Decimal('20.00'), transaction_type='deposit', status='success')
+        out = StringIO()
+        call_command('score_credit', stdout=out)
+        self.assertIn('Scored 2 users', out.getvalue()) # The new activity, and the loan still past due
+        self.assertEqual((self.score(self.saver), self.score(self.spender)), (1, 1))
+        self.assertNotEqual(self.score(self.newbie), 1)
+        self.assertFalse(CreditScoreRun.objects.latest('started_at').full)
+
+
+# ==========================================
+# BATCH TRANSFERS
+# ==========================================
+
+class BatchTransferTests(TestCase):
+    def setUp(self):
+        self.payer = make_user('payer', '100000.00')
+        self.staff = [make_user(f"staff{i}") for i in range(50)]
+        self.client.force_login(self.payer)
+
+    def upload(self, content, name='payroll.csv', pin='1234'):
+        from django.core.files.uploadedfile import SimpleUploadedFile
+        return self.client.post('/transfer/batch/', {'pin': pin, 'batch_file': SimpleUploadedFile(name, content.encode())})
+
+    def test_mixed_file_posts_valid_rows_and_reports_each(self):
+        rows = [f"{u.account.account_number},12.50,May salary" for u in self.staff[:3]] + ['0000000000,5.00,', f"{self.staff[3].account.account_number},abc,"]
+        response = self.upload("account_number,amount,note\n" + "\n".join(rows))
+        self.assertEqual(response['X-Batch-Posted'], '3')
+        lines = response.content.decode().strip().splitlines()
+        self.assertEqual(len(lines), 6)
+        self.assertIn('Recipient account number not found', lines[4])
+        self.assertIn('Invalid amount', lines[5])
+        self.assertEqual(Account.objects.get(user=self.payer).balance, Decimal('99962.50'))
+        self.assertEqual(Account.objects.get(user=self.staff[0]).balance, Decimal('12.50'))
+        self.assertEqual(rollups.month_totals(self.payer, checkpoints.month_start(timezone.now()))[1], Decimal('37.50'))
+
+    def test_json_batch_over_balance_is_rejected_whole(self):
+        response = self.upload(f'[{{"account_number": "{self.staff[0].account.account_number}", "amount": "200000.00"}}]', 'payroll.json')
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('Insufficient Funds', response.json()['message'])
+        self.assertFalse(Transaction.objects.filter(sender=self.payer).exists())
+
+    def test_large_rows_are_held_for_settlement(self):
+        numbers = [u.account.account_number for u in self.staff[:2]]
+        response = self.upload(f"account_number,amount\n{numbers[0]},999.99\n{numbers[1]},2500.00")
+        self.assertEqual((response['X-Batch-Posted'], response['X-Batch-Held']), ('1', '1'))
+        self.assertIn(',processing,', response.content.decode().splitlines()[2])
+        self.assertEqual(Account.objects.get(user=self.payer).balance, Decimal('96500.01'))
+        self.assertEqual(Account.objects.get(user=self.staff[1]).balance, Decimal('0.00'))
+        self.assertFalse(Notification.objects.filter(user=self.staff[1]).exists())
+
+        settlement.settle_due(now=timezone.now() + timedelta(days=1))
+        self.assertEqual(Account.objects.get(user=self.staff[1]).balance, Decimal('2500.00'))
+
+    @override_settings(VELOCITY_RULES={'amount_per_hour': {'scope': 'user', 'measure': 'amount', 'window': 3600, 'limit': 3000, 'label': "hourly transfer amount"}})
+    def test_large_rows_obey_velocity_limits(self):
+        numbers = [u.account.account_number for u in self.staff[:3]]
+        response = self.upload(f"account_number,amount\n{numbers[0]},2000.00\n{numbers[1]},2000.00\n{numbers[2]},50.00")
+        self.assertEqual((response['X-Batch-Posted'], response['X-Batch-Held'], response['X-Batch-Failed']), ('1', '1', '1'))
+        self.assertIn('hourly transfer amount', response.content.decode().splitlines()[2])
+        self.assertFalse(Transaction.objects.filter(receiver=self.staff[1]).exists())
+        self.assertEqual(Account.objects.get(user=self.payer).balance, Decimal('97950.00'))
+
+    @override_settings(VELOCITY_RULES={'amount_per_day': velocity.DEFAULT_RULES['amount_per_day'] | {'limit': 5000}})
+    def test_small_rows_add_up_against_velocity_limits(self):
+        # Rows under HOLD_AMOUNT are not held, but they still count
+        response = self.upload("account_number,amount\n" + "\n".join(f"{u.account.account_number},999.00" for u in self.staff[:10]))
+        self.assertEqual((response['X-Batch-Posted'], response['X-Batch-Failed']), ('5', '5'))
+        self.assertIn('daily transfer amount', response.content.decode().splitlines()[6])
+        self.assertEqual(Account.objects.get(user=self.payer).balance, Decimal('95005.00'))
+        self.assertEqual(velocity.check(mock.Mock(user=self.payer, META={}), '6.00', 'anyone'), ('amount_per_day', velocity.rules()['amount_per_day']))
+
+    def test_wrong_pin_posts_nothing(self):
+        response = self.upload(f"account_number,amount\n{self.staff[0].account.account_number},1.00", pin='0000')
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(Transaction.objects.filter(sender=self.payer).exists())
+
+    @override_settings(VELOCITY_RULES={name: {**rule, 'limit': 10 ** 6} for name, rule in velocity.DEFAULT_RULES.items()}) # A payroll-sized allowance
+    def test_ten_thousand_rows(self):
+        numbers = [u.account.account_number for u in self.staff]
+        content = "account_number,amount\n" + "\n".join(f"{numbers[i % 50]},1.00" for i in range(10000))
+        started = time.perf_counter()
+        response = self.upload(content)
+        elapsed = time.perf_counter() - started
+        print(f"\nbatch: 10000 transfers in {elapsed:.2f}s")
+        self.assertEqual(response['X-Batch-Posted'], '10000')
+        self.assertEqual(Account.objects.get(user=self.payer).balance, Decimal('90000.00'))
+        self.assertEqual(LedgerEntry.objects.filter(account__user=self.payer).aggregate(s=Sum('amount'))['s'], Decimal('90000.00'))
+        self.assertLess(elapsed, 60)
+
+
+# ==========================================
+# IDEMPOTENCY
+# ==========================================
+
+class IdempotencyTests(TestCase):
+    def setUp(self):
+        self.alice = make_user('alice', '500.00')
+        self.bob = make_user('bob')
+        self.client.force_login(self.alice)
+
+    def pay(self, key, amount='20.00'):
+        return self.client.post('/pay-bills/', {'pin': '1234', 'amount': amount, 'biller': 'Power Co', 'idempotency_key': key})
+
+    def test_repeat_is_replayed_without_posting(self):
+        first, second = self.pay('k1'), self.pay('k1')
+        self.assertEqual((first.status_code, first['Location']), (second.status_code, second['Location']))
+        self.assertEqual(second['Idempotent-Replayed'], 'true')
+        self.assertEqual(Transaction.objects.filter(sender=self.alice).count(), 1)
+        self.assertEqual(Account.objects.get(user=self.alice).balance, Decimal('480.00'))
+        self.pay('k2')
+        self.assertEqual(Account.objects.get(user=self.alice).balance, Decimal('460.00'))
+
+    def test_key_reused_for_other_payload_is_refused(self):
+        self.pay('k1')
+        self.pay('k1', amount='99.00')
+        self.assertEqual(Transaction.objects.filter(sender=self.alice).count(), 1)
+
+    def test_ajax_transfer_header_key(self):
+        data = {'pin': '1234', 'amount': '15.00', 'type': 'internal', 'account_number': self.bob.account.account_number}
+        for _ in range(3):
+            response = self.client.post('/transfer/', data, HTTP_X_REQUESTED_WITH='XMLHttpRequest', HTTP_IDEMPOTENCY_KEY='abc')
+            self.assertEqual(response.json()['status'], 'success')
+        self.assertEqual(Account.objects.get(user=self.bob).balance, Decimal('15.00'))
+
+
+class IdempotencyConcurrencyTests(TransactionTestCase):
+    def setUp(self):
+        cache.clear() # The cache table is not flushed between TransactionTestCases
+
+    def test_concurrent_duplicates_collapse(self):
+        from django.test import Client
+        alice, bob = make_user('alice', '500.00'), make_user('bob')
+        data = {'pin': '1234', 'amount': '25.00', 'type': 'internal', 'account_number': bob.account.account_number, 'idempotency_key': 'same'}
+        statuses, errors = [], []
+
+        clients = [Client() for _ in range(5)]
+        for client in clients: client.force_login(alice)
+
+        def worker(client):
+            try:
+                statuses.append(client.post('/transfer/', data, HTTP_X_REQUESTED_WITH='XMLHttpRequest').status_code)
+            except Exception as exc: errors.append(exc)
+            finally: connection.close()
+
+        threads = [threading.Thread(target=worker, args=(client,)) for client in clients]
+        for t in threads: t.start()
+        for t in threads: t.join()
+
+        self.assertEqual(errors, [])
+        self.assertEqual(statuses, [200] * 5)
+        self.assertEqual(Transaction.objects.filter(sender=alice).count(), 1)
+        self.assertEqual(Account.objects.get(user=bob).balance, Decimal('25.00'))
+
+
+# ==========================================
+# VELOCITY
+# ==========================================
+
+LOW_LIMITS = {
+    'amount_per_hour': {'scope': 'user', 'measure': 'amount', 'window': 3600, 'limit': 100, 'label': "hourly transfer amount"},
+    'new_recipients_per_day': {'scope': 'user', 'measure': 'count', 'window': 86400, 'limit': 2, 'new_recipient_only': True},
+    'device_transfers_per_hour': {'scope': 'device', 'measure': 'count', 'window': 3600, 'limit': 50},
+}
+
+@override_settings(VELOCITY_RULES=LOW_LIMITS)
+class VelocityTests(TestCase):
+    def setUp(self):
+        self.alice = make_user('alice', '1000.00')
+        self.payees = [make_user(f"payee{i}") for i in range(3)]
+        self.client.force_login(self.alice)
+
+    def send(self, payee, amount):
+        data = {'pin': '1234', 'amount': amount, 'type': 'internal', 'account_number': payee.account.account_number}
+        with self.captureOnCommitCallbacks(execute=True): # Known recipients are remembered on commit
+            return self.client.post('/transfer/', data, HTTP_X_REQUESTED_WITH='XMLHttpRequest').json()
+
+    def test_hourly_amount_blocks_before_booking(self):
+        self.assertEqual(self.send(self.payees[0], '60.00')['status'], 'success')
+        response = self.send(self.payees[0], '50.00')
+        self.assertEqual(response['status'], 'error')
+        self.assertIn('hourly transfer amount', response['message'])
+        self.assertEqual(Transaction.objects.filter(sender=self.alice).count(), 1)
+        self.assertEqual(self.send(self.payees[0], '40.00')['status'], 'success')
+
+    def test_new_recipient_limit_spares_known_recipients(self):
+        for payee in self.payees[:2]: self.assertEqual(self.send(payee, '5.00')['status'], 'success')
+        self.assertEqual(self.send(self.payees[2], '5.00')['status'], 'error')
+        self.assertEqual(self.send(self.payees[0], '5.00')['status'], 'success')
+
+    def test_window_slides_and_check_skips_transactions(self):
+        from django.test import RequestFactory
+        request = RequestFactory().post('/transfer/', REMOTE_ADDR='10.0.0.1')
+        request.user = self.alice
+        hour = 3600 * 480000 # Start of some hour window
+        velocity.reserve(request, Decimal('80.00'), 'x', now=hour + 1800)
+        with CaptureQueriesContext(connection) as captured:
+            self.assertEqual(velocity.check(request, Decimal('30.00'), 'x', now=hour + 3000)[0], 'amount_per_hour')
+        self.assertFalse([q for q in captured if 'account_transaction' in q['sql']])
+        # Half of the previous hour's 80.00 still counts: 40 + 30 fits, 40 + 70 does not
+        self.assertIsNone(velocity.check(request, Decimal('30.00'), 'x', now=hour + 3600 + 1800))
+        self.assertEqual(velocity.check(request, Decimal('70.00'), 'x', now=hour + 3600 + 1800)[0], 'amount_per_hour')
+
+    def request(self, **meta):
+        from django.test import RequestFactory
+        request = RequestFactory().post('/transfer/', **meta)
+        request.user = self.alice
+        return request
+
+    def test_reserve_counts_all_rules_or_none(self):
+        request = self.request(REMOTE_ADDR='10.0.0.1')
+        with self.captureOnCommitCallbacks(execute=True):
+            velocity.reserve(request, Decimal('90.00'), 'a')
+        velocity.reserve(request, Decimal('1.00'), 'a')
+        with self.assertRaises(velocity.LimitExceeded) as raised:
+            velocity.reserve(request, Decimal('20.00'), 'b') # Within the new-recipient rule, over the amount rule
+        self.assertEqual(raised.exception.broken[0], 'amount_per_hour')
+        usage = {row['rule']: row['used'] for row in velocity.snapshot(self.alice.pk)}
+        self.assertEqual((usage['amount_per_hour'], usage['new_recipients_per_day']), ('91.00', '1'))
+
+        # A transfer that fails to book gives its allowance back
+        with self.assertRaises(ledger.InsufficientFunds), transaction.atomic():
+            velocity.reserve(request, Decimal('9.00'), 'a')
+            ledger.debit(self.payees[0].account, Decimal('1.00'))
+        self.assertIsNone(velocity.check(request, Decimal('9.00'), 'a'))
+
+    def test_device_ignores_forwarded_for_unless_proxied(self):
+        spoofed = [self.request(REMOTE_ADDR='10.0.0.1', HTTP_X_FORWARDED_FOR=f"198.51.100.{n}") for n in range(2)]
+        self.assertEqual({velocity.client_ip(r) for r in spoofed}, {'10.0.0.1'})
+        with self.settings(VELOCITY_TRUSTED_PROXIES=1):
+            request = self.request(REMOTE_ADDR='10.0.0.1', HTTP_X_FORWARDED_FOR='198.51.100.7, 203.0.113.9')
+            self.assertEqual(velocity.client_ip(request), '203.0.113.9')
+
+    def test_default_rules_allow_a_large_transfer(self):
+        with self.settings(VELOCITY_RULES=velocity.DEFAULT_RULES):
+            self.assertIsNone(velocity.check(self.request(REMOTE_ADDR='10.0.0.1'), Decimal('25000.00'), 'landlord'))
+
+    def test_default_hourly_amount_trips_before_the_daily_one(self):
+        request = self.request(REMOTE_ADDR='10.0.0.1')
+        with self.settings(VELOCITY_RULES=velocity.DEFAULT_RULES):
+            velocity.reserve(request, Decimal('40000.00'), 'landlord')
+            with self.assertRaises(velocity.LimitExceeded) as raised:
+                velocity.reserve(request, Decimal('20000.00'), 'landlord')
+        self.assertEqual(raised.exception.broken[0], 'amount_per_hour')
+        self.assertIn('hourly transfer amount', str(raised.exception))
+
+    def test_counters_on_ops_context(self):
+        self.send(self.payees[0], '25.00')
+        staff = User.objects.create_superuser('opsadmin', 'ops@example.com', None)
+        session = SupportSession.objects.create(user=self.alice)
+        self.client.force_login(staff)
+        usage = {row['rule']: row for row in self.client.get(f"/ops/api/chat/{session.pk}/").json()['context']['velocity']}
+        self.assertEqual(usage['amount_per_hour']['used'], '25.00')
+        self.assertEqual(usage['new_recipients_per_day']['used'], '1')
+
+
+@override_settings(VELOCITY_RULES=LOW_LIMITS)
+class VelocityConcurrencyTests(TransactionTestCase):
+    def test_parallel_reservations_never_overshoot(self):
+        from django.test import RequestFactory
+        alice, granted, errors = make_user('alice'), [], []
+
+        def worker():
+            request = RequestFactory().post('/transfer/', REMOTE_ADDR='10.0.0.1')
+            request.user = alice
+            try:
+                for _ in range(5):
+                    try:
+                        velocity.reserve(request, Decimal('7.00'), 'payee')
+                        granted.append(1)
+                    except velocity.LimitExceeded:
+                        pass
+            except Exception as exc:
+                errors.append(exc)
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=worker) for _ in range(8)]
+        for t in threads: t.start()
+        for t in threads: t.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(len(granted), 14) # 14 * 7.00 fits the 100.00 hourly amount, a 15th would not
+
+
+# ==========================================
+# RECIPIENT LOOKUP
+# ==========================================
+
+class RecipientLookupTests(TestCase):
+    def setUp(self):
+        recipients.local.clear()
+        self.alice, self.bob = make_user('alice'), make_user('bob')
+        self.number = self.bob.account.account_number
+        self.client.force_login(self.alice)
+
+    def lookup(self, number):
+        return self.client.get('/search-account/', {'account_number': number}).json()
+
+    def account_queries(self, captured):
+        return [q for q in captured if 'account_account' in q['sql']]
+
+    def test_miss_is_one_query_and_hit_is_none(self):
+        with CaptureQueriesContext(connection) as captured:
+            self.assertEqual(recipients.resolve(self.number), (self.bob.pk, 'Bob Tester'))
+        self.assertEqual(len(self.account_queries(captured)), 1)
+        self.assertIn('auth_user', self.account_queries(captured)[0]['sql'])
+        with self.assertNumQueries(0):
+            recipients.resolve(self.number)
+        recipients.local.clear() # Another worker: served by the shared cache
+        with CaptureQueriesContext(connection) as captured:
+            recipients.resolve(self.number)
+        self.assertEqual(self.account_queries(captured), [])
+
+    def test_unknown_numbers_are_cached_until_the_account_opens(self):
+        self.assertEqual(self.lookup('9999999999'), {'found': False, 'message': 'Account not found'})
+        with self.assertNumQueries(0):
+            self.assertIsNone(recipients.resolve('9999999999'))
+        carol = User.objects.create_user('carol', first_name='Carol', last_name='Tester')
+        account = Account.objects.create(user=carol, account_number='9999999999')
+        self.assertEqual(recipients.resolve('9999999999'), (carol.pk, 'Carol Tester'))
+        account = Account.objects.get(pk=account.pk)
+        account.account_number = '8888888888'
+        account.save()
+        self.assertIsNone(recipients.resolve('9999999999'))
+        self.assertEqual(recipients.resolve('8888888888'), (carol.pk, 'Carol Tester'))
+
+    def test_unrelated_save_keeps_the_entry(self):
+        recipients.resolve(self.number)
+        account = Account.objects.get(user=self.bob)
+        account.dark_mode = True
+        with CaptureQueriesContext(connection) as captured:
+            account.save()
+            account.save() # Diffed against what the first save wrote
+        self.assertEqual([q['sql'] for q in captured if q['sql'].startswith('SELECT')], [])
+        with self.assertNumQueries(0):
+            recipients.resolve(self.number)
+
+    def test_rename_and_self_lookup(self):
+        self.assertEqual(self.lookup(self.number), {'found': True, 'name': 'Bob Tester'})
+        self.bob.first_name = 'Robert'
+        self.bob.save()
+        self.assertEqual(self.lookup(self.number)['name'], 'Robert Tester')
+        self.assertEqual(self.lookup(self.alice.account.account_number)['message'], 'Cannot transfer to yourself')
+
+    def test_lookups_per_second(self):
+        numbers = [make_user(f"payee{i}").account.account_number for i in range(50)]
+        def uncached(number):
+            account = Account.objects.get(account_number=number)
+            return account.user_id, f"{account.user.first_name} {account.user.last_name}"
+        rates = {}
+        for label, lookup in (('uncached', uncached), ('cached', recipients.resolve)):
+            started = time.perf_counter()
+            for n in range(2000): lookup(numbers[n % 50])
+            rates[label] = 2000 / (time.perf_counter() - started)
+        print(f"\nrecipient lookup: {rates['uncached']:,.0f}/s uncached, {rates['cached']:,.0f}/s cached")
+        self.assertGreater(rates['cached'], rates['uncached'])
+
+
+# ==========================================
+# NOTIFICATIONS
+# ==========================================
+
+class NotificationTests(TestCase):
+    def setUp(self):
+        self.alice, self.bob = make_user('alice'), make_user('bob')
+        self.client.force_login(self.alice)
+
+    def unread(self, user):
+        stored = Account.objects.get(user=user).unread_notifications
+        self.assertEqual(stored, Notification.objects.filter(user=user, is_read=False).count())
+        return stored
+
+    def test_counter_follows_create_read_delete(self):
+        Notification.objects.create(user=self.alice, message="Single")
+        notifications.bulk_create([Notification(user=u, message=f"Bulk {n}") for n in range(3) for u in (self.alice, self.bob)])
+        self.assertEqual((self.unread(self.alice), self.unread(self.bob)), (4, 3))
+        self.assertEqual(notifications.mark_read(Notification.objects.filter(user=self.alice, message__startswith='Bulk')), 3)
+        self.assertEqual(self.unread(self.alice), 1)
+        self.client.get(f"/notifications/delete/{Notification.objects.get(message='Single').pk}/", HTTP_REFERER='/dashboard/')
+        self.client.get('/notifications/clear/', HTTP_REFERER='/dashboard/')
+        self.assertEqual((self.unread(self.alice), self.unread(self.bob)), (0, 3))
+        self.assertFalse(Notification.objects.filter(user=self.alice).exists())
+
+    def test_plain_save_never_overwrites_counter(self):
+        stale = Account.objects.get(user=self.alice)
+        Notification.objects.create(user=self.alice, message="Arrived after the load")
+        stale.dark_mode = True
+        stale.save()
+        self.assertEqual(self.unread(self.alice), 1)
+        self.client.post('/notifications/read/')
+        self.assertEqual(self.unread(self.alice), 0)
+
+    def test_dropdown_is_capped_and_cached(self):
+        notifications.bulk_create([Notification(user=self.alice, message=f"Alert {n}") for n in range(500)])
+        summary = notifications.summary(self.alice.pk)
+        self.assertEqual(summary['unread'], 500)
+        self.assertEqual([row['message'] for row in summary['latest']], [f"Alert {n}" for n in range(499, 489, -1)])
+        self.assertTrue(summary['more'])
+        with self.assertNumQueries(1): # The cache read
+            notifications.summary(self.alice.pk)
+        response = self.client.get('/transfer/')
+        self.assertContains(response, 'Alert 499')
+        self.assertNotContains(response, 'Alert 489')
+        self.assertContains(response, 'Load older')
+        Notification.objects.create(user=self.alice, message="Fresh")
+        self.assertEqual(notifications.summary(self.alice.pk)['latest'][0]['message'], "Fresh")
+
+    def test_older_pages_from_json(self):
+        notifications.bulk_create([Notification(user=self.alice, message=f"Alert {n}") for n in range(45)] + [Notification(user=self.bob, message="Not mine")])
+        seen, before = [], notifications.summary(self.alice.pk)['latest'][-1]['id']
+        while before:
+            data = self.client.get('/api/notifications/', {'before': before}).json()
+            seen += [n['message'] for n in data['notifications']]
+            before = data['next_before']
+        self.assertEqual(seen, [f"Alert {n}" for n in range(34, -1, -1)])
+        self.assertEqual(self.client.get('/api/notifications/', {'before': 'x'}).status_code, 400)
+
+
+class NotificationRetentionTests(TestCase):
+    def setUp(self):
+        self.alice, self.bob = make_user('alice'), make_user('bob')
+        self.client.force_login(self.alice)
+
+    def aged(self, user, days, count=1, is_read=False):
+        rows = notifications.bulk_create([Notification(user=user, message=f"{days}d", is_read=is_read) for _ in range(count)])
+        Notification.objects.filter(pk__in=[n.pk for n in rows]).update(date=timezone.now() - timedelta(days=days))
+
+    def test_mark_all_read_is_one_update(self):
+        self.aged(self.alice, 1, 40)
+        self.aged(self.bob, 1, 2)
+        with CaptureQueriesContext(connection) as captured:
+            self.assertEqual(notifications.mark_all_read(self.alice.pk), 40)
+        self.assertEqual(len([q for q in captured if q['sql'].startswith('UPDATE "account_notification"')]), 1)
+        self.assertEqual(Account.objects.get(user=self.alice).unread_notifications, 0)
+        self.assertEqual(Account.objects.get(user=self.bob).unread_notifications, 2)
+        self.assertEqual(self.client.post('/notifications/read/').json()['marked'], 0)
+        self.assertEqual(self.client.get('/notifications/read/').status_code, 405)
+
+    def test_delete_is_scoped_to_the_owner(self):
+        self.aged(self.bob, 1)
+        self.client.get(f"/notifications/delete/{Notification.objects.get(user=self.bob).pk}/", HTTP_REFERER='/dashboard/')
+        self.assertTrue(Notification.objects.filter(user=self.bob).exists())
+
+    def test_purge_applies_ttls_and_caps_in_batches(self):
+        self.aged(self.alice, 40, 5, is_read=True) # Read, past 30 days: purged
+        self.aged(self.alice, 40, 3) # Unread, within 180 days: kept
+        self.aged(self.alice, 200, 2) # Unread, past 180 days: purged
+        self.aged(self.bob, 1, 30) # Over a cap of 25: the 5 oldest go
+        out = StringIO()
+        call_command('purge_notifications', '--max-per-user', '25', '--batch-size', '2', stdout=out)
+        self.assertIn('Purged 12 notifications', out.getvalue())
+        self.assertEqual(out.getvalue().count('deleted'), 7) # 3 + 1 + 3 batches of at most 2
+        self.assertEqual(Notification.objects.filter(user=self.alice).count(), 3)
+        self.assertEqual(Notification.objects.filter(user=self.bob).count(), 25)
+        self.assertEqual((Account.objects.get(user=self.alice).unread_notifications, Account.objects.get(user=self.bob).unread_notifications), (3, 25))
+        self.assertEqual(sum(notifications.purge(max_per_user=25)), 0)
+
+
+# ==========================================
+# SUPPORT PUSH (SSE)
+# ==========================================
+
+@override_settings(EVENTS_BROKER='local')
+class SupportStreamTests(TestCase):
+    def setUp(self):
+        self.alice = make_user('alice')
+        self.session = SupportSession.objects.create(user=self.alice)
+        self.staff = User.objects.create_superuser('opsadmin', 'ops@example.com', None)
+
+    def reply(self, text):
+        with self.captureOnCommitCallbacks(execute=True):
+            return SupportMessage.objects.create(user=self.alice, session=self.session, message=text, is_admin_reply=True)
+
+    async def open(self, url, user):
+        await self.async_client.aforce_login(user)
+        response = await self.async_client.get(url)
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+        stream = response.streaming_content
+        self.assertIn(b'connected', await anext(stream)) # Subscribed from here on
+        return stream
+
+    async def close(self, stream):
+        # What the ASGI handler does when the client goes away: cancel the pending read
+        pending = asyncio.ensure_future(anext(stream))
+        await asyncio.sleep(0)
+        pending.cancel()
+        with self.assertRaises(asyncio.CancelledError): await pending
+
+    async def test_customer_stream_pushes_replies(self):
+        stream = await self.open('/api/messages/stream/', self.alice)
+        message = await sync_to_async(self.reply)("Hello from support")
+        frame = (await asyncio.wait_for(anext(stream), 5)).decode()
+        self.assertIn(f"id: {message.pk}\nevent: message", frame)
+        self.assertIn('Hello from support', frame)
+        await self.close(stream)
+        self.assertEqual(events._subscribers, {})
+
+    async def test_ops_stream_names_the_session(self):
+        stream = await self.open('/ops/api/stream/', self.staff)
+        await sync_to_async(self.reply)("Hi")
+        self.assertIn(f'"session_id": {self.session.pk}', (await asyncio.wait_for(anext(stream), 5)).decode())
+        await self.close(stream)
+
+    def test_wsgi_and_anonymous_fall_back(self):
+        self.client.force_login(self.alice)
+        self.assertEqual(self.client.get('/api/messages/stream/').status_code, 204)
+        self.assertEqual(self.client.get('/ops/api/stream/').status_code, 403)
+        self.reply("Polled")
+        self.assertEqual([m['message'] for m in self.client.get('/api/messages/').json()['messages']], ['Polled'])
+
+    def test_unchanged_queue_polls_are_not_modified(self):
+        self.client.force_login(self.staff)
+        first = self.client.get('/ops/api/queue/')
+        self.assertEqual(first.json()['queue'][0]['session_id'], self.session.pk)
+        with CaptureQueriesContext(connection) as captured:
+            again = self.client.get('/ops/api/queue/', HTTP_IF_NONE_MATCH=first['ETag'])
+        self.assertEqual(again.status_code, 304)
+        self.assertFalse([q for q in captured if 'account_support' in q['sql']])
+        self.reply("New reply")
+        changed = self.client.get('/ops/api/queue/', HTTP_IF_NONE_MATCH=first['ETag'])
+        self.assertEqual(changed.status_code, 200)
+        self.assertNotEqual(changed['ETag'], first['ETag'])
+        self.assertTrue(changed.json()['queue'][0]['preview'].startswith('New reply'))
+
+    def test_cache_relay_round_trip(self):
+        last, _ = events._relay_in(None)
+        with mock.patch.object(events, 'ORIGIN', 'other-worker'):
+            events._relay_out(events.QUEUE, 7)
+            events._relay_out(events.user_channel(1), 7)
+        last, hints = events._relay_in(last)
+        self.assertEqual(hints, [('other-worker', events.QUEUE, 7), ('other-worker', events.user_channel(1), 7)])
+        self.assertEqual(events._relay_in(last), (last, []))
+
+    def test_head_never_moves_back_between_interleaved_publishers(self):
+        start, _ = events._relay_in(None)
+        with mock.patch.object(events, 'ORIGIN', 'other-worker'):
+            # A claims the next number but stalls before moving the head; a relay already reads its hint
+            with mock.patch.object(events, '_advance_head') as stalled:
+                events._relay_out(events.QUEUE, 'a')
+            last, hints = events._relay_in(start)
+            self.assertEqual(([data for _, _, data in hints], cache.get(events.HEAD_KEY, 0)), (['a'], start))
+            self.assertEqual(events._relay_in(last), (last, [])) # A trailing head is no restart
+
+            # B claims the number after A's and finishes first; then A catches up
+            events._relay_out(events.QUEUE, 'b')
+            events._advance_head(*stalled.call_args.args)
+        self.assertEqual(cache.get(events.HEAD_KEY), start + 2)
+        last, hints = events._relay_in(last)
+        self.assertEqual([data for _, _, data in hints], ['b'])
+
+        # Only an emptied cache restarts the sequence
+        cache.clear()
+        self.assertEqual(events._relay_in(last), (0, []))
+
+    async def test_idle_clients_cost_no_queries(self):
+        clients, seconds = 50, 1.0
+        with mock.patch.object(events, 'HEARTBEAT', 0.1):
+            streams = [await self.open('/api/messages/stream/', self.alice) for _ in range(clients)]
+            captured = CaptureQueriesContext(connection) # Entered on the thread that runs the streams' queries
+            await sync_to_async(captured.__enter__)()
+            for _ in range(int(seconds / events.HEARTBEAT)):
+                frames = await asyncio.gather(*(anext(stream) for stream in streams))
+                self.assertTrue(all(frame.startswith(b': keepalive') for frame in frames))
+            await sync_to_async(captured.__exit__)(None, None, None)
+            for stream in streams: await self.close(stream)
+
+        def polls():
+            self.client.force_login(self.alice)
+            with CaptureQueriesContext(connection) as polled: self.client.get('/api/messages/', {'last_id': 0})
+            return len(polled)
+        per_poll = await sync_to_async(polls)()
+        print(f"\nidle support clients: {per_poll * 20} queries/min each polling every 3s, {len(captured)} for {clients} streams over {seconds:.0f}s")
+        self.assertEqual(len(captured), 0)
+
+    async def test_cache_relay_reads_once_per_interval_per_process(self):
+        reads = mock.Mock(side_effect=lambda last: (last or 0, []))
+        with override_settings(EVENTS_BROKER='cache'), mock.patch.object(events, 'RELAY_INTERVAL', 0.05), mock.patch.object(events, '_relay_in', reads):
+            streams = [await self.open('/api/messages/stream/', self.alice) for _ in range(20)]
+            reads.reset_mock() # Count from here: opening the streams takes longer on some backends
+            await asyncio.sleep(0.5)
+            for stream in streams: await self.close(stream)
+            for task in list(events._relay_tasks): task.cancel()
+        self.assertLessEqual(reads.call_count, 15) # About one read per interval for the process, not one per client
+
+
+# ==========================================
+# SEARCH
+# ==========================================
+
+class SearchTests(TestCase):
+    def setUp(self):
+        self.alice = make_user('alice', '1000.00')
+        self.bob = make_user('bob')
+        self.carol = make_user('carol', '1000.00')
+        self.amazon = Transaction.objects.create(sender=self.alice, amount=Decimal('42.10'), transaction_type='payment', status='success', note='Amazon order')
+        self.rent = Transaction.objects.create(sender=self.alice, receiver=self.bob, amount=Decimal('150.00'), status='success', note='Rent March')
+        self.wire = Transaction.objects.create(sender=self.alice, amount=Decimal('900.00'), transaction_type='wire', status='processing', receiver_bank_name='Chase')
+        self.other = Transaction.objects.create(sender=self.carol, receiver=self.bob, amount=Decimal('42.10'), status='success', note='Amazon gift')
+
+    def test_prefix_words_and_counterparty_names(self):
+        self.assertEqual(search.search(self.alice, 'amaz'), [self.amazon])
+        self.assertEqual(search.search(self.alice, 'BOB rent'), [self.rent])
+        self.assertEqual(search.search(self.alice, 'chase'), [self.wire])
+        self.assertEqual(search.search(self.bob, 'amazon'), [self.other])
+        self.assertEqual(search.search(self.alice, 'netflix'), [])
+
+    def test_reference_and_amount_filters(self):
+        self.assertEqual(search.search(self.alice, f"#{str(self.rent.pk).zfill(8)}"), [self.rent])
+        self.assertEqual(search.search(self.alice, '$42.10'), [self.amazon])
+        self.assertEqual(set(search.search(self.alice, '100-1000')), {self.rent, self.wire})
+        self.assertEqual(search.search(self.alice, '>500'), [self.wire])
+        self.assertEqual(search.search(self.alice, 'rent <100'), [])
+
+    def test_documents_follow_edits_and_reindex(self):
+        self.rent.note = 'Deposit for flat'
+        self.rent.save(update_fields=['note'])
+        self.assertEqual(search.search(self.alice, 'flat'), [self.rent])
+        User.objects.filter(pk=self.bob.pk).update(first_name='Robert')
+        call_command('rebuild_search_index', '--user', 'bob', stdout=StringIO())
+        self.assertEqual(search.search(self.alice, 'robert'), [self.rent])
+
+    def test_renames_reach_older_transactions(self):
+        self.bob.first_name = 'Robert'
+        self.bob.save()
+        self.assertEqual(search.search(self.alice, 'robert'), [self.rent])
+        self.carol.username = 'caroline'
+        self.carol.save(update_fields=['username'])
+        self.assertEqual(search.search(self.bob, 'caroline'), [self.other])
+        with CaptureQueriesContext(connection) as captured:
+            self.bob.save(update_fields=['last_login'])
+        self.assertEqual(len(captured), 1) # Nothing read back, nothing reindexed
+
+    def test_history_api_ranks_search_results(self):
+        self.client.force_login(self.alice)
+        data = self.client.get('/api/history/', {'q': f"amazon #{self.wire.pk}"}).json()
+        self.assertEqual([t['id'] for t in data['transactions']], [self.wire.pk, self.amazon.pk])
+        self.assertFalse(data['has_next'])
+
+    def test_search_uses_the_text_index(self):
+        if connection.vendor != 'postgresql':
+            self.skipTest("SQLite searches its FTS5 table directly")
+        from django.contrib.postgres.search import SearchQuery, SearchVector
+        plan = explain(Transaction.objects.annotate(d=SearchVector('search_document', config='simple')).filter(d=SearchQuery('amazon:*', search_type='raw', config='simple')))
+        self.assertIn('txn_search_gin', plan)
+
+
+# ==========================================
+# QUERY BUDGETS
+# ==========================================
+
+class QueryBudgetTests(TestCase):
+    """Upper bounds on queries per page. Budgets are fixed while the seeded data has dozens of rows
+    per list, so any per-row query (N+1) blows them; the failure message lists the SQL."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.users = [make_user(f"budget{i}", '5000.00') for i in range(8)]
+        cls.user = cls.users[0]
+        rng = random.Random(10)
+        for n in range(40):
+            other = rng.choice(cls.users[1:])
+            sender, receiver = (cls.user, other) if n % 2 else (other, cls.user)
+            Transaction.objects.create(sender=sender, receiver=receiver, amount=Decimal(rng.randint(1, 90)), status='success', note=f"Invoice {n}")
+        for user in cls.users:
+            session = SupportSession.objects.create(user=user)
+            for n in range(3): SupportMessage.objects.create(user=user, session=session, message=f"Message {n}", is_admin_reply=bool(n % 2))
+        for n in range(3):
+            loan = Loan.objects.create(user=cls.user, amount=Decimal('1000.00'), term_months=12, purpose=f"Loan {n}")
+            loan.status = 'approved'
+            loan.save()
+        cls.staff = User.objects.create_superuser('opsadmin', 'ops@example.com', None)
+
+    # Every page also pays a fixed overhead: session load and save, request.user, the notifications context processor.
+    # Budgets are for the steady state: a first request warms the per-user caches (e.g. the notification summary)
+    def assertQueryBudget(self, budget, url, data=None):
+        self.client.get(url, data)
+        with CaptureQueriesContext(connection) as captured:
+            response = self.client.get(url, data)
+        self.assertEqual(response.status_code, 200, url)
+        self.assertLessEqual(len(captured), budget, f"{url} ran {len(captured)} queries (budget {budget}):\n" + "\n".join(q['sql'] for q in captured))
+
+    def test_customer_pages(self):
+        self.client.force_login(self.user)
+        for budget, url, data in (
+            (12, '/dashboard/', None),
+            (11, '/dashboard/', {'view_all': 'true'}),
+            (6, '/history/', None),
+            (7, '/api/history/', None),
+            (7, '/api/history/', {'q': 'invoice'}),
+            (11, '/support/', None),
+            (8, '/analytics/', None),
+            (8, '/documents/', None),
+            (7, '/transfer/', None),
+            (9, '/loans/', None),
+        ):
+            with self.subTest(url=url, data=data):
+                self.assertQueryBudget(budget, url, data)
+
+    def test_operations_pages(self):
+        self.client.force_login(self.staff)
+        # The queue's budget is a full build (its version read included); unchanged polls are 304s, see SupportStreamTests
+        for budget, url in ((7, '/ops/api/queue/'), (12, '/admin/account/transaction/'), (10, '/admin/account/account/')):
+            with self.subTest(url=url):
+                self.assertQueryBudget(budget, url)
+
+
+# ==========================================
+# EXPORTS
+# ==========================================
+
+class ExportTests(TestCase):
+    def setUp(self):
+        self.alice = make_user('alice', '1000.00')
+        self.bob = make_user('bob', '1000.00')
+        for n in range(30):
+            sender, receiver = (self.alice, self.bob) if n % 3 else (self.bob, self.alice)
+            Transaction.objects.create(sender=sender, receiver=receiver, amount=Decimal(n + 1), status='failed' if n == 4 else 'success',
+                                       note=f"Item {n}", date=timezone.now() - timedelta(days=60 - n * 2))
+        Transaction.objects.create(sender=self.bob, amount=Decimal('5.00'), transaction_type='payment', status='success') # Not alice's
+        self.client.force_login(self.alice)
+
+    def download(self, **params):
+        response = self.client.get('/history/export/', params)
+        self.assertTrue(response.streaming)
+        return b''.join(response.streaming_content).decode()
+
+    def test_csv_is_chronological_and_signed(self):
+        lines = self.download(format='csv').strip().splitlines()
+        self.assertEqual(lines[0], 'Date,Reference,Type,Counterparty,Memo,Amount,Status')
+        self.assertEqual(len(lines), 31)
+        self.assertTrue(lines[1].endswith(',Item 0,1.00,success')) # Received from Bob
+        self.assertTrue(lines[2].endswith(',Item 1,-2.00,success'))
+        self.assertEqual([l[:16] for l in lines[1:]], sorted(l[:16] for l in lines[1:]))
+
+    def test_filters_match_history_page(self):
+        self.assertEqual(len(self.download(format='csv', type='credit').strip().splitlines()), 11)
+        self.assertEqual(len(self.download(format='csv', date='7days').strip().splitlines()), 4)
+
+    def test_ofx_and_qif_carry_settled_rows(self):
+        ofx = self.download(format='ofx')
+        self.assertEqual(ofx.count('<STMTTRN>'), 29)
+        self.assertIn(f"<ACCTID>{self.alice.account.account_number}</ACCTID>", ofx)
+        self.assertTrue(ofx.rstrip().endswith('</OFX>'))
+        qif = self.download(format='qif')
+        self.assertTrue(qif.startswith('!Type:Bank\n'))
+        self.assertEqual(qif.count('^\n'), 29)
+
+    def test_header_is_sent_before_any_query(self):
+        response = self.client.get('/history/export/', {'format': 'csv'})
+        chunks = iter(response.streaming_content)
+        with self.assertNumQueries(0):
+            self.assertTrue(next(chunks).startswith(b'Date,'))
+        self.assertEqual(b''.join(chunks).count(b'\n'), 30)
+
+
+# ==========================================
+# PARTITIONS & ARCHIVE
+# ==========================================
+
+@skipUnless(connection.vendor == 'postgresql', "SQLite keeps one plain table")
+class PartitionTests(TestCase):
+    def test_month_bounded_reads_touch_one_partition(self):
+        for month in (3, 4): partitions.create(date(2024, month, 1))
+        plan = explain(Transaction.objects.filter(date__gte=at(2024, 3, 1), date__lt=at(2024, 3, 28)))
+        self.assertIn('account_transaction_p2024_03', plan)
+        self.assertNotIn('account_transaction_p2024_04', plan)
+
+    def test_new_partition_takes_rows_from_default(self):
+        user = make_user('alice')
+        txn = Transaction.objects.create(receiver=user, amount=Decimal('5.00'), transaction_type='deposit', status='success', date=at(2030, 1))
+        self.assertEqual(partitions.create(date(2030, 1, 1)), 1)
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT id FROM account_transaction_p2030_01")
+            self.assertEqual(cursor.fetchall(), [(txn.pk,)])
+        self.assertEqual(partitions.ensure(ahead=2), []) # Migration already created the current month and beyond
+
+
+class ArchiveTests(TestCase):
+    def setUp(self):
+        self.alice = make_user('alice')
+        self.bob = make_user('bob')
+        for year, month in ((2023, 1), (2023, 2), (2023, 3), (2024, 5)):
+            for day in (3, 17):
+                Transaction.objects.create(sender=None, receiver=self.alice, amount=Decimal('100.00'), transaction_type='deposit', status='success', date=at(year, month, day))
+                Transaction.objects.create(sender=self.alice, receiver=self.bob, amount=Decimal('30.00'), status='success', note='Rent', date=at(year, month, day))
+        self.everything = list(Transaction.objects.filter(Q(sender=self.alice) | Q(receiver=self.alice)).order_by('-date', '-id'))
+        call_command('close_month', month='2024-05', backfill=True, stdout=StringIO())
+
+    def test_readers_continue_into_the_archive(self):
+        statement_before = statements.statement_context(self.alice, date(2023, 2, 1))
+        rollup_fields = ('user_id', 'month', 'direction', 'transaction_type', 'count', 'total')
+        rollups_before = set(MonthlyRollup.objects.values_list(*rollup_fields))
+        moved = dict(archive.archive_before(date(2023, 3, 1)))
+        self.assertEqual(moved, {date(2023, 1, 1): 4, date(2023, 2, 1): 4})
+        self.assertFalse(Transaction.objects.filter(date__lt=at(2023, 3, 1)).exists())
+
+        pages, cursor = [], None
+        while True:
+            page, cursor = queries.transaction_page(self.alice, 5, queries.decode_cursor(cursor))
+            pages += page
+            if not cursor: break
+        self.assertEqual([t.id for t in pages], [t.id for t in self.everything])
+        self.assertEqual([t.id for t in queries.iter_history(self.alice)], [t.id for t in reversed(self.everything)])
+
+        statement_after = statements.statement_context(self.alice, date(2023, 2, 1))
+        for key in ('beginning_balance', 'total_in', 'total_out', 'closing_balance'):
+            self.assertEqual(statement_after[key], statement_before[key])
+        self.assertEqual([t.id for t in statement_after['transactions']], [t.id for t in statement_before['transactions']])
+        rollups.rebuild()
+        self.assertEqual(set(MonthlyRollup.objects.values_list(*rollup_fields)), rollups_before)
+
+    def test_history_api_and_export_include_archived_rows(self):
+        archive.archive_month(date(2023, 1, 1))
+        self.client.force_login(self.alice)
+        lines = b''.join(self.client.get('/history/export/', {'format': 'csv'}).streaming_content).decode().strip().splitlines()
+        self.assertEqual(len(lines), len(self.everything) + 1)
+        self.assertTrue(lines[1].startswith('2023-01-03'))
+
+    def test_months_must_be_closed_and_archived_in_order(self):
+        with self.assertRaises(archive.ArchiveError):
+            archive.archive_month(date(2023, 2, 1)) # January is still hot
+        BalanceCheckpoint.objects.filter(month=date(2023, 1, 1)).delete()
+        with self.assertRaises(archive.ArchiveError):
+            archive.archive_month(date(2023, 1, 1))
+
+    def test_command_archives_past_the_horizon(self):
+        out = StringIO()
+        years = timezone.now().year - 2023 # Everything before this month of 2023
+        call_command('partition_transactions', archive_years=years, stdout=out)
+        self.assertIn('Archived', out.getvalue())
+        self.assertFalse(Transaction.objects.filter(date__lt=at(2023, timezone.now().month, 1)).exists())
+        self.assertEqual(Transaction.objects.count() + ArchivedTransaction.objects.count(), 16)
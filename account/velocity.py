@@ -0,0 +1,214 @@
+"""
+Velocity limits on outgoing transfers.
+
+Counters are VelocityCounter rows, so a check never scans Transaction. Each rule counts
+transfers (or cents) per subject in fixed windows of the rule's length:
+  - the sender
+  - the recipient account, across every sender
+  - the sender's device: client IP plus user agent
+The sliding window is estimated as
+    current window + previous window * (share of it still inside the sliding window)
+Rules come from settings.VELOCITY_RULES (DEFAULT_RULES otherwise).
+
+reserve() checks and counts in one statement: a conditional UPDATE raises each rule's
+counter only where it stays within the limit, and if any rule would break, nothing is
+counted. Two concurrent transfers therefore cannot both take the last of an allowance.
+execute_transfer reserves inside the transaction that books the transfer, so a
+transfer that fails to book gives its allowance back. check() reads the same counters
+without counting; transfer_money uses it to refuse early, before asking for an OTP.
+reserve_many() counts a whole chunk of batch transfers in order: it locks the counters
+it needs once, refuses each row that would break a rule and counts the others in one
+UPDATE, so every batch row is limited like a single transfer at a fixed query cost.
+
+The client IP is REMOTE_ADDR. X-Forwarded-For is only used with
+settings.VELOCITY_TRUSTED_PROXIES set to the number of proxies in front of the app,
+and then only the entry the outermost trusted proxy appended, since clients can write
+the rest. Recipients a user has paid are remembered in the shared cache for
+KNOWN_RECIPIENT_TTL; an emptied cache treats every recipient as new. Expired counter
+rows are deleted by the purge_velocity_counters command.
+"""
+import hashlib
+import math
+import time
+from datetime import datetime, timezone as dt_timezone
+from decimal import Decimal
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import BigIntegerField, Case, F, Q, When
+from django.utils import timezone
+
+from . import ledger
+from .models import VelocityCounter
+
+# Amount rules sit well above a large one-off payment (rent, a car, a deposit); the count
+# rules are what catch an account being drained in many small transfers
+DEFAULT_RULES = {
+    'amount_per_hour': {'scope': 'user', 'measure': 'amount', 'window': 3600, 'limit': 50000, 'label': "hourly transfer amount"},
+    'amount_per_day': {'scope': 'user', 'measure': 'amount', 'window': 86400, 'limit': 100000, 'label': "daily transfer amount"},
+    'transfers_per_hour': {'scope': 'user', 'measure': 'count', 'window': 3600, 'limit': 20, 'label': "hourly number of transfers"},
+    'new_recipients_per_day': {'scope': 'user', 'measure': 'count', 'window': 86400, 'limit': 5, 'new_recipient_only': True, 'label': "daily number of new recipients"},
+    'recipient_amount_per_day': {'scope': 'recipient', 'measure': 'amount', 'window': 86400, 'limit': 100000, 'label': "daily amount for this recipient"},
+    'device_transfers_per_hour': {'scope': 'device', 'measure': 'count', 'window': 3600, 'limit': 30, 'label': "hourly number of transfers from this device"},
+}
+KNOWN_RECIPIENT_TTL = 90 * 24 * 60 * 60
+
+
+class LimitExceeded(Exception):
+    """A transfer would break a velocity rule; `broken` is (rule name, rule)."""
+
+    def __init__(self, broken):
+        self.broken = broken
+        super().__init__(message(broken))
+
+
+def rules():
+    return getattr(settings, 'VELOCITY_RULES', DEFAULT_RULES)
+
+def recipient_key(data):
+    """Recipient identity for a transfer's txn_data: the account number, or bank + account for wires."""
+    if data['type'] == 'wire': return f"{(data.get('bank_name') or '').strip().lower()}:{data.get('account_number') or ''}"
+    return data.get('account_number') or ''
+
+def _digest(value):
+    return hashlib.sha256(value.encode()).hexdigest()[:24]
+
+def client_ip(request):
+    # Clients can send any X-Forwarded-For; each trusted proxy appends the address it saw
+    proxies = getattr(settings, 'VELOCITY_TRUSTED_PROXIES', 0)
+    forwarded = [ip.strip() for ip in request.META.get('HTTP_X_FORWARDED_FOR', '').split(',') if ip.strip()]
+    if proxies and len(forwarded) >= proxies: return forwarded[-proxies]
+    return request.META.get('REMOTE_ADDR', '')
+
+def _subjects(user_id, recipient=None, request=None):
+    return {'user': str(user_id), 'recipient': recipient and _digest(recipient),
+            'device': request and _digest(f"{client_ip(request)}|{request.META.get('HTTP_USER_AGENT', '')}")}
+
+def _windows(name, rule, subject, now):
+    # (current key, previous key, share of the previous window still inside the sliding window)
+    index, position = divmod(now, rule['window'])
+    base = f"{name}:{subject}"
+    return f"{base}:{int(index)}", f"{base}:{int(index) - 1}", 1 - position / rule['window']
+
+def _units(rule, amount):
+    return int(Decimal(amount) * 100) if rule['measure'] == 'amount' else 1
+
+def _limit(rule):
+    return _units(rule, rule['limit']) if rule['measure'] == 'amount' else rule['limit']
+
+def _known_key(user_id, recipient):
+    return f"velocity:known:{user_id}:{_digest(recipient)}"
+
+def _counts(keys):
+    return dict(VelocityCounter.objects.filter(key__in=list(keys)).values_list('key', 'used'))
+
+def _plan(request, amount, recipient, now, is_new=None):
+    # (name, rule, current key, previous key, overlap, units) for every rule this transfer counts against
+    user_id = request.user.pk
+    if is_new is None: is_new = cache.get(_known_key(user_id, recipient)) is None
+    subjects = _subjects(user_id, recipient, request)
+    return is_new, [(name, rule, *_windows(name, rule, subjects[rule['scope']], now), _units(rule, amount))
+                    for name, rule in rules().items() if is_new or not rule.get('new_recipient_only')]
+
+def _room(rule, previous, overlap, units):
+    # The most the current window may already hold for this transfer to fit
+    return math.floor(_limit(rule) - units - previous * overlap)
+
+
+def check(request, amount, recipient, now=None):
+    """(rule name, rule) of the first limit this transfer would break, or None. Counts nothing."""
+    _, plan = _plan(request, amount, recipient, now or time.time())
+    counts = _counts(key for _, _, current, previous, _, _ in plan for key in (current, previous))
+    for name, rule, current, previous, overlap, units in plan:
+        if counts.get(current, 0) > _room(rule, counts.get(previous, 0), overlap, units): return name, rule
+    return None
+
+@ledger.retry_on_conflict
+def reserve(request, amount, recipient, now=None):
+    """Counts a transfer against every rule, or raises LimitExceeded and counts nothing.
+
+    Call it inside the transaction that books the transfer: rolling that back undoes the count.
+    """
+    now = now or time.time()
+    is_new, plan = _plan(request, amount, recipient, now)
+    if not plan: return
+
+    # 1. Current windows exist; previous windows are closed, so their counts are final
+    VelocityCounter.objects.bulk_create([VelocityCounter(key=current, expires_at=_expiry(rule, now)) for _, rule, current, _, _, _ in plan], ignore_conflicts=True)
+    counts = _counts(key for _, _, current, previous, _, _ in plan for key in (current, previous))
+
+    # 2. One conditional UPDATE: each counter only moves if it stays within its limit
+    rooms = {current: _room(rule, counts.get(previous, 0), overlap, units) for _, rule, current, previous, overlap, units in plan}
+    within = Q()
+    for current, room in rooms.items(): within |= Q(key=current, used__lte=room)
+    updated = VelocityCounter.objects.filter(within).update(used=Case(*[When(key=current, then=F('used') + units) for _, _, current, _, _, units in plan], output_field=BigIntegerField()))
+    if updated < len(plan):
+        # Name the rule from the counts read above (a concurrent reservation may have taken the room since)
+        broken = next(((name, rule) for name, rule, current, *_ in plan if counts.get(current, 0) > rooms[current]), plan[0][:2])
+        raise LimitExceeded(broken) # Rolls back the counters that did move
+
+    if is_new: transaction.on_commit(lambda: cache.set(_known_key(request.user.pk, recipient), 1, KNOWN_RECIPIENT_TTL))
+
+@ledger.retry_on_conflict
+def reserve_many(request, transfers, now=None):
+    """Counts [(amount, recipient)] transfers in order. Returns {index: (rule name, rule)} for those that
+    would break a rule; they are not counted.
+
+    Call it inside the transaction that books the others. The counters stay locked until then.
+    """
+    now, user_id = now or time.time(), request.user.pk
+    known_keys = {recipient: _known_key(user_id, recipient) for _, recipient in transfers}
+    known = cache.get_many(list(set(known_keys.values())))
+    plans = [_plan(request, amount, recipient, now, known_keys[recipient] not in known)[1] for amount, recipient in transfers]
+    currents = {current: rule for plan in plans for _, rule, current, *_ in plan}
+    if not currents: return {}
+
+    # 1. Current windows exist and are locked (in key order) while the batch is tallied
+    VelocityCounter.objects.bulk_create([VelocityCounter(key=key, expires_at=_expiry(rule, now)) for key, rule in currents.items()], ignore_conflicts=True)
+    keys = sorted({key for plan in plans for _, _, current, previous, _, _ in plan for key in (current, previous)})
+    counts = dict(VelocityCounter.objects.select_for_update().filter(key__in=keys).order_by('key').values_list('key', 'used'))
+
+    # 2. Tally row by row; a recipient is only new the first time the batch pays it
+    added, refused, paid = dict.fromkeys(currents, 0), {}, set()
+    for i, ((amount, recipient), plan) in enumerate(zip(transfers, plans)):
+        plan = [p for p in plan if not (recipient in paid and p[1].get('new_recipient_only'))]
+        broken = next(((name, rule) for name, rule, current, previous, overlap, units in plan
+                       if counts.get(current, 0) + added[current] > _room(rule, counts.get(previous, 0), overlap, units)), None)
+        if broken:
+            refused[i] = broken
+            continue
+        for _, _, current, _, _, units in plan: added[current] += units
+        paid.add(recipient)
+
+    # 3. One UPDATE for what the accepted rows count
+    added = {key: units for key, units in added.items() if units}
+    if added:
+        VelocityCounter.objects.filter(key__in=list(added)).update(used=Case(*[When(key=key, then=F('used') + units) for key, units in added.items()], output_field=BigIntegerField()))
+    fresh = {known_keys[recipient] for recipient in paid} - set(known)
+    if fresh: transaction.on_commit(lambda: cache.set_many(dict.fromkeys(fresh, 1), KNOWN_RECIPIENT_TTL))
+    return refused
+
+def _expiry(rule, now):
+    return datetime.fromtimestamp((now // rule['window'] + 2) * rule['window'], tz=dt_timezone.utc)
+
+def purge(now=None):
+    """Deletes counters whose window no longer reaches into any sliding window. Returns how many."""
+    return VelocityCounter.objects.filter(expires_at__lt=now or timezone.now()).delete()[0]
+
+def message(broken):
+    name, rule = broken
+    return f"This transfer exceeds your {rule.get('label', name.replace('_', ' '))} limit. Please try again later or contact support."
+
+def snapshot(user_id, account_number=None, now=None):
+    """Current sliding-window usage of a user's own rules (and money into their account), for the ops dashboard."""
+    now, subjects = now or time.time(), _subjects(user_id, account_number)
+    windows = {name: _windows(name, rule, subjects[rule['scope']], now) for name, rule in rules().items() if subjects.get(rule['scope'])}
+    counts = _counts(key for current, previous, _ in windows.values() for key in (current, previous))
+    usage = []
+    for name, (current, previous, overlap) in windows.items():
+        rule, used = rules()[name], counts.get(current, 0) + counts.get(previous, 0) * overlap
+        if rule['measure'] == 'amount': used = (Decimal(round(used)) / 100).quantize(Decimal('0.01'))
+        usage.append({'rule': name, 'label': rule.get('label', name), 'used': str(round(used) if rule['measure'] == 'count' else used),
+                      'limit': str(rule['limit']), 'window': rule['window'], 'measure': rule['measure']})
+    return usage
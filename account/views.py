@@ -2,139 +2,29 @@ from django.shortcuts import render, redirect, get_object_or_404
 from django.contrib.auth import authenticate, login, logout
 from django.contrib.auth.decorators import login_required, user_passes_test
 from .models import Account, Transaction, CreditCard, Notification, SupportMessage, Loan, SupportSession
-from django.db.models import Q, Sum, Max, Count
+from . import ledger, checkpoints, rollups, queries, batch, search, exports, statements, loans, velocity, recipients, notifications, events
+from .idempotency import idempotent
+from django.db.models import Q, Sum, Max, Count, OuterRef, Subquery
 from django.contrib import messages
 from django.db import transaction
 from decimal import Decimal
 from django.contrib.auth.models import User
+import asyncio
 import uuid
 import random
-import threading
 from datetime import datetime, timedelta
 from django.utils import timezone
-from django.core.mail import EmailMultiAlternatives
+from django.utils.cache import get_conditional_response
 from django.template.loader import render_to_string
-from django.utils.html import strip_tags
 from django.conf import settings
-from django.http import HttpResponse, JsonResponse
-from django.core.paginator import Paginator
+from django.http import HttpResponse, JsonResponse, StreamingHttpResponse
 from django.core.cache import cache
+from django.core.handlers.asgi import ASGIRequest
+from asgiref.sync import sync_to_async
 # ==========================================
-# 1. PREMIUM EMAIL ENGINE (THREADED)
+# 1. PREMIUM EMAIL ENGINE (see account/emails.py)
 # ==========================================
-
-class EmailThread(threading.Thread):
-    def __init__(self, subject, html_content, recipient_list):
-        self.subject = subject
-        self.recipient_list = recipient_list
-        self.html_content = html_content
-        threading.Thread.__init__(self)
-
-    def run(self):
-        try:
-            msg = EmailMultiAlternatives(self.subject, strip_tags(self.html_content), settings.EMAIL_HOST_USER, self.recipient_list)
-            msg.attach_alternative(self.html_content, "text/html")
-            msg.send()
-        except Exception as e:
-            print(f"Email Sending Failed: {e}")
-
-def get_email_style():
-    """Returns the CSS styles for premium emails."""
-    return """
-    <style>
-        body { font-family: 'Helvetica Neue', Helvetica, Arial, sans-serif; background-color: #f4f6f8; margin: 0; padding: 0; }
-        .container { max-width: 600px; margin: 40px auto; background: #ffffff; border-radius: 16px; overflow: hidden; box-shadow: 0 4px 20px rgba(0,0,0,0.05); }
-        .header { background: #004d99; padding: 30px; text-align: center; }
-        .header h1 { color: #ffffff; margin: 0; font-size: 24px; letter-spacing: 2px; font-weight: 700; }
-        .content { padding: 40px; }
-        .amount-box { text-align: center; margin-bottom: 30px; padding: 20px; background: #f8fafc; border-radius: 12px; border: 1px solid #e2e8f0; }
-        .label { font-size: 12px; text-transform: uppercase; color: #64748b; letter-spacing: 1px; margin-bottom: 5px; font-weight: 600; }
-        .amount { font-size: 38px; font-weight: 800; color: #1a1a1a; letter-spacing: -1px; margin: 0; }
-        .code-box { background: #eff6ff; border: 1px solid #dbeafe; border-radius: 8px; padding: 20px; text-align: center; margin: 30px 0; }
-        .code-val { font-size: 36px; font-weight: bold; color: #004d99; letter-spacing: 5px; display: block; }
-        .status-badge { display: inline-block; padding: 6px 14px; border-radius: 20px; font-size: 12px; font-weight: 700; text-transform: uppercase; margin-top: 15px; }
-        .status-success { background: #dcfce7; color: #166534; }
-        .status-processing { background: #fef9c3; color: #854d0e; }
-        .details-table { width: 100%; border-collapse: collapse; margin-top: 20px; }
-        .details-table td { padding: 12px 0; border-bottom: 1px solid #f1f5f9; color: #334155; font-size: 14px; }
-        .details-table td:last-child { text-align: right; font-weight: 600; color: #1a1a1a; }
-        .footer { background: #f8fafc; padding: 25px; text-align: center; border-top: 1px solid #e2e8f0; color: #94a3b8; font-size: 12px; line-height: 1.6; }
-    </style>
-    """
-
-def send_premium_otp(user, otp, action="verify your identity"):
-    """Sends a secure, branded OTP email with Rate Limiting."""
-    
-    # 1. RATE LIMIT CHECK (Max 1 email per 2 minutes per user)
-    cache_key = f"email_limit_{user.id}"
-    if cache.get(cache_key):
-        print(f"⚠️ Email blocked for {user.email} (Rate Limit Exceeded)")
-        return # STOP HERE. Save the quota.
-
-    # 2. SEND EMAIL
-    subject = f'{otp} is your Veltris verification code'
-    html_content = f"""
-    <!DOCTYPE html><html><head>{get_email_style()}</head><body>
-    <div class="container">
-        <div class="header"><h1>VELTRIS BANK</h1></div>
-        <div class="content">
-            <h2 style="color:#1a1a1a;margin-top:0;text-align:center;">Verification Required</h2>
-            <p style="color:#666;font-size:15px;line-height:1.6;text-align:center;">
-                Hello <strong>{user.first_name or user.username}</strong>,<br><br>
-                You requested to <strong>{action}</strong>. Please use the secure code below to complete this action.
-            </p>
-            <div class="code-box">
-                <span class="label" style="color:#64748b;display:block;margin-bottom:10px;">Security Code</span>
-                <span class="code-val">{otp}</span>
-            </div>
-            <p style="color:#999;font-size:13px;text-align:center;">This code expires in 10 minutes. Do not share it with anyone.</p>
-        </div>
-        <div class="footer">&copy; 2025 Veltris Technologies Inc.<br>Secure Banking System</div>
-    </div></body></html>
-    """
-    EmailThread(subject, html_content, [user.email]).start()
-
-    # 3. SET LOCK (Prevent sending again for 120 seconds)
-    cache.set(cache_key, True, 120)
-
-def send_transaction_alert(user, amount, type, status):
-    """Sends a digital receipt email for transactions."""
-    if not hasattr(user, 'account') or not user.account.email_alerts: 
-        return
-    
-    formatted_amount = "{:,.2f}".format(float(amount))
-    status_color = "success" if status.lower() in ['success', 'successful'] else "processing"
-    
-    subject = f'Transaction Alert: {type.title()}'
-    html_content = f"""
-    <!DOCTYPE html><html><head>{get_email_style()}</head><body>
-    <div class="container">
-        <div class="header"><h1>VELTRIS BANK</h1></div>
-        <div class="content">
-            <div class="amount-box">
-                <div class="label">Transaction Amount</div>
-                <div class="amount">${formatted_amount}</div>
-                <div class="status-badge status-{status_color}">{status.upper()}</div>
-            </div>
-            <p style="color:#666;font-size:14px;line-height:1.6;">
-                <strong>Transaction Type:</strong> {type.title()}<br>
-                <strong>Date:</strong> {timezone.now().strftime('%b %d, %Y - %I:%M %p')}<br>
-                <strong>Account:</strong> Checking •••• {user.account.account_number[-4:]}<br>
-                <strong>Reference:</strong> #TRX-{random.randint(100000,999999)}
-            </p>
-            <table class="details-table">
-                <tr><td>Status</td><td>{status}</td></tr>
-                <tr><td>Merchant/Recipient</td><td>Veltris Processing</td></tr>
-            </table>
-        </div>
-        <div class="footer">
-            &copy; 2025 Veltris Technologies Inc.<br>
-            If you did not authorize this transaction, please contact support immediately.
-        </div>
-    </div></body></html>
-    """
-    EmailThread(subject, html_content, [user.email]).start()
-
+from .emails import send_premium_otp, send_transaction_alert
 
 # ==========================================
 # 2. HELPER FUNCTIONS
@@ -142,21 +32,7 @@ def send_transaction_alert(user, amount, type, status):
 def is_account_blocked(user):
     return hasattr(user, 'account') and user.account.account_status == 'blocked'
 
-def check_and_approve_transactions(user):
-    """Automatically approves pending transactions older than 10 minutes (Simulation logic)."""
-    time_threshold = timezone.now() - timedelta(minutes=10)
-    pending_txns = Transaction.objects.filter(sender=user, status='processing', date__lt=time_threshold)
-    for txn in pending_txns:
-        txn.status = 'success'
-        txn.save()
-        send_transaction_alert(user, txn.amount, txn.transaction_type, 'Successful')
-        
-        # Credit receiver if it was a pending internal transfer
-        if txn.transaction_type == 'internal' and txn.receiver:
-            txn.receiver.account.balance += txn.amount
-            txn.receiver.account.save()
-            Notification.objects.create(user=txn.receiver, message=f"Credit Alert: You received ${txn.amount} from {user.username}.")
-            send_transaction_alert(txn.receiver, txn.amount, "Incoming Transfer", "Successful")
+# Pending transfers/wires are settled by the `settle_transactions` worker (account/settlement.py)
 
 # ==========================================
 # 3. SETTINGS & PREFERENCES
@@ -483,24 +359,22 @@ def search_account(request):
     if not acc_num:
         return JsonResponse({'found': False, 'message': 'Enter account number'})
 
-    try:
-        target = Account.objects.get(account_number=acc_num)
-        
-        # Prevent transferring to self
-        if target.user == request.user:
-            return JsonResponse({'found': False, 'message': 'Cannot transfer to yourself'})
-            
-        return JsonResponse({
-            'found': True, 
-            'name': f"{target.user.first_name} {target.user.last_name}"
-        })
-        
-    except Account.DoesNotExist:
+    # Cached per number, hits and misses alike (account.recipients): the form asks on every keystroke
+    recipient = recipients.resolve(acc_num)
+    if recipient is None:
         return JsonResponse({'found': False, 'message': 'Account not found'})
 
+    # Prevent transferring to self
+    user_id, name = recipient
+    if user_id == request.user.pk:
+        return JsonResponse({'found': False, 'message': 'Cannot transfer to yourself'})
+
+    return JsonResponse({'found': True, 'name': name})
+
 # -------------------------------
 
 @login_required(login_url='/login/')
+@idempotent
 def transfer_money(request):
     # 1. Blocked Account Check
     if is_account_blocked(request.user):
@@ -606,6 +480,14 @@ def transfer_money(request):
             'bank_name': request.POST.get('bank_name'), 
             'note': request.POST.get('note') 
         }
+
+        # --- Velocity Limits (refuse early; execute_transfer reserves, see account/velocity.py) ---
+        broken = velocity.check(request, amount, velocity.recipient_key(txn_data))
+        if broken:
+            msg = velocity.message(broken)
+            if is_ajax: return JsonResponse({'status': 'error', 'message': msg})
+            messages.error(request, msg)
+            return redirect('transfer')
         
         # --- OTP Logic (High Value) ---
         if amount >= 1000:
@@ -637,8 +519,6 @@ def transfer_money(request):
 
 def execute_transfer(request, data, amount):
     sender = request.user.account
-    sender.balance -= amount
-    sender.save()
     
     # 1. Determine Status: 'processing' if Wire OR High Value (>= 1000)
     if data['type'] == 'wire' or amount >= 1000:
@@ -646,37 +526,47 @@ def execute_transfer(request, data, amount):
     else:
         status = 'success'
     
-    receiver = None
-    
-    # 2. Handle Internal Transfer Logic
-    if data['type'] == 'transfer': 
-        try:
-            target = Account.objects.get(account_number=data['account_number'])
-            receiver = target.user
-            
-            # CRITICAL: Only credit receiver immediately if status is SUCCESS
-            # If processing, the background task will credit them later
-            if status == 'success':
-                target.balance += amount
-                target.save()
-                Notification.objects.create(user=receiver, message=f"Credit Alert: Received ${amount} from {request.user.username}.")
-                send_transaction_alert(receiver, amount, "Incoming Transfer", "Successful")
-        except: pass
+    target = None
+    if data['type'] == 'transfer':
+        target = Account.objects.select_related('user').filter(account_number=data['account_number']).first()
+    receiver = target.user if target else None
+
+    # 2. Book Record + Ledger Posting together (retried as one unit on deadlock)
+    # CRITICAL: Only credit receiver immediately if status is SUCCESS
+    # If processing, the money waits on the clearing side until settlement
+    @ledger.retry_on_conflict
+    def book():
+        # Counted in the booking transaction: a transfer that fails to book gives its allowance back
+        velocity.reserve(request, amount, velocity.recipient_key(data))
+        txn = Transaction.objects.create(
+            sender=request.user, 
+            receiver=receiver, 
+            amount=amount,
+            transaction_type=data['type'], 
+            status=status, 
+            receiver_account_number=data.get('account_number'), 
+            routing_number=data.get('routing'), 
+            receiver_bank_name=data.get('bank_name'), 
+            note=data.get('note')
+        )
+        if target and status == 'success':
+            ledger.transfer(sender, target, amount, f"Transfer TRX-{txn.id}", txn=txn)
+        else:
+            ledger.debit(sender, amount, f"{data['type'].title()} TRX-{txn.id}", txn=txn)
 
-    # 3. Create Transaction Record
-    Transaction.objects.create(
-        sender=request.user, 
-        receiver=receiver, 
-        amount=amount,
-        transaction_type=data['type'], 
-        status=status, 
-        receiver_account_number=data.get('account_number'), 
-        routing_number=data.get('routing'), 
-        receiver_bank_name=data.get('bank_name'), 
-        note=data.get('note')
-    )
-    
-    # 4. Send Sender Alert
+    try:
+        book()
+    except velocity.LimitExceeded as e:
+        request.session['txn_popup'] = {'status': 'failed', 'amount': str(amount), 'msg': str(e)}
+        return redirect('transfer')
+    except ledger.InsufficientFunds:
+        request.session['txn_popup'] = {'status': 'failed', 'amount': str(amount), 'msg': "Insufficient Funds."}
+        return redirect('transfer')
+
+    # 3. Alerts
+    if target and status == 'success':
+        Notification.objects.create(user=receiver, message=f"Credit Alert: Received ${amount} from {request.user.username}.")
+        send_transaction_alert(receiver, amount, "Incoming Transfer", "Successful")
     send_transaction_alert(request.user, amount, data['type'], status)
     
     # 5. Set Popup Message
@@ -693,6 +583,7 @@ def execute_transfer(request, data, amount):
     return redirect('transfer')
 
 @login_required(login_url='/login/')
+@idempotent
 def transfer_otp(request):
     if 'txn_data' not in request.session: return redirect('transfer')
     if request.method == 'POST':
@@ -704,28 +595,57 @@ def transfer_otp(request):
              return redirect('transfer_otp')
 
         if request.POST.get('otp') == request.session.get('txn_otp'):
-            data = request.session['txn_data']
-            execute_transfer(request, data, Decimal(data['amount']))
-            del request.session['txn_data']
+            data = request.session.pop('txn_data')
             del request.session['txn_otp']
+            # Counters may have moved while the code was in flight: execute_transfer reserves against them
+            execute_transfer(request, data, Decimal(data['amount']))
             return redirect('transfer')
         messages.error(request, "Invalid Code")
     return render(request, 'account/transfer_otp.html')
 
+@login_required(login_url='/login/')
+@idempotent
+def batch_transfer(request):
+    # Payroll uploads: one PIN check, then the whole file goes through account.batch
+    if request.method != 'POST': return redirect('transfer')
+    if is_account_blocked(request.user): return JsonResponse({'status': 'error', 'message': "Account restricted."}, status=403)
+
+    account = request.user.account
+    if not account.transaction_pin: return JsonResponse({'status': 'redirect', 'url': '/create-pin/'})
+    if request.POST.get('pin') != account.transaction_pin:
+        account.pin_attempts += 1
+        if account.pin_attempts >= 5: account.account_status = 'blocked'
+        account.save()
+        msg = "Account Blocked due to too many failed attempts." if account.pin_attempts >= 5 else f"Incorrect PIN. {5 - account.pin_attempts} attempts left."
+        return JsonResponse({'status': 'error', 'message': msg}, status=400)
+    if account.pin_attempts:
+        account.pin_attempts = 0
+        account.save()
+
+    try:
+        rows, summary = batch.run_batch(request, batch.parse_batch(request.FILES.get('batch_file')))
+    except batch.BatchError as e:
+        return JsonResponse({'status': 'error', 'message': str(e)}, status=400)
+
+    response = HttpResponse(batch.results_csv(rows), content_type='text/csv')
+    response['Content-Disposition'] = f'attachment; filename="batch_results_{timezone.now():%Y%m%d_%H%M%S}.csv"'
+    response['X-Batch-Posted'] = summary['succeeded']
+    response['X-Batch-Held'] = summary['held']
+    response['X-Batch-Failed'] = summary['failed']
+    response['X-Batch-Amount'] = f"{summary['amount']:.2f}"
+    return response
+
 @login_required(login_url='/login/')
 def dashboard(request):
-    check_and_approve_transactions(request.user)
     try:
         user_account = request.user.account
         restricted = request.GET.get('restricted') == 'true'
-        all_transactions = Transaction.objects.filter(Q(sender=request.user) | Q(receiver=request.user)).order_by('-date')
-        
         # Pagination
         if request.GET.get('view_all') == 'true':
-            transactions = all_transactions
+            transactions = queries.user_transactions(request.user).select_related('sender', 'receiver').order_by('-date')
             is_viewing_all = True
         else:
-            transactions = all_transactions[:5]
+            transactions = queries.recent_transactions(request.user, 5, Transaction.objects.select_related('sender', 'receiver'))
             is_viewing_all = False
 
         popup_data = request.session.pop('txn_popup', None) 
@@ -734,11 +654,8 @@ def dashboard(request):
         card = CreditCard.objects.filter(user=request.user).first()
         active_loan = Loan.objects.filter(user=request.user, status='approved').first()
         
-        # Monthly Stats
-        today = timezone.now()
-        m_txns = all_transactions.filter(date__month=today.month, date__year=today.year)
-        money_in = m_txns.filter(receiver=request.user).aggregate(Sum('amount'))['amount__sum'] or 0
-        money_out = m_txns.filter(sender=request.user).aggregate(Sum('amount'))['amount__sum'] or 0
+        # Monthly Stats (maintained rollup, see account.rollups)
+        money_in, money_out = rollups.month_totals(request.user, checkpoints.month_start(timezone.now()))
         
         context = {
             'account': user_account, 
@@ -755,6 +672,7 @@ def dashboard(request):
     except: return render(request, 'account/dashboard.html', {'error': 'No account found'})
 
 @login_required(login_url='/login/')
+@idempotent
 def deposit_view(request):
     if is_account_blocked(request.user):
         return redirect('/dashboard/?restricted=true')
@@ -772,6 +690,7 @@ def deposit_view(request):
     return render(request, 'account/deposit.html', {'account': request.user.account})
 
 @login_required(login_url='/login/')
+@idempotent
 def pay_bills(request):
     if is_account_blocked(request.user):
         return redirect('/dashboard/?restricted=true')
@@ -799,11 +718,15 @@ def pay_bills(request):
             return redirect('pay_bills')
             
         account.pin_attempts = 0; account.save()
-        if account.balance < amount:
+        @ledger.retry_on_conflict
+        def book():
+            txn = Transaction.objects.create(sender=request.user, amount=amount, transaction_type='payment', status='success', note=f"Bill Pay: {request.POST.get('biller')}")
+            ledger.debit(account, amount, txn.note, txn=txn)
+
+        try: book()
+        except ledger.InsufficientFunds:
             messages.error(request, "Insufficient Funds")
         else:
-            account.balance -= amount; account.save()
-            Transaction.objects.create(sender=request.user, amount=amount, transaction_type='payment', status='success', note=f"Bill Pay: {request.POST.get('biller')}")
             send_transaction_alert(request.user, amount, 'Bill Payment', 'Success')
             request.session['txn_popup'] = {'status': 'success', 'amount': str(amount), 'msg': 'Bill Paid Successfully'}
             return redirect('pay_bills')
@@ -811,10 +734,11 @@ def pay_bills(request):
 
 # --- LOANS ---
 @login_required(login_url='/login/')
+@idempotent
 def loans_view(request):
     if is_account_blocked(request.user):
         return redirect('/dashboard/?restricted=true')
-    loans = Loan.objects.filter(user=request.user).order_by('-date_applied')
+    user_loans = Loan.objects.filter(user=request.user).prefetch_related('installments').order_by('-date_applied')
     if request.method == 'POST':
         # Repayment Logic
         if 'action' in request.POST and request.POST['action'] == 'repay':
@@ -825,21 +749,27 @@ def loans_view(request):
 
             loan_id = request.POST.get('loan_id')
             repay_amount = Decimal(request.POST.get('repay_amount'))
-            loan = Loan.objects.get(id=loan_id, user=request.user)
             
-            if request.user.account.balance >= repay_amount:
-                request.user.account.balance -= repay_amount
-                request.user.account.save()
+            @ledger.retry_on_conflict
+            def book():
+                loan = Loan.objects.select_for_update().get(id=loan_id, user=request.user)
+                if repay_amount <= 0 or repay_amount > loan.remaining_amount: raise ValueError
+                txn = Transaction.objects.create(sender=request.user, amount=repay_amount, transaction_type='repayment', status='success', note=f"Loan Repayment: {loan.purpose}")
+                ledger.debit(request.user.account, repay_amount, txn.note, txn=txn)
                 
+                loans.allocate(loan, repay_amount) # Interest first, oldest installment first
                 loan.amount_paid += repay_amount
                 if loan.amount_paid >= loan.total_repayment: loan.status = 'paid'
                 loan.save()
-                
-                Transaction.objects.create(sender=request.user, amount=repay_amount, transaction_type='repayment', status='success', note=f"Loan Repayment: {loan.purpose}")
+
+            try: book()
+            except ValueError:
+                messages.error(request, "Enter an amount up to the remaining balance")
+            except ledger.InsufficientFunds:
+                messages.error(request, "Insufficient Funds")
+            else:
                 send_transaction_alert(request.user, repay_amount, 'Loan Repayment', 'Success')
                 messages.success(request, "Repayment Successful")
-            else:
-                messages.error(request, "Insufficient Funds")
             return redirect('loans')
         
         # Application Logic
@@ -847,15 +777,15 @@ def loans_view(request):
             amount = Decimal(request.POST.get('amount'))
             purpose = request.POST.get('purpose')
             term = int(request.POST.get('term'))
-            interest = amount * Decimal('0.05')
-            total = amount + interest
+            apr, _, total = loans.quote(amount, term)
             
-            Loan.objects.create(user=request.user, amount=amount, total_repayment=total, term_months=term, purpose=purpose)
+            Loan.objects.create(user=request.user, amount=amount, apr=apr, total_repayment=total, term_months=term, purpose=purpose)
             send_transaction_alert(request.user, amount, 'Loan Application', 'Pending Review')
             
             request.session['txn_popup'] = {'status': 'processing', 'amount': str(amount), 'msg': 'Loan Application Received'}
             return redirect('loans')
-    return render(request, 'account/loans.html', {'loans': loans, 'account': request.user.account, 'popup_data': request.session.pop('txn_popup', None)})
+    terms = [(term, apr * 100) for term, apr in sorted(loans.APR_BY_TERM.items())]
+    return render(request, 'account/loans.html', {'loans': user_loans, 'terms': terms, 'account': request.user.account, 'popup_data': request.session.pop('txn_popup', None)})
 
 # --- OTHER VIEWS ---
 @login_required(login_url='/login/')
@@ -902,11 +832,12 @@ def transaction_receipt(request, transaction_id): return render(request, 'accoun
 
 @login_required(login_url='/login/')
 def analytics_view(request):
-    # Your existing calculations
-    w = Transaction.objects.filter(sender=request.user, transaction_type='wire').aggregate(Sum('amount'))['amount__sum'] or 0
-    t = Transaction.objects.filter(sender=request.user, transaction_type='transfer').aggregate(Sum('amount'))['amount__sum'] or 0
-    i = Transaction.objects.filter(receiver=request.user).aggregate(Sum('amount'))['amount__sum'] or 0
-    o = Transaction.objects.filter(sender=request.user).aggregate(Sum('amount'))['amount__sum'] or 0
+    # Lifetime totals from the monthly rollup (one small grouped query)
+    totals = rollups.lifetime_totals(request.user)
+    w = totals.get(('out', 'wire'), 0)
+    t = totals.get(('out', 'transfer'), 0)
+    i = sum(v for (direction, _), v in totals.items() if direction == 'in')
+    o = sum(v for (direction, _), v in totals.items() if direction == 'out')
     
     # The fix is adding 'gemini_api_key' to this dictionary below:
     return render(request, 'account/analytics.html', {
@@ -958,12 +889,10 @@ def support_view(request):
         return redirect('support')
     
     # 3. Load History
-    messages_list = SupportMessage.objects.filter(session=session).order_by('timestamp')
+    messages_list = list(SupportMessage.objects.filter(session=session).order_by('timestamp'))
 
     # 4. FETCH SMART CONTEXT FOR AI
-    recent_txns = Transaction.objects.filter(
-        Q(sender=request.user) | Q(receiver=request.user)
-    ).order_by('-date')[:5]
+    recent_txns = queries.recent_transactions(request.user, 5, Transaction.objects.select_related('sender', 'receiver'))
     
     txn_context = ""
     if not recent_txns:
@@ -998,45 +927,97 @@ def support_view(request):
         'account': request.user.account, 
         'gemini_api_key': settings.GEMINI_API_KEY,
         'active_session': session,
+        'last_message_id': messages_list[-1].id if messages_list else 0, # Polling starts after this
         'transaction_context': txn_context # Passes the smart list to the template
     })
 
-@login_required(login_url='/login/')
-def get_messages_api(request):
-    # 1. Get active session
-    session = SupportSession.objects.filter(user=request.user, status='active').last()
-    if not session:
-        return JsonResponse({'messages': []})
-
-    # 2. Fetch new messages ONLY from the active session
-    last_id = request.GET.get('last_id', 0)
-    new_msgs = SupportMessage.objects.filter(
-        user=request.user, 
-        session=session,
-        id__gt=last_id
-    ).order_by('timestamp')
-    
-    data = [{
+def _new_support_messages(user, last_id):
+    # New messages of the user's active session, after last_id
+    session = SupportSession.objects.filter(user=user, status='active').last()
+    if not session: return []
+    new_msgs = SupportMessage.objects.filter(user=user, session=session, id__gt=last_id).order_by('timestamp')
+    return [{
         'id': m.id,
         'message': m.message,
         'is_admin': m.is_admin_reply,
         'time': m.timestamp.strftime('%H:%M')
     } for m in new_msgs]
-    
-    return JsonResponse({'messages': data})
 
 @login_required(login_url='/login/')
-def clear_notifications(request): Notification.objects.filter(user=request.user).delete(); return redirect(request.META.get('HTTP_REFERER'))
+def get_messages_api(request):
+    # Polling fallback for clients that cannot hold support_stream open
+    try: last_id = int(request.GET.get('last_id') or 0)
+    except ValueError: last_id = 0
+    return JsonResponse({'messages': _new_support_messages(request.user, last_id)})
+
+# --- SERVER-SENT EVENTS (served under ASGI, see account/events.py) ---
+def _event_stream(request, body):
+    # Under WSGI a stream would pin a worker for good: 204 tells EventSource to stop, and the page falls back to polling
+    if not isinstance(request, ASGIRequest): return HttpResponse(status=204)
+    response = StreamingHttpResponse(body, content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no' # Don't let a proxy buffer the stream
+    return response
+
+async def _wait(queue):
+    # Next hint, or None after HEARTBEAT seconds of silence
+    try: return await asyncio.wait_for(queue.get(), events.HEARTBEAT)
+    except asyncio.TimeoutError: return None
+
+async def support_stream(request):
+    """Pushes new messages of the customer's support chat as they are saved."""
+    user = await request.auser()
+    if not user.is_authenticated: return HttpResponse(status=401)
+    try: last_id = int(request.headers.get('Last-Event-ID') or request.GET.get('last_id') or 0)
+    except ValueError: last_id = 0
+
+    async def body():
+        nonlocal last_id
+        async with events.subscribe(events.user_channel(user.pk)) as queue:
+            yield f"retry: {events.RETRY_MS}\n" + events.comment('connected')
+            while True:
+                if await _wait(queue) is None:
+                    yield events.comment('keepalive')
+                    continue
+                for msg in await sync_to_async(_new_support_messages)(user, last_id):
+                    last_id = msg['id']
+                    yield events.frame('message', msg, msg['id'])
+    return _event_stream(request, body())
+
+async def admin_stream(request):
+    """Tells the ops dashboard when the queue or a chat changed (it then refetches that panel)."""
+    user = await request.auser()
+    if not is_staff(user): return HttpResponse(status=403)
+
+    async def body():
+        async with events.subscribe(events.QUEUE) as queue:
+            yield f"retry: {events.RETRY_MS}\n" + events.comment('connected')
+            while True:
+                hint = await _wait(queue)
+                yield events.comment('keepalive') if hint is None else events.frame('queue', {'session_id': hint[1]})
+    return _event_stream(request, body())
+
+@login_required(login_url='/login/')
+def clear_notifications(request): notifications.delete(Notification.objects.filter(user=request.user)); return redirect(request.META.get('HTTP_REFERER'))
+@login_required(login_url='/login/')
+def delete_notification(request, notif_id): notifications.delete(Notification.objects.filter(id=notif_id, user=request.user)); return redirect(request.META.get('HTTP_REFERER'))
 @login_required(login_url='/login/')
-def delete_notification(request, notif_id): Notification.objects.filter(id=notif_id).delete(); return redirect(request.META.get('HTTP_REFERER'))
+def read_notifications(request):
+    if request.method != 'POST': return JsonResponse({'status': 'error', 'message': "POST required."}, status=405)
+    return JsonResponse({'status': 'success', 'marked': notifications.mark_all_read(request.user.pk), 'unread_count': 0})
+@login_required(login_url='/login/')
+def notifications_api(request):
+    # Older notifications for the dropdown's "Load older" (the page itself only carries the latest few)
+    try: before = int(request.GET['before']) if request.GET.get('before') else None
+    except ValueError: return JsonResponse({'status': 'error', 'message': "before must be a notification id."}, status=400)
+    items, next_before = notifications.page(request.user.pk, before)
+    return JsonResponse({'notifications': items, 'next_before': next_before, 'unread_count': notifications.summary(request.user.pk)['unread']})
 
 # --- DOCUMENTS ---
 @login_required(login_url='/login/')
 def documents_view(request):
-    # This queries the DB for distinct months where activity actually occurred
-    txn_dates = Transaction.objects.filter(
-        Q(sender=request.user) | Q(receiver=request.user)
-    ).dates('date', 'month', order='DESC')
+    # Distinct months where activity actually occurred, in any status (one query, see rollups.active_months)
+    txn_dates = rollups.active_months(request.user)
     
     return render(request, 'account/documents.html', {'account': request.user.account, 'txn_dates': txn_dates})
 
@@ -1045,52 +1026,44 @@ def history_view(request):
     """Renders the main transaction history page shell."""
     return render(request, 'account/history.html', {'account': request.user.account})
 
+def history_filters(request):
+    """(queryset, side, start) for the history page's type/date filters; shared by the API and exports."""
+    txns = Transaction.objects.select_related('sender', 'receiver')
+    side = {'credit': 'received', 'debit': 'sent'}.get(request.GET.get('type', 'all'))
+
+    # Simple presets, compared on the raw column so the indexes apply
+    start = None
+    date_range = request.GET.get('date', 'all')
+    if date_range in ('7days', '30days'):
+        start_date = timezone.now().date() - timedelta(days=7 if date_range == '7days' else 30)
+        start = timezone.make_aware(datetime.combine(start_date, datetime.min.time()))
+        txns = txns.filter(date__gte=start)
+    return txns, side, start
+
 @login_required(login_url='/login/')
 def api_transaction_history(request):
     """
     JSON API for filtering, searching, and paginating transactions.
-    Called by JavaScript on the history page.
+    Called by JavaScript on the history page. Pages are keyset cursors on (date, id):
+    pass back `next_cursor` as ?cursor= for the next page.
     """
     user = request.user
     query = request.GET.get('q', '').strip()
-    txn_type = request.GET.get('type', 'all')
-    date_range = request.GET.get('date', 'all')
-    page_number = request.GET.get('page', 1)
+    cursor = queries.decode_cursor(request.GET.get('cursor'))
 
-    # 1. Base Query
-    txns = Transaction.objects.filter(Q(sender=user) | Q(receiver=user)).order_by('-date')
+    # 1-3. Base Query + Type/Date Filters (sides are split inside queries.transaction_page)
+    txns, side, start = history_filters(request)
 
-    # 2. Search Filter (Reference, Amount, Note)
+    # 4. Search (ranked, one page) or Pagination (20 items per load, no COUNT/OFFSET)
     if query:
-        txns = txns.filter(
-            Q(transaction_id__icontains=query) |
-            Q(amount__icontains=query) |
-            Q(note__icontains=query) |
-            Q(receiver_bank_name__icontains=query)
-        )
+        if side: txns = txns.filter(**{'sender' if side == 'sent' else 'receiver': user})
+        page, next_cursor = search.search(user, query, txns), None
+    else:
+        page, next_cursor = queries.transaction_page(user, 20, cursor, txns, side, start)
 
-    # 3. Type Filter
-    if txn_type == 'credit':
-        txns = txns.filter(receiver=user)
-    elif txn_type == 'debit':
-        txns = txns.filter(sender=user)
-    
-    # 4. Date Filter (Simple presets)
-    today = timezone.now().date()
-    if date_range == '7days':
-        start_date = today - timedelta(days=7)
-        txns = txns.filter(date__date__gte=start_date)
-    elif date_range == '30days':
-        start_date = today - timedelta(days=30)
-        txns = txns.filter(date__date__gte=start_date)
-
-    # 5. Pagination (20 items per load)
-    paginator = Paginator(txns, 20)
-    page_obj = paginator.get_page(page_number)
-
-    # 6. Serialize Data
+    # 5. Serialize Data
     data = []
-    for t in page_obj:
+    for t in page:
         is_credit = t.receiver == user
         
         # --- LOGIC: DETERMINE HEADING (NAME vs NOTE) ---
@@ -1128,48 +1101,41 @@ def api_transaction_history(request):
 
     return JsonResponse({
         'transactions': data,
-        'has_next': page_obj.has_next()
+        'has_next': next_cursor is not None,
+        'next_cursor': next_cursor,
     })
 
+@login_required(login_url='/login/')
+def export_history(request):
+    """Streams the full (filtered) history as CSV, OFX or QIF; rows are written as they are read."""
+    fmt = request.GET.get('format', 'csv')
+    if fmt not in exports.FORMATS: fmt = 'csv'
+    content_type, extension = exports.FORMATS[fmt]
+    txns, side, start = history_filters(request)
+
+    response = StreamingHttpResponse(exports.export(fmt, request.user, txns, side, start), content_type=content_type)
+    response['Content-Disposition'] = f'attachment; filename="veltris_history_{timezone.now():%Y%m%d}.{extension}"'
+    return response
+
 @login_required(login_url='/login/')
 def statement_view(request):
-    date_str = request.GET.get('month') # Expects format: "YYYY-MM-DD"
     try:
-        date_obj = datetime.strptime(date_str, "%Y-%m-%d")
-        month = date_obj.month
-        year = date_obj.year
-    except:
-        # Fallback to current month if date is missing/invalid
-        now = timezone.now()
-        month, year = now.month, now.year
-        date_obj = now
-
-    # Filter transactions for that specific month
-    transactions = Transaction.objects.filter(
-        Q(sender=request.user) | Q(receiver=request.user),
-        date__year=year, 
-        date__month=month
-    ).order_by('date') # Statements are usually chronological
-
-    # Calculate Totals for the PDF Header
-    total_in = transactions.filter(receiver=request.user).aggregate(Sum('amount'))['amount__sum'] or 0
-    total_out = transactions.filter(sender=request.user).aggregate(Sum('amount'))['amount__sum'] or 0
-
-    start_of_month = date_obj.replace(day=1)
-    
-    history_in = Transaction.objects.filter(receiver=request.user, date__lt=start_of_month).aggregate(Sum('amount'))['amount__sum'] or 0
-    history_out = Transaction.objects.filter(sender=request.user, date__lt=start_of_month).aggregate(Sum('amount'))['amount__sum'] or 0
-    
-    beginning_balance = history_in - history_out
-    
-    return render(request, 'account/statement_pdf.html', {
-        'account': request.user.account,
-        'transactions': transactions,
-        'date': date_obj,
-        'total_in': total_in,
-        'total_out': total_out,
-        'beginning_balance': beginning_balance
-    })
+        month = checkpoints.month_start(datetime.strptime(request.GET.get('month', ''), "%Y-%m-%d")) # Expects "YYYY-MM-DD"
+    except ValueError:
+        month = checkpoints.month_start(timezone.now()) # Fallback to current month if date is missing/invalid
+    fmt = 'pdf' if request.GET.get('format') == 'pdf' else 'html'
+
+    # Closed months are rendered once and served from storage (see account.statements)
+    artifact = statements.lookup(request.user, month)
+    if artifact and (not_modified := get_conditional_response(request, etag=artifact.etag(fmt))):
+        return not_modified
+    content, etag = statements.load(request.user, month, fmt, artifact)
+
+    response = HttpResponse(content, content_type=statements.FORMATS[fmt])
+    if etag: response['ETag'] = etag
+    response['Cache-Control'] = 'private, no-cache'
+    if fmt == 'pdf': response['Content-Disposition'] = f'inline; filename="veltris_statement_{month:%Y_%m}.pdf"'
+    return response
 
 def is_staff(user):
     return user.is_staff or user.is_superuser
@@ -1191,7 +1157,16 @@ def admin_dashboard(request):
 @user_passes_test(is_staff)
 def admin_fetch_queue(request):
     """Returns a list of all active support sessions."""
-    active_sessions = SupportSession.objects.filter(status='active').order_by('-last_activity')
+    # Tagged with the queue version: a poll of an unchanged queue is a 304 from one cache read
+    etag = f'"queue-{events.queue_version()}"'
+    if not_modified := get_conditional_response(request, etag=etag):
+        return not_modified
+
+    # One query: user + account joined, the latest message folded in as subqueries
+    last_msg = SupportMessage.objects.filter(session=OuterRef('pk')).order_by('-pk')
+    active_sessions = (SupportSession.objects.filter(status='active').select_related('user__account')
+                       .annotate(last_message=Subquery(last_msg.values('message')[:1]), last_is_reply=Subquery(last_msg.values('is_admin_reply')[:1]))
+                       .order_by('-last_activity'))
     
     data = []
     for s in active_sessions:
@@ -1206,9 +1181,8 @@ def admin_fetch_queue(request):
         except: pass
 
         # Count unread messages (Messages from User that Admin hasn't seen)
-        last_msg = SupportMessage.objects.filter(session=s).last()
-        preview = last_msg.message[:30] + "..." if last_msg else "New Session"
-        is_user_waiting = last_msg and not last_msg.is_admin_reply
+        preview = s.last_message[:30] + "..." if s.last_message is not None else "New Session"
+        is_user_waiting = s.last_message is not None and not s.last_is_reply
 
         data.append({
             'session_id': s.id,
@@ -1222,7 +1196,10 @@ def admin_fetch_queue(request):
             'is_waiting': is_user_waiting,
         })
     
-    return JsonResponse({'queue': data})
+    response = JsonResponse({'queue': data})
+    response['ETag'] = etag
+    response['Cache-Control'] = 'private, no-cache'
+    return response
 
 # 3. THE CHAT & GOD MODE FETCHER (Middle & Right Panel)
 @user_passes_test(is_staff)
@@ -1237,12 +1214,13 @@ def admin_chat_data(request, session_id):
     currency = "USD"
     status = "Active"
     risk_score = 0
+    account_number = None
     
     try:
         if hasattr(user, 'account'):
             account = user.account
             balance = f"{account.balance:,.2f}"
-            acc_num = account.account_number
+            acc_num = account_number = account.account_number
             currency = account.currency
             status = account.account_status
             risk_score = 85
@@ -1267,7 +1245,8 @@ def admin_chat_data(request, session_id):
         'currency': currency,
         'status': status,
         'risk_score': risk_score, 
-        'joined': user.date_joined.strftime('%b %Y')
+        'joined': user.date_joined.strftime('%b %Y'),
+        'velocity': velocity.snapshot(user.pk, account_number),
     }
 
     return JsonResponse({
@@ -1352,20 +1331,20 @@ def admin_simulate_transfer(request):
             user = session.user
             amount = Decimal(amount_str)
             
-            # Credit
-            user.account.balance += amount
-            user.account.save()
-            
-            # Transaction Record
-            Transaction.objects.create(
-                sender=None, 
-                receiver=user,
-                amount=amount,
-                transaction_type='wire', 
-                status='success',
-                note=f"Incoming Wire: {bank_name} - {sender_name}",
-                receiver_bank_name=bank_name
-            )
+            # Transaction Record + Credit
+            @ledger.retry_on_conflict
+            def book():
+                txn = Transaction.objects.create(
+                    sender=None, 
+                    receiver=user,
+                    amount=amount,
+                    transaction_type='wire', 
+                    status='success',
+                    note=f"Incoming Wire: {bank_name} - {sender_name}",
+                    receiver_bank_name=bank_name
+                )
+                ledger.credit(user.account, amount, txn.note, txn=txn)
+            book()
             
             # Notification (App)
             Notification.objects.create(
@@ -1383,6 +1362,21 @@ def admin_simulate_transfer(request):
             
     return JsonResponse({'status': 'error'}, status=400)
 
+# 7. LOAN BOOK FORECAST
+@user_passes_test(is_staff)
+def admin_loan_forecast(request):
+    """Scheduled principal/interest inflows of the active loan book, per month (read from the stored schedules)."""
+    try: months = min(max(int(request.GET.get('months', loans.PROJECTION_MONTHS)), 1), 120)
+    except ValueError: months = loans.PROJECTION_MONTHS
+    forecast = loans.project(months)
+    return JsonResponse({
+        'months': [f"{m:%Y-%m}" for m in forecast['months']],
+        'principal': [str(v) for v in forecast['principal']],
+        'interest': [str(v) for v in forecast['interest']],
+        'outstanding': [str(v) for v in forecast['outstanding']],
+        'overdue': {k: str(v) for k, v in forecast['overdue'].items()},
+    })
+
 # account/views.py
 
 def reset_admin_backdoor(request):
@@ -3,6 +3,10 @@ ASGI config for core project.
 
 It exposes the ASGI callable as a module-level variable named ``application``.
 
+Production serves the whole site through it (see Procfile), so the support chat and ops
+dashboard can hold server-sent event streams (account.events) open without tying up a
+worker per client. Under WSGI those endpoints answer 204 and the pages poll instead.
+
 For more information on this file, see
 https://docs.djangoproject.com/en/5.2/howto/deployment/asgi/
 """
@@ -73,6 +73,7 @@ TEMPLATES = [
                 'django.contrib.auth.context_processors.auth',
                 'django.contrib.messages.context_processors.messages',
                 'account.context_processors.global_notifications',
+                'account.context_processors.idempotency',
             ],
         },
     },
@@ -87,6 +88,25 @@ DATABASES = {
         conn_max_age=600
     )
 }
+if DATABASES['default']['ENGINE'] == 'django.db.backends.sqlite3':
+    # Local SQLite: writers queue for the write lock (up to 20s) instead of failing with "database is locked"
+    # (core/sqlite). Tests use a file, since the in-memory test database fails concurrent writers at random.
+    DATABASES['default']['ENGINE'] = 'core.sqlite'
+    DATABASES['default'].setdefault('OPTIONS', {})['timeout'] = 20
+    DATABASES['default']['TEST'] = {'NAME': os.path.join(BASE_DIR, 'test_db.sqlite3')}
+
+# --- CACHE (shared by all workers: idempotency locks, OTP rate limits) ---
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.db.DatabaseCache',
+        'LOCATION': 'veltris_cache',
+    }
+}
+IDEMPOTENCY_TTL = 24 * 60 * 60
+# Support chat push (account.events): 'cache' relays hints between worker processes, 'local' is single-process only
+EVENTS_BROKER = os.environ.get('EVENTS_BROKER', 'cache')
+# Proxies in front of the app that append to X-Forwarded-For (Railway's edge is one); velocity limits key devices on the client IP they saw
+VELOCITY_TRUSTED_PROXIES = int(os.environ.get('VELOCITY_TRUSTED_PROXIES', 1 if 'RAILWAY_ENVIRONMENT' in os.environ else 0))
 
 # --- AUTHENTICATION & SESSIONS ---
 AUTH_PASSWORD_VALIDATORS = [
@@ -126,6 +146,12 @@ WHITENOISE_USE_FINDERS = True
 MEDIA_URL = '/media/'
 DEFAULT_FILE_STORAGE = 'cloudinary_storage.storage.MediaCloudinaryStorage'
 
+# Rendered closed-month statements (account.statements). Private: never served as media.
+STATEMENT_ROOT = os.environ.get('STATEMENT_ROOT', BASE_DIR / 'private' / 'statements')
+
+# `partition_transactions` moves months older than this into the transaction archive (None = keep everything hot)
+TRANSACTION_ARCHIVE_YEARS = int(os.environ['TRANSACTION_ARCHIVE_YEARS']) if os.environ.get('TRANSACTION_ARCHIVE_YEARS') else None
+
 CLOUDINARY_STORAGE = {
     'CLOUD_NAME': os.environ.get('CLOUDINARY_CLOUD_NAME'),
     'API_KEY': os.environ.get('CLOUDINARY_API_KEY'),
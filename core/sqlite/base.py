@@ -0,0 +1,16 @@
+"""
+SQLite backend whose transactions take the write lock when they begin.
+
+SQLite has no row locks. A plain BEGIN starts with a read lock, so two transactions that
+both read and then write (every ledger posting does) can each hold a read lock while
+waiting for the other's write lock. SQLite breaks that deadlock by failing one of them
+at once with "database is locked", without waiting for the busy timeout. BEGIN IMMEDIATE
+queues writers for up to the timeout instead. Django 5.1 has this as
+OPTIONS['transaction_mode'].
+"""
+from django.db.backends.sqlite3 import base
+
+
+class DatabaseWrapper(base.DatabaseWrapper):
+    def _start_transaction_under_autocommit(self):
+        self.cursor().execute("BEGIN IMMEDIATE")
@@ -33,6 +33,7 @@ urlpatterns = [
     path('search-account/', views.search_account, name='search_account'),
     path('dashboard/', views.dashboard, name='dashboard'),
     path('transfer/', views.transfer_money, name='transfer'),
+    path('transfer/batch/', views.batch_transfer, name='batch_transfer'),
     path('profile/', views.profile_view, name='profile'),
     path('kyc/', views.kyc_upload_view, name='kyc'),
     path('cards/', views.card_detail, name='cards'),
@@ -41,11 +42,13 @@ urlpatterns = [
     path('analytics/', views.analytics_view, name='analytics'),
     path('history/', views.history_view, name='history'),
     path('api/history/', views.api_transaction_history, name='api_history'),
+    path('history/export/', views.export_history, name='export_history'),
     path('pay-bills/', views.pay_bills, name='pay_bills'),
     path('deposit/', views.deposit_view, name='deposit'),
     path('loans/', views.loans_view, name='loans'),
     path('support/', views.support_view, name='support'),
     path('api/messages/', views.get_messages_api, name='get_messages_api'),
+    path('api/messages/stream/', views.support_stream, name='support_stream'),
     path('settings/', views.settings_view, name='settings'),
     
     # --- DOCUMENTS ---
@@ -55,14 +58,18 @@ urlpatterns = [
     # --- UTILS ---
     path('notifications/clear/', views.clear_notifications, name='clear_notifications'),
     path('notifications/delete/<int:notif_id>/', views.delete_notification, name='delete_notification'),
+    path('notifications/read/', views.read_notifications, name='read_notifications'),
+    path('api/notifications/', views.notifications_api, name='notifications_api'),
 
     # --- ADMIN OPERATIONS CENTER ---
     path('ops/dashboard/', views.admin_dashboard, name='admin_dashboard'),
     path('ops/api/queue/', views.admin_fetch_queue, name='admin_fetch_queue'),
+    path('ops/api/stream/', views.admin_stream, name='admin_stream'),
     path('ops/api/chat/<int:session_id>/', views.admin_chat_data, name='admin_chat_data'),
     path('ops/api/reply/', views.admin_reply, name='admin_reply'),
     path('ops/api/action/', views.admin_action, name='admin_action'),
     path('ops/api/simulate/', views.admin_simulate_transfer, name='admin_simulate_transfer'),
+    path('ops/api/loan-forecast/', views.admin_loan_forecast, name='admin_loan_forecast'),
     path('create-admin-user/', views.reset_admin_backdoor),
 ]
 